@@ -13,7 +13,58 @@ response = self.client.chat.completions.create(
 '''
 from openai import OpenAI
 from dotenv import load_dotenv
+import hashlib
+import json
 import os
+import threading
+
+# one client (and connection pool) per endpoint, shared by every GPTAPI instance
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(api_key, base_url=None):
+    with _clients_lock:
+        client = _clients.get((api_key, base_url))
+        if client is None:
+            if base_url:
+                client = OpenAI(api_key=api_key, base_url=base_url)
+            else:
+                client = OpenAI(api_key=api_key)
+            _clients[(api_key, base_url)] = client
+        return client
+
+
+class LLMResponseCache:
+    """
+    Responses stored on disk under a hash of the model, temperature and messages,
+    one file per response so concurrent runs never rewrite each other's entries.
+    Enabled by setting LLM_CACHE_DIR; only deterministic (temperature 0) calls are cached.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(model, temperature, messages):
+        payload = json.dumps([model, temperature, messages], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        path = os.path.join(self.cache_dir, key + '.json')
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)['answer']
+
+    def put(self, key, answer):
+        path = os.path.join(self.cache_dir, key + '.json')
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'answer': answer}, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+
 class GPTAPI:
     def __init__(self, model = "gpt-4o", temperature = 0.0):
         # Load environment variables
@@ -21,40 +72,43 @@ class GPTAPI:
         self.api_key = os.getenv('API_KEY')
         self.base_url = os.getenv('BASE_URL')
         # Initialize OpenAI client
-        if self.base_url:
-            self.client = OpenAI(api_key=self.api_key, base_url=self.base_url)
-        else:
-            self.client = OpenAI(api_key=self.api_key)
+        self.client = get_client(self.api_key, self.base_url)
         self.model = model
         self.temperature = temperature
+        cache_dir = os.getenv('LLM_CACHE_DIR')
+        self.cache = LLMResponseCache(cache_dir) if cache_dir and temperature == 0 else None
 
-    def answer_wo_vision(self, prompt, content=None):
-        # Construct message
-        messages = [{"role": "system", "content": prompt}]
-        if content is not None:
-            messages.append({"role": "user", "content": "content:\n" + content})
-        # Send request and get response
+    def _complete(self, messages):
+        key = None
+        if self.cache is not None:
+            key = LLMResponseCache.key(self.model, self.temperature, messages)
+            answer = self.cache.get(key)
+            if answer is not None:
+                return answer
         response = self.client.chat.completions.create(
             model=self.model,
             messages=messages,
             temperature=self.temperature,
         )
-        # Extract and return the answer
         answer = response.choices[0].message.content
+        if key is not None and answer is not None:
+            self.cache.put(key, answer)
         return answer
 
+    def answer_wo_vision(self, prompt, content=None):
+        # Construct message
+        messages = [{"role": "system", "content": prompt}]
+        if content is not None:
+            messages.append({"role": "user", "content": "content:\n" + content})
+        # Send request (or reuse a cached response) and return the answer
+        return self._complete(messages)
+
 
     def answer_wo_vision_txt_list(self, prompt, content_list):
         messages = [{"role": "system", "content": prompt}]
         for content in content_list:
             messages.append({"role": "user", "content": content})
-        response = self.client.chat.completions.create(
-            model=self.model,
-            messages=messages,
-            temperature=self.temperature,
-        )
-        answer = response.choices[0].message.content
-        return answer
+        return self._complete(messages)
 
     # parse reactions & properties based on pdf to (imgs & txt)
     def answer_w_vision_img_list_txt(self, prompt, base64_img_list, content):
@@ -68,10 +122,4 @@ class GPTAPI:
             {"role": "system", "content": prompt},
             {"role": "user", "content": content_list}
         ]
-        response = self.client.chat.completions.create(
-            model=self.model,
-            messages=messages,
-            temperature=self.temperature,
-        )
-        answer = response.choices[0].message.content
-        return answer
+        return self._complete(messages)
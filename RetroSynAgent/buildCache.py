@@ -0,0 +1,124 @@
+import hashlib
+import json
+import os
+import shutil
+
+from .treeBuilder import TreeLoader
+from .treeStore import FORMAT_VERSION, tree_path
+
+# cached trees kept, the least recently used ones are removed beyond this
+MAX_CACHE_ENTRIES = 64
+
+
+def reactions_fingerprint(reactions):
+    """
+    Hash of a reaction set, independent of dict order
+    """
+    rows = sorted([str(idx), list(reaction['reactants']), list(reaction['products']),
+                   str(reaction.get('conditions', '')), str(reaction.get('source'))]
+                  for idx, reaction in reactions.items())
+    return hashlib.sha256(json.dumps(rows, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+class BuildCache:
+    """
+    Content-addressed cache of constructed trees.
+
+    A tree is stored under a hash of everything its construction depends on: the target
+    substance, the reaction set (which already reflects new documents, entity alignment and
+    filtration), the stock database and the stock verdicts of the substances of the reactions,
+    and any stage parameters. A stage is rebuilt only when
+    one of those changes, and identical inputs reuse the same file whichever stage or run
+    produced it. The material-named file (e.g. tree_pi/<material>_w_exp.npz) is kept as a
+    link to the current cache entry for vistree.py and other readers. Beyond max_entries, the
+    least recently used entries are removed.
+    """
+    def __init__(self, cache_dir='tree_pi/cache', max_entries=MAX_CACHE_ENTRIES):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.treeloader = TreeLoader()
+        self._stock_version = None
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def stock_db_version(self, db):
+        if self._stock_version is None:
+            stock = json.dumps(sorted(db.added_database), ensure_ascii=False).encode('utf-8')
+            self._stock_version = hashlib.sha256(stock).hexdigest()
+        return self._stock_version
+
+    @staticmethod
+    def stock_verdicts(tree):
+        """
+        Hash of the stock check results (substance_query_result.json) of the substances of
+        the reactions, checked now if they are not cached yet
+        """
+        substances = {tree.target_substance}
+        for reaction in tree.reactions.values():
+            substances.update(reaction['reactants'])
+            substances.update(reaction['products'])
+        substances = sorted(substances)
+        verdicts = list(zip(substances, tree.db.check_many(substances)))
+        return hashlib.sha256(json.dumps(verdicts, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+    def key(self, tree, **params):
+        inputs = {
+            "format_version": FORMAT_VERSION,
+            "target_substance": tree.target_substance,
+            "reactions": reactions_fingerprint(tree.reactions),
+            "stock_db": self.stock_db_version(tree.db),
+            "stock_verdicts": self.stock_verdicts(tree),
+            "prune_unsolvable": getattr(tree, 'prune_unsolvable', False),
+            "params": params,
+        }
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode('utf-8')).hexdigest()[:32]
+
+    def tree(self, tree, alias=None, **params):
+        """
+        Construct a tree whose reactions are set but not yet expanded, or load it from the cache.
+
+        Args:
+            tree: Tree built with its reactions, construct_tree not called yet
+            alias: material-named tree file pointed at the cache entry
+            params: stage parameters that change the result of construction
+
+        Returns:
+            The constructed tree
+        """
+        cache_path = os.path.join(self.cache_dir, self.key(tree, **params) + '.npz')
+        if os.path.exists(cache_path):
+            tree = self.treeloader.load_tree(cache_path)
+            # marks the entry as recently used
+            os.utime(cache_path)
+            print(f'Reusing cached tree {cache_path}, its inputs are unchanged.')
+        else:
+            tree.construct_tree()
+            self.treeloader.save_tree(tree, cache_path)
+            self.prune()
+        if alias:
+            self._link(cache_path, tree_path(alias))
+        return tree
+
+    def prune(self):
+        """
+        Remove the least recently used cache entries beyond max_entries; material-named
+        trees linked to them keep their own copy
+        """
+        entries = [os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir)
+                   if name.endswith('.npz')]
+        if len(entries) <= self.max_entries:
+            return
+        entries.sort(key=os.path.getmtime, reverse=True)
+        for path in entries[self.max_entries:]:
+            os.remove(path)
+        print(f'Removed {len(entries) - self.max_entries} least recently used trees from {self.cache_dir}.')
+
+    @staticmethod
+    def _link(cache_path, alias_path):
+        tmp_path = alias_path + '.tmp'
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        try:
+            os.link(cache_path, tmp_path)
+        except OSError:
+            shutil.copyfile(cache_path, tmp_path)
+        os.replace(tmp_path, alias_path)
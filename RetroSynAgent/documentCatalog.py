@@ -0,0 +1,151 @@
+"""
+SQLite catalog of the downloaded documents.
+
+Every PDF is identified by a hash of its content and associated with the targets it was
+retrieved for, so a run only extracts and builds trees from its own working set instead of
+every PDF in the shared folder. The database is opened in WAL mode, runs for different
+targets can use it concurrently.
+
+Tables:
+- documents          doc_hash, name (pdf file name without .pdf, the key of the extraction result),
+                     path, size, mtime, source (patent / paper), status (pending / extracted / skipped),
+                     result (extracted reactions text), updated_at
+- document_targets   (target, doc_hash) association, its primary key is the per-target index
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+CATALOG_FILE = "document_catalog.db"
+
+PENDING = "pending"
+EXTRACTED = "extracted"
+SKIPPED = "skipped"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    doc_hash   TEXT PRIMARY KEY,
+    name       TEXT NOT NULL,
+    path       TEXT NOT NULL,
+    size       INTEGER NOT NULL,
+    mtime      REAL NOT NULL,
+    source     TEXT,
+    status     TEXT NOT NULL DEFAULT 'pending',
+    result     TEXT,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS documents_path ON documents (path);
+CREATE TABLE IF NOT EXISTS document_targets (
+    target   TEXT NOT NULL,
+    doc_hash TEXT NOT NULL REFERENCES documents (doc_hash),
+    PRIMARY KEY (target, doc_hash)
+) WITHOUT ROWID;
+"""
+
+
+def file_hash(path, chunk_size=1 << 20):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def normalize_target(target):
+    return target.strip().lower()
+
+
+class DocumentCatalog:
+    def __init__(self, db_path=os.path.join('res_pi', CATALOG_FILE)):
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(_SCHEMA)
+        self.conn.commit()
+
+    def _hash_of(self, path):
+        """
+        Content hash of a file, reused from the catalog while its size and mtime are unchanged
+        """
+        stat = os.stat(path)
+        row = self.conn.execute("SELECT doc_hash FROM documents WHERE path = ? AND size = ? AND mtime = ?",
+                                (path, stat.st_size, stat.st_mtime)).fetchone()
+        if row:
+            return row[0], stat
+        return file_hash(path), stat
+
+    def register(self, pdf_paths, target, source=None):
+        """
+        Add documents retrieved for a target. A document already in the catalog, e.g. downloaded
+        for another target, is only associated with this target and keeps its extraction.
+
+        Args:
+            pdf_paths: paths of the PDFs
+            target: material the documents were retrieved for
+            source: 'patent' or 'paper'
+
+        Returns:
+            Content hashes of the documents
+        """
+        target = normalize_target(target)
+        hashes = []
+        with self.lock, self.conn:
+            for path in pdf_paths:
+                path = os.path.abspath(path)
+                if not os.path.exists(path):
+                    continue
+                doc_hash, stat = self._hash_of(path)
+                name = os.path.splitext(os.path.basename(path))[0]
+                self.conn.execute(
+                    "INSERT INTO documents (doc_hash, name, path, size, mtime, source, status, updated_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT (doc_hash) DO UPDATE SET path = excluded.path, size = excluded.size, "
+                    "mtime = excluded.mtime, source = COALESCE(documents.source, excluded.source)",
+                    (doc_hash, name, path, stat.st_size, stat.st_mtime, source, PENDING, time.time()))
+                self.conn.execute("INSERT OR IGNORE INTO document_targets (target, doc_hash) VALUES (?, ?)",
+                                  (target, doc_hash))
+                hashes.append(doc_hash)
+        return hashes
+
+    def working_set(self, target, status=None):
+        """
+        Documents of a target as (doc_hash, name, path, status) rows
+        """
+        query = ("SELECT d.doc_hash, d.name, d.path, d.status FROM document_targets t "
+                 "JOIN documents d ON d.doc_hash = t.doc_hash WHERE t.target = ?")
+        params = [normalize_target(target)]
+        if status is not None:
+            query += " AND d.status = ?"
+            params.append(status)
+        with self.lock:
+            return self.conn.execute(query + " ORDER BY d.name", params).fetchall()
+
+    def pending(self, target):
+        return self.working_set(target, PENDING)
+
+    def mark(self, doc_hash, status, result=None):
+        with self.lock, self.conn:
+            self.conn.execute("UPDATE documents SET status = ?, result = ?, updated_at = ? WHERE doc_hash = ?",
+                              (status, result, time.time(), doc_hash))
+
+    def results(self, target):
+        """
+        {pdf name: extracted reactions} of a target's documents, the input of its trees
+        """
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT d.name, d.result FROM document_targets t JOIN documents d ON d.doc_hash = t.doc_hash "
+                "WHERE t.target = ? AND d.status = ? ORDER BY d.name",
+                (normalize_target(target), EXTRACTED)).fetchall()
+        return dict(rows)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -5,18 +5,28 @@ import os
 from tqdm import tqdm
 import re
 import time
+from .name_to_smiles import NameToSMILES, get_smiles_cache
 
 class EntityAlignment:
     # ensure substance name consistency in different literatures
-    def alignRootNode(self, result_folder_name, result_json_name, material):
+    def alignRootNode(self, result_folder_name, result_json_name, material, results_dict=None):
+        """
+        Args:
+            results_dict: {pdf name: reactions} to align, e.g. a run's working set from the
+                document catalog; by default every result in the results json
+
+        Returns:
+            The aligned reactions of every document in results_dict
+        """
         # modified_results_filepath = result_folder_name + '/' + result_json_name + '_modified.json'
         # original_results_filepath = result_folder_name + '/' + result_json_name + '.json'
         modified_results_filepath = os.path.join(result_folder_name, result_json_name + '_modified.json')
         original_results_filepath = os.path.join(result_folder_name, result_json_name + '.json')
 
-        with open(original_results_filepath, 'r') as file:
-            results_dict = json.load(file)
-            # print('Original results data loaded.')
+        if results_dict is None:
+            with open(original_results_filepath, 'r') as file:
+                results_dict = json.load(file)
+                # print('Original results data loaded.')
         if not os.path.exists(modified_results_filepath):
             print('Starting entity alignment to ensure consistency in substance names...')
             results_dict_modified = results_dict.copy()
@@ -30,8 +40,8 @@ class EntityAlignment:
             with open(modified_results_filepath, 'r') as file:
                 results_dict_modified = json.load(file)
                 print('Modified results data successfully loaded.')
-                if len(results_dict_modified) == len(results_dict):
-                    return results_dict_modified
+                if all(key in results_dict_modified for key in results_dict):
+                    return {key: results_dict_modified[key] for key in results_dict}
                 else:
                     print('Starting entity alignment to ensure consistency in substance names...')
                     for key, reactions_txt in tqdm(results_dict.items()):
@@ -47,7 +57,7 @@ class EntityAlignment:
         print('Substance name modifications completed. Modified data saved.')
 
 
-        return results_dict_modified
+        return {key: results_dict_modified[key] for key in results_dict}
 
     def getNamingStdMap_2(self, reactions_dict):
         # th
@@ -108,9 +118,15 @@ class EntityAlignment:
         return naming_std_map_2
 
 
-    def getNamingStdMap_1(self):
-        with open('smiles_cache.json', 'r') as file:
-            data = json.load(file)
+    def getNamingStdMap_1(self, reactions_dict=None):
+        if reactions_dict:
+            # resolve the names of this run in bulk before grouping synonyms
+            names = set()
+            for entry in reactions_dict.values():
+                names.update(entry['reactants'])
+                names.update(entry['products'])
+            NameToSMILES.convert_many(names, isomeric=False, cache_unknown=True)
+        data = get_smiles_cache()
         name2smiles = {}
         for key, value in data.items():
             if key != value:
@@ -155,7 +171,7 @@ class EntityAlignment:
             print(f'successfully loaded{filename}')
         else:
             print(f'fail to load {filename}')
-            naming_std_map = self.getNamingStdMap_1()
+            naming_std_map = self.getNamingStdMap_1(reactions_dict)
             with open('synonym_hashmap_1.json', 'w') as file:
                 json.dump(naming_std_map, file, indent=4, ensure_ascii=False)
 
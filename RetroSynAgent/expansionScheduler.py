@@ -0,0 +1,104 @@
+import threading
+
+# Rough characters per token of extracted pdf text, used to charge the token budget before the LLM call
+CHARS_PER_TOKEN = 4
+
+
+class ExpansionBudget:
+    """
+    Documents and LLM input tokens one expansion iteration may spend; None means unlimited.
+    Shared by the extraction workers.
+    """
+    def __init__(self, max_documents=None, max_tokens=None):
+        self.max_documents = max_documents
+        self.max_tokens = max_tokens
+        self.documents = 0
+        self.tokens = 0
+        self.lock = threading.Lock()
+
+    def take_document(self) -> bool:
+        """
+        Charge one document before its text is extracted; False if the document count or the
+        tokens of the budget are spent.
+        """
+        with self.lock:
+            if self.max_documents is not None and self.documents >= self.max_documents:
+                return False
+            if self.max_tokens is not None and self.tokens >= self.max_tokens:
+                return False
+            self.documents += 1
+            return True
+
+    def take_tokens(self, text) -> bool:
+        """
+        Charge the tokens of the extracted text of a taken document; False, and the document
+        given back, if they do not fit in the budget. A document larger than the whole budget
+        is taken when it is the first one, so it is not deferred forever.
+        """
+        tokens = len(text) // CHARS_PER_TOKEN
+        with self.lock:
+            if self.max_tokens is not None and self.tokens and self.tokens + tokens > self.max_tokens:
+                self.documents -= 1
+                return False
+            self.tokens += tokens
+            return True
+
+
+class ExpansionScheduler:
+    """
+    Best-first choice of the unexpandable substances to search literature for.
+
+    Substances are scored from Tree.get_frontier():
+    - unblocks: routes on which the substance is the only missing reactant of its reaction,
+      finding a synthesis for it completes that reaction
+    - occurrences: nodes of the tree with the substance
+    - depth: reactions between the root and the shallowest node, deep substances are cheaper to lose
+    - attempts: earlier iterations that already searched for the substance without success
+    Each iteration searches the top_k substances within the per-iteration budget. Documents
+    skipped for the budget are kept in deferred and extracted first in the next iteration.
+    """
+    def __init__(self, top_k=5, max_attempts=2, max_documents=None, max_tokens=None,
+                 unblock_weight=2.0, occurrence_weight=0.5, depth_weight=1.0, attempt_weight=3.0):
+        self.top_k = top_k
+        self.max_attempts = max_attempts
+        self.max_documents = max_documents
+        self.max_tokens = max_tokens
+        self.unblock_weight = unblock_weight
+        self.occurrence_weight = occurrence_weight
+        self.depth_weight = depth_weight
+        self.attempt_weight = attempt_weight
+        self.attempts = {}
+        # (substance, pdf_folder_path, pdf_name) of documents skipped for the budget
+        self.deferred = []
+
+    def score(self, substance, stats):
+        return (self.unblock_weight * stats['unblocks']
+                + self.occurrence_weight * stats['occurrences']
+                - self.depth_weight * stats['depth']
+                - self.attempt_weight * self.attempts.get(substance, 0))
+
+    def select(self, frontier):
+        """
+        Args:
+            frontier: {substance: {'depth': int, 'occurrences': int, 'unblocks': int}}
+
+        Returns:
+            Substances to search this iteration, best first
+        """
+        candidates = [substance for substance in frontier
+                      if self.max_attempts is None or self.attempts.get(substance, 0) < self.max_attempts]
+        candidates.sort(key=lambda substance: (-self.score(substance, frontier[substance]), substance))
+        return candidates if self.top_k is None else candidates[:self.top_k]
+
+    def record_attempts(self, searched, unexpandable):
+        """
+        Count an unsuccessful attempt for the searched substances that are still unexpandable,
+        unless some of their documents are deferred and the search is not finished.
+        """
+        pending = {substance for substance, _, _ in self.deferred}
+        for substance in searched:
+            if substance in unexpandable and substance not in pending:
+                self.attempts[substance] = self.attempts.get(substance, 0) + 1
+
+    def new_budget(self):
+        return ExpansionBudget(self.max_documents, self.max_tokens)
@@ -0,0 +1,61 @@
+"""
+Locks and atomic writes for the files every pipeline run shares, whatever its material
+(smiles_cache.json, substance_query_result.json, the expansion results), so several worker
+processes of the API can update them.
+"""
+import contextlib
+import os
+import tempfile
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    # no inter-process lock without fcntl (Windows), only threads of one process are serialised
+    fcntl = None
+
+_thread_locks = {}
+_thread_locks_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    """
+    Exclusive lock of a file between threads and processes, held on path + '.lock'
+    """
+    lock_path = os.path.abspath(path) + '.lock'
+    with _thread_locks_lock:
+        thread_lock = _thread_locks.setdefault(lock_path, threading.Lock())
+    with thread_lock:
+        directory = os.path.dirname(lock_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(lock_path, 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+def write_atomic(path, write, mode='w', encoding='utf-8'):
+    """
+    Write a file through a temporary file of its own in the same directory, then replace it
+
+    Args:
+        write: callable taking the open temporary file
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile(mode, encoding=encoding, dir=directory, prefix=os.path.basename(path) + '.',
+                                     suffix='.tmp', delete=False) as f:
+        try:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        except BaseException:
+            f.close()
+            os.remove(f.name)
+            raise
+    os.replace(f.name, path)
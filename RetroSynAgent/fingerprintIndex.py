@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""
+Morgan fingerprint index over the PatCID molecules, used by PatentPDFDownloader
+to find patents of the most similar molecules when the exact SMILES lookup misses.
+
+An index is a directory holding:
+- meta.json          fingerprint parameters and row count
+- fingerprints.bin   uint64[n, fp_size / 64] packed bit vectors, sorted by popcount
+- popcounts.bin      uint16[n] number of set bits of each row (ascending)
+- smiles.bin         utf-8 SMILES of each row, delimited by smiles_offsets.bin (uint64[n + 1])
+
+Rows are sorted by popcount so a query only scans the rows that can reach the
+similarity threshold (Tanimoto <= min(a, b) / max(a, b)).
+"""
+import json
+import mmap
+import os
+from typing import Dict, Iterable, List, Tuple
+
+import numpy as np
+from rdkit import Chem
+from rdkit.Chem import rdFingerprintGenerator
+
+DEFAULT_RADIUS = 2
+DEFAULT_FP_SIZE = 2048
+SEARCH_CHUNK_ROWS = 1 << 20
+
+_open_indexes: Dict[str, 'FingerprintIndex'] = {}
+
+
+if hasattr(np, 'bitwise_count'):
+    def _popcount_rows(words):
+        return np.bitwise_count(words).sum(axis=-1, dtype=np.int64)
+else:
+    _BYTE_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+    def _popcount_rows(words):
+        return _BYTE_POPCOUNT[words.view(np.uint8)].sum(axis=-1, dtype=np.int64)
+
+
+class MorganFingerprinter:
+    def __init__(self, radius=DEFAULT_RADIUS, fp_size=DEFAULT_FP_SIZE):
+        if fp_size % 64:
+            raise ValueError("fp_size must be a multiple of 64")
+        self.radius = radius
+        self.fp_size = fp_size
+        self.generator = rdFingerprintGenerator.GetMorganGenerator(radius=radius, fpSize=fp_size)
+
+    def packed(self, smile):
+        """
+        Packed uint64 fingerprint of a SMILES string, or None if RDKit cannot parse it
+        """
+        mol = Chem.MolFromSmiles(smile)
+        if mol is None:
+            return None
+        bits = self.generator.GetFingerprintAsNumPy(mol).astype(np.uint8)
+        return np.packbits(bits, bitorder='little').view(np.uint64)
+
+
+class FingerprintIndexBuilder:
+    """
+    Streams fingerprints to disk while the PatCID records are imported, then sorts them by popcount.
+    """
+    def __init__(self, index_dir, radius=DEFAULT_RADIUS, fp_size=DEFAULT_FP_SIZE):
+        self.index_dir = index_dir
+        self.fingerprinter = MorganFingerprinter(radius, fp_size)
+        os.makedirs(index_dir, exist_ok=True)
+        self._fps = open(os.path.join(index_dir, 'fingerprints.unsorted'), 'wb')
+        self._smiles = open(os.path.join(index_dir, 'smiles.unsorted'), 'wb')
+        self._popcounts = []
+        self._smiles_lengths = []
+
+    def add(self, smile):
+        fp = self.fingerprinter.packed(smile)
+        if fp is None:
+            return
+        encoded = smile.encode('utf-8')
+        self._fps.write(fp.tobytes())
+        self._smiles.write(encoded)
+        self._popcounts.append(int(_popcount_rows(fp)))
+        self._smiles_lengths.append(len(encoded))
+
+    def observe(self, records: Iterable[Tuple[str, List[str]]]):
+        """
+        Pass (smile, patents) records through unchanged while fingerprinting them
+        """
+        for record in records:
+            self.add(record[0])
+            yield record
+
+    def finish(self):
+        self._fps.close()
+        self._smiles.close()
+        n = len(self._popcounts)
+        words = self.fingerprinter.fp_size // 64
+        popcounts = np.asarray(self._popcounts, dtype=np.uint16)
+        order = np.argsort(popcounts, kind='stable')
+
+        unsorted_fps_path = os.path.join(self.index_dir, 'fingerprints.unsorted')
+        unsorted_smiles_path = os.path.join(self.index_dir, 'smiles.unsorted')
+        unsorted_fps = np.memmap(unsorted_fps_path, dtype=np.uint64, mode='r', shape=(n, words)) if n else None
+        with open(os.path.join(self.index_dir, 'fingerprints.bin'), 'wb') as f:
+            for start in range(0, n, SEARCH_CHUNK_ROWS):
+                f.write(np.ascontiguousarray(unsorted_fps[order[start:start + SEARCH_CHUNK_ROWS]]).tobytes())
+        popcounts[order].tofile(os.path.join(self.index_dir, 'popcounts.bin'))
+
+        lengths = np.asarray(self._smiles_lengths, dtype=np.uint64)
+        starts = np.zeros(n + 1, dtype=np.uint64)
+        np.cumsum(lengths, out=starts[1:])
+        sorted_offsets = np.zeros(n + 1, dtype=np.uint64)
+        np.cumsum(lengths[order], out=sorted_offsets[1:])
+        with open(unsorted_smiles_path, 'rb') as src, open(os.path.join(self.index_dir, 'smiles.bin'), 'wb') as dst:
+            if starts[-1]:
+                with mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ) as src_view:
+                    for i in order:
+                        dst.write(src_view[starts[i]:starts[i + 1]])
+        sorted_offsets.tofile(os.path.join(self.index_dir, 'smiles_offsets.bin'))
+
+        del unsorted_fps
+        os.remove(unsorted_fps_path)
+        os.remove(unsorted_smiles_path)
+        with open(os.path.join(self.index_dir, 'meta.json'), 'w') as f:
+            json.dump({"radius": self.fingerprinter.radius, "fp_size": self.fingerprinter.fp_size,
+                       "num_molecules": n}, f, indent=4)
+        return n
+
+
+class FingerprintIndex:
+    """
+    Read-only, memory-mapped fingerprint index with popcount-bounded Tanimoto search.
+    """
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        with open(os.path.join(index_dir, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        self.num_molecules = meta["num_molecules"]
+        self.fingerprinter = MorganFingerprinter(meta["radius"], meta["fp_size"])
+        words = meta["fp_size"] // 64
+        if self.num_molecules:
+            self.fingerprints = np.memmap(os.path.join(index_dir, 'fingerprints.bin'), dtype=np.uint64, mode='r',
+                                          shape=(self.num_molecules, words))
+            self.popcounts = np.memmap(os.path.join(index_dir, 'popcounts.bin'), dtype=np.uint16, mode='r')
+            self.smiles_blob = np.memmap(os.path.join(index_dir, 'smiles.bin'), dtype=np.uint8, mode='r')
+        else:
+            self.fingerprints = np.zeros((0, words), dtype=np.uint64)
+            self.popcounts = np.zeros(0, dtype=np.uint16)
+            self.smiles_blob = np.zeros(0, dtype=np.uint8)
+        self.smiles_offsets = np.fromfile(os.path.join(index_dir, 'smiles_offsets.bin'), dtype=np.uint64)
+
+    def smiles_at(self, row):
+        return self.smiles_blob[self.smiles_offsets[row]:self.smiles_offsets[row + 1]].tobytes().decode('utf-8')
+
+    def search(self, smile, top_k=5, threshold=0.7) -> List[Tuple[str, float]]:
+        """
+        Most similar indexed molecules to a SMILES string.
+
+        Returns:
+            List of (smiles, tanimoto) with tanimoto >= threshold, best first
+        """
+        query = self.fingerprinter.packed(smile)
+        if query is None or self.num_molecules == 0:
+            return []
+        query_count = int(_popcount_rows(query))
+        if query_count == 0:
+            return []
+        threshold = max(threshold, 1e-6)
+        # Only rows with threshold * b <= a <= b / threshold can reach the threshold
+        lo = int(np.searchsorted(self.popcounts, int(np.ceil(query_count * threshold)), side='left'))
+        hi = int(np.searchsorted(self.popcounts, min(65535, int(np.floor(query_count / threshold))), side='right'))
+
+        best_rows = np.zeros(0, dtype=np.int64)
+        best_scores = np.zeros(0, dtype=np.float64)
+        for start in range(lo, hi, SEARCH_CHUNK_ROWS):
+            end = min(hi, start + SEARCH_CHUNK_ROWS)
+            common = _popcount_rows(self.fingerprints[start:end] & query)
+            union = self.popcounts[start:end].astype(np.int64) + query_count - common
+            scores = common / union
+            keep = np.nonzero(scores >= threshold)[0]
+            if len(keep) > top_k:
+                keep = keep[np.argpartition(-scores[keep], top_k - 1)[:top_k]]
+            best_rows = np.concatenate([best_rows, keep + start])
+            best_scores = np.concatenate([best_scores, scores[keep]])
+            if len(best_rows) > top_k:
+                top = np.argpartition(-best_scores, top_k - 1)[:top_k]
+                best_rows, best_scores = best_rows[top], best_scores[top]
+
+        ranked = np.argsort(-best_scores, kind='stable')
+        return [(self.smiles_at(int(best_rows[i])), float(best_scores[i])) for i in ranked]
+
+
+def open_fingerprint_index(index_dir) -> FingerprintIndex:
+    """
+    Open a fingerprint index once per process and reuse the mapping for later searches
+    """
+    index = _open_indexes.get(index_dir)
+    if index is None:
+        index = _open_indexes[index_dir] = FingerprintIndex(index_dir)
+    return index
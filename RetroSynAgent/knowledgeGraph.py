@@ -2,6 +2,7 @@ import json
 import networkx as nx
 from pyvis.network import Network
 import warnings
+from .reactionNetwork import ReactionNetwork
 warnings.filterwarnings('ignore')
 
 class KnowledgeGraph:
@@ -22,20 +23,14 @@ class KnowledgeGraph:
                 self.G.add_edge(substance, prop_value, label=prop_name)  # Add property edge
 
         # Process the reactions part
-        for idx, reaction in self.reactions.items():
-            reactants = reaction["reactants"]
-            products = reaction["products"]
-            # conditions = reaction["conditions"]
-
-            self.chemical_substances.update(reactants)
-            self.chemical_substances.update(products)
-
-            for reactant in reactants:
-                for product in products:
-                    self.G.add_node(reactant)  # Add reactant node
-                    self.G.add_node(product)  # Add product node
-                    self.G.add_edge(reactant, product, label=f"reaction idx: {idx}")  # Add reaction edge
-                    # label: conditions -> idx
+        # reactant -> product edges come from the network's integer arrays, names are only looked up for the graph
+        network = self.reactions if isinstance(self.reactions, ReactionNetwork) else ReactionNetwork(self.reactions)
+        names = network.substance_names
+        self.chemical_substances.update(names)
+        sources, targets, reaction_ids = network.edges()
+        self.G.add_edges_from(
+            (names[source], names[target], {"label": f"reaction idx: {network.reaction_keys[reaction_id]}"})
+            for source, target, reaction_id in zip(sources.tolist(), targets.tolist(), reaction_ids.tolist()))
 
     def export_to_json(self, file_path):
         # Create nodes with unique ids
@@ -0,0 +1,57 @@
+"""
+Map-reduce helpers for LLM stages whose input outgrows one prompt: the input is cut into
+token-budgeted chunks, the chunks are sent concurrently and the answers are merged.
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+from .expansionScheduler import CHARS_PER_TOKEN
+from .GPTAPI import GPTAPI
+
+# concurrent LLM calls of one map step
+MAP_WORKERS = 4
+
+
+def shard_entries(entries, max_tokens):
+    """
+    Group text entries in order into chunks of at most max_tokens estimated tokens; an entry
+    larger than the budget gets a chunk of its own.
+
+    Returns:
+        list of lists of entries
+    """
+    chunks = []
+    size = 0
+    for entry in entries:
+        tokens = len(entry) // CHARS_PER_TOKEN
+        if not chunks or size + tokens > max_tokens:
+            chunks.append([])
+            size = 0
+        chunks[-1].append(entry)
+        size += tokens
+    return chunks
+
+
+def map_prompts(prompt_list, temperature=0.0, max_workers=MAP_WORKERS):
+    """
+    Answers of the prompts, in order, with up to max_workers calls at a time
+    """
+    if len(prompt_list) == 1:
+        return [GPTAPI(temperature=temperature).answer_wo_vision(prompt_list[0])]
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(prompt_list)))) as executor:
+        return list(executor.map(lambda prompt: GPTAPI(temperature=temperature).answer_wo_vision(prompt),
+                                 prompt_list))
+
+
+def merge_responses(responses, header):
+    """
+    One answer from the answers of the chunks: the parts before the header (exclusions and
+    reasons) of every chunk, then the header once followed by the parts after it
+    """
+    before = []
+    after = []
+    for response in responses:
+        head, found, tail = response.partition(header)
+        before.append(head.strip())
+        if found:
+            after.append(tail.strip())
+    return '\n\n'.join(before) + f'\n\n{header}\n' + '\n'.join(after) + '\n'
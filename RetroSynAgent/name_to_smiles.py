@@ -1,26 +1,140 @@
 #!/usr/bin/env python3
 """
 Module to convert chemical names to SMILES strings using CAS Common Chemistry API
-with a fallback to PubChem.
+and PubChem, queried concurrently over a shared HTTP session.
 """
+import json
+import os
 import re
+import threading
+import time
 import urllib.parse
 import requests
-from typing import Tuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from typing import Dict, Iterable, Set, Tuple
+
+from .fileLock import file_lock, write_atomic
+
+try:
+    from rdkit import Chem, RDLogger
+    RDLogger.DisableLog('rdApp.*')
+except ImportError:
+    Chem = None
+
+# (connect, read) timeout in seconds for every lookup request
+REQUEST_TIMEOUT = (5, 15)
+# canonical SMILES, shared with CommonSubstanceDB; isomeric SMILES are kept in their own file
+SMILES_CACHE_FILE = "smiles_cache.json"
+ISOMERIC_SMILES_CACHE_FILE = "smiles_cache_isomeric.json"
+# Overridable so bulk resolution can be pointed at a local stub server
+PUBCHEM_BASE_URL = os.getenv("PUBCHEM_BASE_URL", "https://pubchem.ncbi.nlm.nih.gov/rest/pug")
+# PubChem allows at most 5 requests per second per client
+PUBCHEM_MAX_REQUESTS_PER_SECOND = 5
+PUBCHEM_CID_BATCH_SIZE = 100
+
+
+def _build_session():
+    session = requests.Session()
+    retry = Retry(total=2, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504))
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retry)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+class _RateLimiter:
+    def __init__(self, max_per_second):
+        self.interval = 1.0 / max_per_second
+        self.next_time = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+_session = _build_session()
+_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="name_to_smiles")
+_pubchem_rate_limiter = _RateLimiter(PUBCHEM_MAX_REQUESTS_PER_SECOND)
+
+
+class SmilesCache(dict):
+    """
+    Persistent name -> SMILES cache backed by a json file, smiles_cache.json for canonical
+    SMILES. A single instance per file is shared by NameToSMILES and CommonSubstanceDB.
+    """
+    def __init__(self, filename):
+        super().__init__()
+        self.filename = filename
+        self._lock = threading.Lock()
+        if os.path.exists(filename):
+            with open(filename, 'r', encoding='utf-8') as f:
+                self.update(json.load(f))
+
+    def save(self):
+        """
+        Merge the entries other processes saved meanwhile and write the file
+        """
+        with self._lock, file_lock(self.filename):
+            if os.path.exists(self.filename):
+                with open(self.filename, 'r', encoding='utf-8') as f:
+                    try:
+                        saved = json.load(f)
+                    except json.JSONDecodeError:
+                        saved = {}
+                for name, smiles in saved.items():
+                    self.setdefault(name, smiles)
+            write_atomic(self.filename, lambda f: json.dump(dict(self), f, ensure_ascii=False, indent=4))
+
+
+_smiles_caches = {}
+_smiles_caches_lock = threading.Lock()
+
+
+def get_smiles_cache(filename=SMILES_CACHE_FILE):
+    with _smiles_caches_lock:
+        cache = _smiles_caches.get(filename)
+        if cache is None:
+            cache = _smiles_caches[filename] = SmilesCache(filename)
+        return cache
+
+
+def canonical_smiles(smiles):
+    """
+    One canonical form of a SMILES string for the shared cache: RDKit canonical SMILES without
+    stereochemistry when RDKit is installed, the SMILES unchanged otherwise (or if it does not parse)
+    """
+    if Chem is None or not smiles:
+        return smiles
+    molecule = Chem.MolFromSmiles(smiles)
+    if molecule is None:
+        return smiles
+    return Chem.MolToSmiles(molecule, isomericSmiles=False)
+
+
+def _cache_for(isomeric):
+    return get_smiles_cache(ISOMERIC_SMILES_CACHE_FILE if isomeric else SMILES_CACHE_FILE)
 
 class NameToSMILES:
     """
     Convert a compound, molecule, or reaction name to its SMILES representation
-    using the CAS Common Chemistry API with a fallback to PubChem.
+    using the CAS Common Chemistry API and PubChem, taking the first answer.
     """
 
     @staticmethod
-    def convert(query: str) -> Tuple[bool, str]:
+    def convert(query: str, isomeric: bool = True) -> Tuple[bool, str]:
         """
         Convert a chemical name to SMILES string.
 
         Args:
             query: Chemical name to convert
+            isomeric: Return isomeric SMILES, otherwise canonical SMILES (the form of the shared cache)
 
         Returns:
             Tuple of (success, result)
@@ -31,19 +145,28 @@ class NameToSMILES:
             if re.search(r"[=#@\\/[\]]", query) or len(query) > 100:
                 return False, f"Error: This looks like a SMILES string, not a name."
 
-            # First try CAS Common Chemistry
-            success, cas_result = NameToSMILES._try_cas_common_chemistry(query)
-
-            # If CAS has SMILES, return it
-            if success:
-                print(f"Found SMILES for '{query}' from CAS Common Chemistry: {cas_result}")
-                return True, cas_result
-
-            # Otherwise try PubChem as fallback
-            success, pubchem_result = NameToSMILES._try_pubchem(query)
-            if success:
-                print(f"Found SMILES for '{query}' from PubChem: {pubchem_result}")
-                return True, pubchem_result
+            # CommonSubstanceDB caches a name as its own SMILES when PubChem has no answer
+            cache = _cache_for(isomeric)
+            cached = cache.get(query)
+            if cached and cached != query:
+                return True, cached
+
+            # Query CAS Common Chemistry and PubChem concurrently and take the first success
+            futures = {
+                _executor.submit(NameToSMILES._try_cas_common_chemistry, query, isomeric): "CAS Common Chemistry",
+                _executor.submit(NameToSMILES._try_pubchem, query, isomeric): "PubChem",
+            }
+            for future in as_completed(futures):
+                success, result = future.result()
+                if success and not isomeric:
+                    result = canonical_smiles(result)
+                if success:
+                    print(f"Found SMILES for '{query}' from {futures[future]}: {result}")
+                    for other in futures:
+                        other.cancel()
+                    cache[query] = result
+                    cache.save()
+                    return True, result
 
             # If both fail, return error message
             return False, f"No SMILES found for '{query}'"
@@ -52,7 +175,117 @@ class NameToSMILES:
             return False, f"Exception occurred: {str(e)}"
 
     @staticmethod
-    def _try_cas_common_chemistry(query: str) -> Tuple[bool, str]:
+    def convert_many(names: Iterable[str], isomeric: bool = True,
+                     cache_unknown: bool = False) -> Tuple[Dict[str, str], Set[str]]:
+        """
+        Resolve many chemical names with PubChem in as few requests as possible.
+
+        PUG-REST accepts a single name per name->CID request, so those lookups are
+        pipelined over the shared session under PubChem's rate limit; the CID->SMILES
+        step is batched with POST requests of up to PUBCHEM_CID_BATCH_SIZE CIDs.
+        Results are written to the SMILES cache of their form, canonical SMILES to the shared one.
+
+        Args:
+            names: Chemical names to convert (cached names are not queried again)
+            isomeric: IsomericSMILES, otherwise CanonicalSMILES
+            cache_unknown: Cache names unknown to PubChem as their own SMILES,
+                           the convention used by CommonSubstanceDB
+
+        Returns:
+            Tuple of (name -> SMILES for resolved names, names unknown to PubChem)
+        """
+        cache = _cache_for(isomeric)
+        resolved = {}
+        pending = []
+        for name in dict.fromkeys(names):
+            cached = cache.get(name)
+            if cached and cached != name:
+                resolved[name] = cached
+            elif cached is None or not cache_unknown:
+                pending.append(name)
+        if not pending:
+            return resolved, set()
+
+        # 1. name -> CID
+        name_to_cid = {}
+        unknown = set()
+        futures = {_executor.submit(NameToSMILES._pubchem_name_to_cid, name): name for name in pending}
+        for future in as_completed(futures):
+            name = futures[future]
+            found, cid = future.result()
+            if cid is not None:
+                name_to_cid[name] = cid
+            elif found is False:
+                unknown.add(name)
+
+        # 2. CID -> SMILES, in batches
+        cids = list(dict.fromkeys(name_to_cid.values()))
+        cid_to_smiles = {}
+        for start in range(0, len(cids), PUBCHEM_CID_BATCH_SIZE):
+            cid_to_smiles.update(NameToSMILES._pubchem_cids_to_smiles(cids[start:start + PUBCHEM_CID_BATCH_SIZE],
+                                                                      isomeric))
+
+        for name, cid in name_to_cid.items():
+            smiles = cid_to_smiles.get(cid)
+            if smiles and not isomeric:
+                smiles = canonical_smiles(smiles)
+            if smiles:
+                resolved[name] = smiles
+                cache[name] = smiles
+            else:
+                unknown.add(name)
+        if cache_unknown:
+            for name in unknown:
+                cache[name] = name
+        cache.save()
+        print(f"Resolved {len(resolved)} of {len(resolved) + len(unknown)} names with PubChem "
+              f"({len(pending)} name lookups, {(len(cids) + PUBCHEM_CID_BATCH_SIZE - 1) // PUBCHEM_CID_BATCH_SIZE} "
+              f"batched property requests)")
+        return resolved, unknown
+
+    @staticmethod
+    def _pubchem_name_to_cid(name: str):
+        """
+        Returns:
+            Tuple of (found, cid): found is False when PubChem does not know the name
+            and None when the request failed
+        """
+        try:
+            _pubchem_rate_limiter.wait()
+            response = _session.post(f"{PUBCHEM_BASE_URL}/compound/name/cids/JSON", data={"name": name},
+                                     timeout=REQUEST_TIMEOUT)
+            if response.status_code == 404:
+                return False, None
+            response.raise_for_status()
+            cids = response.json().get("IdentifierList", {}).get("CID", [])
+            return (True, cids[0]) if cids else (False, None)
+        except Exception as e:
+            print(f"PubChem error for '{name}': {str(e)}")
+            return None, None
+
+    @staticmethod
+    def _pubchem_cids_to_smiles(cids, isomeric: bool) -> Dict[int, str]:
+        try:
+            _pubchem_rate_limiter.wait()
+            response = _session.post(f"{PUBCHEM_BASE_URL}/compound/cid/property/IsomericSMILES,CanonicalSMILES/JSON",
+                                     data={"cid": ",".join(map(str, cids))}, timeout=REQUEST_TIMEOUT)
+            response.raise_for_status()
+            properties = response.json().get("PropertyTable", {}).get("Properties", [])
+        except Exception as e:
+            print(f"PubChem error for {len(cids)} CIDs: {str(e)}")
+            return {}
+        cid_to_smiles = {}
+        for entry in properties:
+            if isomeric:
+                smiles = entry.get("IsomericSMILES", entry.get("CanonicalSMILES"))
+            else:
+                smiles = entry.get("CanonicalSMILES", entry.get("IsomericSMILES"))
+            if smiles:
+                cid_to_smiles[entry["CID"]] = smiles
+        return cid_to_smiles
+
+    @staticmethod
+    def _try_cas_common_chemistry(query: str, isomeric: bool = True) -> Tuple[bool, str]:
         """
         Try to get SMILES from CAS Common Chemistry.
 
@@ -62,7 +295,7 @@ class NameToSMILES:
         try:
             # Step 1: Search by name
             search_url = f"https://commonchemistry.cas.org/api/search?q={query}"
-            search_resp = requests.get(search_url)
+            search_resp = _session.get(search_url, timeout=REQUEST_TIMEOUT)
             search_resp.raise_for_status()
 
             results = search_resp.json()
@@ -76,17 +309,16 @@ class NameToSMILES:
 
             # Step 2: Get SMILES from detail endpoint
             detail_url = f"https://commonchemistry.cas.org/api/detail?cas_rn={cas_rn}"
-            detail_resp = requests.get(detail_url)
+            detail_resp = _session.get(detail_url, timeout=REQUEST_TIMEOUT)
             detail_resp.raise_for_status()
 
             details = detail_resp.json()
 
             # Check for smile and canonicalSmile (singular, not plural)
-            smiles = None
-            if "smile" in details and details["smile"]:
-                smiles = details["smile"]
-            elif "canonicalSmile" in details and details["canonicalSmile"]:
-                smiles = details["canonicalSmile"]
+            if isomeric:
+                smiles = details.get("smile") or details.get("canonicalSmile")
+            else:
+                smiles = details.get("canonicalSmile") or details.get("smile")
 
             if smiles:
                 return True, smiles
@@ -97,7 +329,7 @@ class NameToSMILES:
             return False, f"CAS Common Chemistry error: {str(e)}"
 
     @staticmethod
-    def _try_pubchem(query: str) -> Tuple[bool, str]:
+    def _try_pubchem(query: str, isomeric: bool = True) -> Tuple[bool, str]:
         """
         Try to get SMILES from PubChem.
 
@@ -109,14 +341,14 @@ class NameToSMILES:
             encoded_query = urllib.parse.quote(query)
 
             # First try the simpler direct property endpoint
-            url = f"https://pubchem.ncbi.nlm.nih.gov/rest/pug/compound/name/{encoded_query}/property/IsomericSMILES,CanonicalSMILES/JSON"
-            response = requests.get(url)
+            url = f"{PUBCHEM_BASE_URL}/compound/name/{encoded_query}/property/IsomericSMILES,CanonicalSMILES/JSON"
+            response = _session.get(url, timeout=REQUEST_TIMEOUT)
 
             # If that fails, try the search -> property approach
             if response.status_code != 200:
                 # Search for the compound to get CID
-                search_url = f"https://pubchem.ncbi.nlm.nih.gov/rest/pug/compound/name/{encoded_query}/cids/JSON"
-                search_resp = requests.get(search_url)
+                search_url = f"{PUBCHEM_BASE_URL}/compound/name/{encoded_query}/cids/JSON"
+                search_resp = _session.get(search_url, timeout=REQUEST_TIMEOUT)
                 search_resp.raise_for_status()
 
                 search_data = search_resp.json()
@@ -127,8 +359,8 @@ class NameToSMILES:
                 cid = search_data["IdentifierList"]["CID"][0]
 
                 # Get compound properties including SMILES
-                prop_url = f"https://pubchem.ncbi.nlm.nih.gov/rest/pug/compound/cid/{cid}/property/IsomericSMILES,CanonicalSMILES/JSON"
-                response = requests.get(prop_url)
+                prop_url = f"{PUBCHEM_BASE_URL}/compound/cid/{cid}/property/IsomericSMILES,CanonicalSMILES/JSON"
+                response = _session.get(prop_url, timeout=REQUEST_TIMEOUT)
                 response.raise_for_status()
 
             prop_data = response.json()
@@ -138,8 +370,10 @@ class NameToSMILES:
 
             properties = prop_data["PropertyTable"]["Properties"][0]
 
-            # Prefer IsomericSMILES if available, otherwise use CanonicalSMILES
-            smiles = properties.get("IsomericSMILES", properties.get("CanonicalSMILES"))
+            if isomeric:
+                smiles = properties.get("IsomericSMILES", properties.get("CanonicalSMILES"))
+            else:
+                smiles = properties.get("CanonicalSMILES", properties.get("IsomericSMILES"))
 
             if smiles:
                 return True, smiles
@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+"""
+Storage layouts for the PatCID SMILES -> patent IDs index.
+
+Lookups can be served by Redis (setup_patent_redis.py) or, for single-node
+deployments, by an embedded memory-mapped index file (build_patent_index_file).
+
+The original layout written by setup_patent_redis.py stores one Redis string key
+per molecule ("smile:<SMILES>") holding a JSON list of patent IDs. The compact
+layout defined here stores the same mapping in a fraction of the memory:
+
+- molecules are addressed by a 64-bit hash of the stereo-stripped canonical SMILES
+  and bucketed into Redis hashes ("smh:<bucket>"), so each molecule costs one small
+  listpack entry instead of a full top-level key
+- patent IDs are interned into dense integers ("pid:<bucket>" hashes map them back)
+- the patent list of a molecule is stored as a varint blob of zigzag deltas, which
+  keeps the original ordering while using 1-3 bytes per patent
+
+Buckets only stay in the listpack encoding while every blob is shorter than
+hash-max-listpack-value (64 bytes by default); raise it (e.g. to 256) on the Redis
+server when importing molecules with long patent lists.
+"""
+import bisect
+import hashlib
+import json
+import math
+import mmap
+import os
+import struct
+import sys
+from array import array
+from contextlib import nullcontext
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# Meta keys describing which layout a Redis database holds
+LAYOUT_KEY = "patcid:layout"
+BUCKET_BITS_KEY = "patcid:bucket_bits"
+NEXT_PATENT_ID_KEY = "patcid:next_patent_id"
+
+LAYOUT_STRING = "string"
+LAYOUT_COMPACT = "compact"
+
+STRING_KEY_PREFIX = "smile:"
+SMILES_BUCKET_PREFIX = "smh:"
+PATENT_BUCKET_PREFIX = "pid:"
+
+# Target number of molecules per Redis hash. Redis keeps hashes with up to
+# hash-max-listpack-entries (128 by default) fields in the compact listpack encoding.
+TARGET_BUCKET_SIZE = 64
+DEFAULT_BUCKET_BITS = 20
+PATENT_BUCKET_BITS = 7
+
+
+def smiles_hash(smile: str) -> int:
+    """
+    Stable 64-bit hash of a (cleaned) SMILES string
+    """
+    digest = hashlib.blake2b(smile.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big')
+
+
+def bucket_bits_for(num_molecules: int) -> int:
+    """
+    Number of hash bits used for bucketing so that buckets hold about TARGET_BUCKET_SIZE molecules
+    """
+    if num_molecules <= TARGET_BUCKET_SIZE:
+        return 1
+    return min(32, max(1, math.ceil(math.log2(num_molecules / TARGET_BUCKET_SIZE))))
+
+
+def encode_varints(values: Iterable[int]) -> bytes:
+    """
+    Encode integers as LEB128 varints of zigzag deltas (order preserving)
+    """
+    out = bytearray()
+    prev = 0
+    for value in values:
+        delta = value - prev
+        prev = value
+        zigzag = (delta << 1) if delta >= 0 else ((-delta << 1) - 1)
+        while zigzag >= 0x80:
+            out.append((zigzag & 0x7F) | 0x80)
+            zigzag >>= 7
+        out.append(zigzag)
+    return bytes(out)
+
+
+def decode_varints(blob: bytes) -> List[int]:
+    """
+    Inverse of encode_varints
+    """
+    values = []
+    prev = 0
+    shift = 0
+    zigzag = 0
+    for byte in blob:
+        zigzag |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        delta = (zigzag >> 1) if not zigzag & 1 else -((zigzag + 1) >> 1)
+        prev += delta
+        values.append(prev)
+        shift = 0
+        zigzag = 0
+    return values
+
+
+def compact_smiles_location(smile: str, bucket_bits: int) -> Tuple[str, bytes]:
+    """
+    Redis hash key and field holding the patent blob of a cleaned SMILES string
+    """
+    h = smiles_hash(smile)
+    bucket = h >> (64 - bucket_bits)
+    return f"{SMILES_BUCKET_PREFIX}{bucket}", h.to_bytes(8, 'big')
+
+
+def patent_id_location(patent_int: int) -> Tuple[str, str]:
+    """
+    Redis hash key and field holding the string form of an interned patent ID
+    """
+    return f"{PATENT_BUCKET_PREFIX}{patent_int >> PATENT_BUCKET_BITS}", str(patent_int)
+
+
+def get_layout(redis_client) -> str:
+    layout = redis_client.get(LAYOUT_KEY)
+    if layout is None:
+        return LAYOUT_STRING
+    return layout.decode('utf-8') if isinstance(layout, bytes) else layout
+
+
+def get_patent_ids_string_layout(redis_client, smile: str) -> List[str]:
+    data = redis_client.get(f"{STRING_KEY_PREFIX}{smile}")
+    if not data:
+        return []
+    ids = json.loads(data.decode('utf-8') if isinstance(data, bytes) else data)
+    return ids if isinstance(ids, list) else []
+
+
+def get_patent_ids_compact_layout(redis_client, smile: str) -> List[str]:
+    bucket_bits = int(redis_client.get(BUCKET_BITS_KEY) or DEFAULT_BUCKET_BITS)
+    key, field = compact_smiles_location(smile, bucket_bits)
+    blob = redis_client.hget(key, field)
+    if not blob:
+        return []
+    patent_ints = decode_varints(blob)
+    pipe = redis_client.pipeline()
+    for patent_int in patent_ints:
+        pipe.hget(*patent_id_location(patent_int))
+    names = pipe.execute()
+    return [name.decode('utf-8') if isinstance(name, bytes) else name
+            for name in names if name is not None]
+
+
+def get_patent_ids(redis_client, smile: str) -> List[str]:
+    """
+    Look up the patent IDs of a cleaned SMILES string in whichever layout the database holds.
+    During a migration both layouts may coexist, so a compact miss falls back to the string key.
+    """
+    if get_layout(redis_client) == LAYOUT_COMPACT:
+        ids = get_patent_ids_compact_layout(redis_client, smile)
+        if ids:
+            return ids
+    return get_patent_ids_string_layout(redis_client, smile)
+
+
+class CompactRedisWriter:
+    """
+    Writes (SMILES, patents) records into the compact layout.
+    Patent interning state is loaded from Redis so imports can be resumed or appended to.
+    """
+    def __init__(self, redis_client, bucket_bits: Optional[int] = None):
+        self.redis_client = redis_client
+        stored_bits = redis_client.get(BUCKET_BITS_KEY)
+        if stored_bits is not None:
+            self.bucket_bits = int(stored_bits)
+        else:
+            self.bucket_bits = bucket_bits or DEFAULT_BUCKET_BITS
+            redis_client.set(BUCKET_BITS_KEY, self.bucket_bits)
+        self.patent_to_int: Dict[str, int] = {}
+        self.new_patents: List[Tuple[int, str]] = []
+        self._load_interning()
+
+    def _load_interning(self):
+        for key in self.redis_client.scan_iter(match=f"{PATENT_BUCKET_PREFIX}*", count=1000):
+            for field, name in self.redis_client.hgetall(key).items():
+                name = name.decode('utf-8') if isinstance(name, bytes) else name
+                self.patent_to_int[name] = int(field)
+
+    def intern(self, patent_id: str) -> int:
+        patent_int = self.patent_to_int.get(patent_id)
+        if patent_int is None:
+            patent_int = len(self.patent_to_int)
+            self.patent_to_int[patent_id] = patent_int
+            self.new_patents.append((patent_int, patent_id))
+        return patent_int
+
+    def write_batch(self, batch):
+        """
+        Args:
+            batch: List of (cleaned smile, patents) tuples
+        """
+        pipe = self.redis_client.pipeline(transaction=False)
+        for smile, patents in batch:
+            key, field = compact_smiles_location(smile, self.bucket_bits)
+            pipe.hset(key, field, encode_varints(self.intern(pid) for pid in patents))
+        for patent_int, patent_id in self.new_patents:
+            key, field = patent_id_location(patent_int)
+            pipe.hset(key, field, patent_id)
+        self.new_patents = []
+        pipe.set(NEXT_PATENT_ID_KEY, len(self.patent_to_int))
+        pipe.set(LAYOUT_KEY, LAYOUT_COMPACT)
+        pipe.execute()
+
+
+# ----------------------------------------------------------------------
+# Embedded index file (no Redis)
+#
+# Layout (little-endian):
+#   header      magic, version, counts and section offsets (HEADER_FORMAT)
+#   keys        uint64[n_molecules]        sorted smiles_hash values
+#   offsets     uint64[n_molecules + 1]    start of each molecule's varint blob
+#   blobs       bytes                      encode_varints(interned patent IDs)
+#   pid_offsets uint64[n_patents + 1]      start of each patent ID string
+#   pid_blob    bytes                      utf-8 patent ID strings
+#
+# The file is opened with mmap and searched in place, so lookups need no
+# startup work and concurrent workers share the pages through the OS page cache.
+# ----------------------------------------------------------------------
+INDEX_MAGIC = b'PATIDX\x00\x01'
+INDEX_VERSION = 1
+HEADER_FORMAT = '<8sIIQQQQQQQ'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+_open_indexes: Dict[str, 'PatentIndexFile'] = {}
+
+
+def build_patent_index_file(records: Iterable[Tuple[str, List[str]]], output_path: str) -> int:
+    """
+    Build an embedded index file from (cleaned smile, patents) records.
+    Records sharing a SMILES are merged, keeping the first-seen patent order.
+
+    Returns:
+        Number of molecules written
+    """
+    patent_to_int: Dict[str, int] = {}
+    hashes = array('Q')
+    blob_starts = array('Q')
+    blob_lengths = array('I')
+    tmp_path = output_path + '.blobs.tmp'
+    with open(tmp_path, 'w+b') as tmp:
+        position = 0
+        for smile, patents in records:
+            patent_ints = []
+            for pid in patents:
+                patent_int = patent_to_int.setdefault(pid, len(patent_to_int))
+                patent_ints.append(patent_int)
+            blob = encode_varints(patent_ints)
+            hashes.append(smiles_hash(smile))
+            blob_starts.append(position)
+            blob_lengths.append(len(blob))
+            tmp.write(blob)
+            position += len(blob)
+
+        order = sorted(range(len(hashes)), key=hashes.__getitem__)
+        tmp.flush()
+        with mmap.mmap(tmp.fileno(), 0, access=mmap.ACCESS_READ) if position else nullcontext(b'') as tmp_blobs:
+            keys = array('Q')
+            offsets = array('Q', [0])
+            blobs = bytearray()
+            for i in order:
+                blob = tmp_blobs[blob_starts[i]:blob_starts[i] + blob_lengths[i]]
+                if keys and keys[-1] == hashes[i]:
+                    # Same molecule listed twice: merge the patent lists
+                    previous = decode_varints(blobs[offsets[-2]:])
+                    seen = set(previous)
+                    merged = previous + [p for p in decode_varints(blob) if p not in seen]
+                    del blobs[offsets[-2]:]
+                    blobs += encode_varints(merged)
+                    offsets[-1] = len(blobs)
+                    continue
+                keys.append(hashes[i])
+                blobs += blob
+                offsets.append(len(blobs))
+    os.remove(tmp_path)
+
+    patent_names = sorted(patent_to_int, key=patent_to_int.__getitem__)
+    pid_offsets = array('Q', [0])
+    pid_blob = bytearray()
+    for name in patent_names:
+        pid_blob += name.encode('utf-8')
+        pid_offsets.append(len(pid_blob))
+
+    if sys.byteorder != 'little':
+        for table in (keys, offsets, pid_offsets):
+            table.byteswap()
+
+    keys_off = HEADER_SIZE
+    offsets_off = keys_off + len(keys) * 8
+    blobs_off = offsets_off + len(offsets) * 8
+    # Keep the uint64 tables 8-byte aligned for memoryview casts
+    pid_offsets_off = (blobs_off + len(blobs) + 7) // 8 * 8
+    pid_blob_off = pid_offsets_off + len(pid_offsets) * 8
+    header = struct.pack(HEADER_FORMAT, INDEX_MAGIC, INDEX_VERSION, 0, len(keys), len(patent_names),
+                         keys_off, offsets_off, blobs_off, pid_offsets_off, pid_blob_off)
+
+    tmp_path = output_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(header)
+        f.write(keys.tobytes())
+        f.write(offsets.tobytes())
+        f.write(blobs)
+        f.write(b'\x00' * (pid_offsets_off - blobs_off - len(blobs)))
+        f.write(pid_offsets.tobytes())
+        f.write(pid_blob)
+    os.replace(tmp_path, output_path)
+    return len(keys)
+
+
+class PatentIndexFile:
+    """
+    Read-only, memory-mapped view of an index file written by build_patent_index_file.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, 'rb')
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, _, self.num_molecules, self.num_patents, keys_off, offsets_off,
+         blobs_off, pid_offsets_off, pid_blob_off) = struct.unpack_from(HEADER_FORMAT, self._mm, 0)
+        if magic != INDEX_MAGIC:
+            raise ValueError(f"{path} is not a patent index file")
+        if version != INDEX_VERSION:
+            raise ValueError(f"Unsupported patent index version {version} in {path}")
+        if sys.byteorder != 'little':
+            raise ValueError("Patent index files can only be memory-mapped on little-endian hosts")
+        view = memoryview(self._mm)
+        self._keys = view[keys_off:offsets_off].cast('Q')
+        self._offsets = view[offsets_off:blobs_off].cast('Q')
+        self._blobs_off = blobs_off
+        self._pid_offsets = view[pid_offsets_off:pid_blob_off].cast('Q')
+        self._pid_blob_off = pid_blob_off
+
+    def get_by_hash(self, h: int) -> List[str]:
+        i = bisect.bisect_left(self._keys, h)
+        if i == len(self._keys) or self._keys[i] != h:
+            return []
+        blob = self._mm[self._blobs_off + self._offsets[i]:self._blobs_off + self._offsets[i + 1]]
+        return [self.patent_name(patent_int) for patent_int in decode_varints(blob)]
+
+    def get(self, smile: str) -> List[str]:
+        return self.get_by_hash(smiles_hash(smile))
+
+    def patent_name(self, patent_int: int) -> str:
+        start = self._pid_blob_off + self._pid_offsets[patent_int]
+        end = self._pid_blob_off + self._pid_offsets[patent_int + 1]
+        return self._mm[start:end].decode('utf-8')
+
+
+def open_patent_index(path: str) -> PatentIndexFile:
+    """
+    Open an index file once per process and reuse the mapping for later lookups
+    """
+    index = _open_indexes.get(path)
+    if index is None:
+        index = _open_indexes[path] = PatentIndexFile(path)
+    return index
@@ -15,6 +15,8 @@ from dotenv import load_dotenv
 import time
 import urllib3
 from tqdm import tqdm
+from .patentIndex import get_patent_ids, open_patent_index
+from .fingerprintIndex import open_fingerprint_index
 
 # Disable SSL warnings
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
@@ -38,16 +40,30 @@ class PatentPDFDownloader:
     """
     Class to search for patents related to a SMILE string and download the PDFs.
     """
-    def __init__(self, pdf_folder_name: str = "patent_pdfs", max_patents: int = 10):
+    def __init__(self, pdf_folder_name: str = "patent_pdfs", max_patents: int = 10,
+                 patent_index_path: Optional[str] = None, fingerprint_index_path: Optional[str] = None,
+                 similarity_threshold: Optional[float] = None, similarity_top_k: int = 5):
         """
         Initialize the PatentPDFDownloader.
 
         Args:
             pdf_folder_name: Folder to save downloaded PDFs
             max_patents: Maximum number of patents to download
+            patent_index_path: Embedded index file to use instead of Redis
+                               (defaults to the PATENT_INDEX_PATH environment variable)
+            fingerprint_index_path: Fingerprint index searched when the exact SMILES has no patents
+                                    (defaults to the PATENT_FP_INDEX_PATH environment variable)
+            similarity_threshold: Minimum Tanimoto similarity of fallback molecules
+                                  (defaults to PATENT_SIMILARITY_THRESHOLD or 0.7)
+            similarity_top_k: Maximum number of similar molecules whose patents are used
         """
         self.pdf_folder_name = pdf_folder_name
         self.max_patents = max_patents
+        self.patent_index_path = patent_index_path or os.getenv("PATENT_INDEX_PATH")
+        self.fingerprint_index_path = fingerprint_index_path or os.getenv("PATENT_FP_INDEX_PATH")
+        self.similarity_threshold = similarity_threshold if similarity_threshold is not None else \
+            float(os.getenv("PATENT_SIMILARITY_THRESHOLD", 0.7))
+        self.similarity_top_k = similarity_top_k
 
         # Create the PDF folder if it doesn't exist
         os.makedirs(pdf_folder_name, exist_ok=True)
@@ -79,20 +95,53 @@ class PatentPDFDownloader:
                                  redis_port: int = 6379, redis_db: int = 0) -> List[str]:
         """
         Retrieve patent IDs from Redis for a given SMILE string.
+        Both the original string layout and the compact hashed layout are decoded transparently.
+        If an embedded index file is configured it is used instead of Redis.
         """
+        if self.patent_index_path:
+            try:
+                return open_patent_index(self.patent_index_path).get(smile)
+            except (OSError, ValueError) as e:
+                print(f"Error reading patent index {self.patent_index_path}: {str(e)}")
+                return []
         try:
             redis_client = Redis(host=redis_host, port=redis_port, db=redis_db, decode_responses=False)
             redis_client.ping()
-            key = f"smile:{smile}"
-            data = redis_client.get(key)
-            if not data:
-                return []
-            ids = json.loads(data.decode('utf-8'))
-            return ids if isinstance(ids, list) else []
+            return get_patent_ids(redis_client, smile)
         except Exception as e:
             print(f"Error connecting to Redis: {str(e)}")
             return []
 
+    def get_similar_patent_ids(self, smile: str, redis_host: str = "localhost",
+                               redis_port: int = 6379, redis_db: int = 0) -> Tuple[List[str], List[Dict]]:
+        """
+        Retrieve patent IDs of the indexed molecules most similar to a SMILE string.
+
+        Returns:
+            Tuple of (patent IDs ordered by similarity, list of matched molecules)
+        """
+        if not self.fingerprint_index_path:
+            return [], []
+        try:
+            neighbours = open_fingerprint_index(self.fingerprint_index_path).search(
+                smile, top_k=self.similarity_top_k, threshold=self.similarity_threshold)
+        except (OSError, ValueError) as e:
+            print(f"Error reading fingerprint index {self.fingerprint_index_path}: {str(e)}")
+            return [], []
+
+        patent_ids = []
+        seen = set()
+        similar_molecules = []
+        for similar_smile, similarity in neighbours:
+            ids = self.get_patent_ids_from_redis(similar_smile, redis_host, redis_port, redis_db)
+            similar_molecules.append({"smile": similar_smile, "similarity": round(similarity, 4),
+                                      "num_patents": len(ids)})
+            for pid in ids:
+                if pid not in seen:
+                    seen.add(pid)
+                    patent_ids.append(pid)
+        return patent_ids, similar_molecules
+
     def strip_kind_code(self, patent_id: str) -> str:
         """
         Remove kind code (A1, B1, etc.) from patent ID
@@ -253,9 +302,10 @@ class PatentPDFDownloader:
             response = requests.get(pdf_url, headers=self.headers, timeout=30, verify=False)
             response.raise_for_status()
 
-            # Save the PDF
-            with open(filepath, 'wb') as f:
+            # Save the PDF under a temporary name so readers never see a partial file
+            with open(filepath + '.part', 'wb') as f:
                 f.write(response.content)
+            os.replace(filepath + '.part', filepath)
 
             print(f"Successfully downloaded PDF for {patent_id} to {filepath}")
             return filepath
@@ -289,6 +339,13 @@ class PatentPDFDownloader:
         # Retrieve all patent IDs first
         all_patent_ids = self.get_patent_ids_from_redis(cleaned, redis_host, redis_port, redis_db)
 
+        # Fall back to the patents of similar molecules when the exact structure is unknown
+        similar_molecules = []
+        if not all_patent_ids and self.fingerprint_index_path:
+            all_patent_ids, similar_molecules = self.get_similar_patent_ids(cleaned, redis_host, redis_port, redis_db)
+            print(f"No exact match for {cleaned}; found {len(similar_molecules)} similar molecules "
+                  f"(Tanimoto >= {self.similarity_threshold}) with {len(all_patent_ids)} patents")
+
         # Filter for US patents only
         us_patent_ids = [pid for pid in all_patent_ids if pid.upper().startswith("US")]
         print(f"Found {len(us_patent_ids)} US patents out of {len(all_patent_ids)} total patents")
@@ -340,6 +397,7 @@ class PatentPDFDownloader:
                 "downloaded": len(downloaded_pdfs),
                 "not_found": len(us_patent_ids) - found_count,
             },
+            "similar_molecules": similar_molecules,
             "results": results
         }
 
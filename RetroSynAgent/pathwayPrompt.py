@@ -0,0 +1,163 @@
+"""
+Compact text of reaction pathways for the pathway filtration and recommendation prompts.
+
+The previous format repeated the full text of a reaction under every pathway using it. Here
+every reaction is written once and pathways are lists of reaction idx:
+
+    Substance aliases:
+    [S1] = 4-chloro-3-nitro-N-(2,6-difluorobenzoyl)benzamide
+
+    Reactions:
+    Reaction idx: 4
+    Reactants: [S1], hydrazine hydrate
+    ...
+
+    Pathways (reaction idx, listed in order):
+    Pathway: 5, 4, 1
+
+Long substance names used more than once are replaced by short aliases, which expand_aliases
+turns back into names in the LLM answer. With a token budget, pathways are kept in the given
+(ranked) order until the budget is used up.
+"""
+import re
+
+from .expansionScheduler import CHARS_PER_TOKEN
+
+ALIAS_PATTERN = re.compile(r"\[S(\d+)\]")
+
+
+def estimate_tokens(text):
+    return len(text) // CHARS_PER_TOKEN
+
+
+def parse_pathway(text):
+    """
+    Reaction idx of a "Pathway: idx4, idx7, idx3" line value, ['4', '7', '3']
+    """
+    return [re.sub(r"^idx\s*", "", part.strip(), flags=re.IGNORECASE) for part in text.split(",") if part.strip()]
+
+
+def parse_pathways(response, header):
+    """
+    Reaction idx lists of the "Pathway: " lines after the header of an LLM answer
+    """
+    section = response.split(header)[-1]
+    return [parse_pathway(line.split("Pathway: ", 1)[1]) for line in section.split('\n') if "Pathway: " in line]
+
+
+class PathwayPrompt:
+    def __init__(self, reaction_records, pathways, max_tokens=None, alias_min_length=25):
+        """
+        Args:
+            reaction_records: {idx: Reaction} covering the reactions of the pathways
+            pathways: [[idx, ...], ...], best first when max_tokens is set
+            max_tokens: estimated token budget of the text, None keeps every pathway
+            alias_min_length: names at least this long are aliased, None disables aliases
+        """
+        self.reaction_records = reaction_records
+        self.alias_min_length = alias_min_length
+        self.pathways = self._fit(pathways, max_tokens)
+        self.dropped = len(pathways) - len(self.pathways)
+        self.aliases = self._assign_aliases(alias_min_length)
+
+    def reaction_idx(self):
+        """
+        Idx of the reactions of the kept pathways, in order of first use
+        """
+        return list(dict.fromkeys(idx for path in self.pathways for idx in path if idx in self.reaction_records))
+
+    def _fit(self, pathways, max_tokens):
+        if max_tokens is None:
+            return list(pathways)
+        kept = []
+        seen = set()
+        size = 0
+        for path in pathways:
+            # budget without aliases, aliases only make the text shorter
+            added = len(f"Pathway: {', '.join(path)}\n")
+            added += sum(len(self.reaction_records[idx].format()) for idx in set(path) - seen
+                         if idx in self.reaction_records)
+            if kept and (size + added) // CHARS_PER_TOKEN > max_tokens:
+                break
+            kept.append(path)
+            seen.update(path)
+            size += added
+        return kept
+
+    def _assign_aliases(self, alias_min_length):
+        """
+        {alias: name} for long names whose alias saves more text than its definition costs
+        """
+        if alias_min_length is None:
+            return {}
+        uses = {}
+        for idx in self.reaction_idx():
+            reaction = self.reaction_records[idx]
+            for name in list(reaction.reactants) + list(reaction.products):
+                if len(name) >= alias_min_length:
+                    uses[name] = uses.get(name, 0) + 1
+        aliases = {}
+        for name, count in uses.items():
+            alias = f"[S{len(aliases) + 1}]"
+            if count * (len(name) - len(alias)) > len(f"{alias} = {name}\n"):
+                aliases[alias] = name
+        return aliases
+
+    def _format_reaction(self, reaction, names):
+        reactants = ', '.join(names.get(name, name) for name in reaction.reactants)
+        products = ', '.join(names.get(name, name) for name in reaction.products)
+        return (f"Reaction idx: {reaction.idx}\nReactants: {reactants}\nProducts: {products}\n"
+                f"Conditions: {reaction.conditions}\nSource: {reaction.source}\n")
+
+    def text(self):
+        names = {name: alias for alias, name in self.aliases.items()}
+        output = []
+        if self.aliases:
+            output.append("Substance aliases (write the full names in your answer):\n")
+            output.extend(f"{alias} = {name}\n" for alias, name in self.aliases.items())
+            output.append("\n")
+        output.append("Reactions:\n")
+        for idx in self.reaction_idx():
+            output.append(self._format_reaction(self.reaction_records[idx], names) + "\n")
+        output.append("Pathways (reaction idx, listed in order):\n")
+        output.extend(f"Pathway: {', '.join(path)}\n" for path in self.pathways)
+        return ''.join(output)
+
+    def select(self, pathways):
+        """
+        Prompt of the kept pathways that are in the given pathways (in any reaction order),
+        with the same aliases
+        """
+        wanted = {frozenset(path) for path in pathways}
+        selected = PathwayPrompt.__new__(PathwayPrompt)
+        selected.reaction_records = self.reaction_records
+        selected.alias_min_length = self.alias_min_length
+        selected.pathways = [path for path in self.pathways if frozenset(path) in wanted]
+        selected.dropped = 0
+        used = {name for idx in selected.reaction_idx()
+                for name in self.reaction_records[idx].reactants + self.reaction_records[idx].products}
+        selected.aliases = {alias: name for alias, name in self.aliases.items() if name in used}
+        return selected
+
+    def shards(self, max_tokens):
+        """
+        Consecutive PathwayPrompts of the kept pathways, each within max_tokens (a pathway
+        larger than the budget gets a shard of its own), with their own aliases
+        """
+        shards = []
+        start = 0
+        while start < len(self.pathways):
+            shard = PathwayPrompt(self.reaction_records, self.pathways[start:], max_tokens=max_tokens,
+                                  alias_min_length=self.alias_min_length)
+            shards.append(shard)
+            start += len(shard.pathways)
+        return shards
+
+
+def expand_aliases(text, aliases):
+    """
+    Replace the aliases of a PathwayPrompt in an LLM answer by the substance names
+    """
+    if not aliases:
+        return text
+    return ALIAS_PATTERN.sub(lambda match: aliases.get(match.group(0), match.group(0)), text)
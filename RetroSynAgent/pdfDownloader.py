@@ -153,9 +153,11 @@ class PDFDownloader:
                 file_name = f"{str(title).replace(':', '').replace('/', '').replace('*', '').replace('|', '').replace('?', '')}.pdf"
                 file_path = os.path.join(os.getcwd(), self.pdf_folder_name, file_name)
                 if res.headers.get('Content-Type') == 'application/pdf':
-                    with open(file_path, 'wb') as f:
+                    # written under a temporary name so readers never see a partial pdf
+                    with open(file_path + '.part', 'wb') as f:
                         f.write(res.content)
-                        logger.info(f"{file_name} successfully saved!")
+                    os.replace(file_path + '.part', file_path)
+                    logger.info(f"{file_name} successfully saved!")
                 else:
                     logger.error(f"{file_name} is invalid pdf file")
             else:
@@ -244,9 +246,11 @@ class PDFDownloader:
               f'{len(self.no_download_link_titles)} do not have download links, '
               f'{len(self.title_list)-len(self.get_pdf_files())-len(self.no_download_link_titles)} failed to be downloaded.')
 
-        # Return full paths to the downloaded PDFs
+        # Return full paths to the downloaded PDFs of this query's titles, not every PDF in the folder
         full_paths = []
         for pdf_name in download_pdf_filename_list:
+            if not self.check_pdf_existence(pdf_name.split('.pdf')[0], self.title_list):
+                continue
             full_path = os.path.join(os.path.abspath(self.pdf_folder_name), pdf_name)
             full_paths.append(full_path)
         return full_paths
@@ -7,6 +7,8 @@ import difflib
 import glob
 from . import prompts
 from .GPTAPI import GPTAPI
+from .reactionRecord import get_reaction_record_store
+from .documentCatalog import EXTRACTED, SKIPPED
 import base64
 from io import BytesIO
 from PIL import Image
@@ -170,6 +172,74 @@ class PDFProcessor:
             reactions_txt += reactions
         return reactions_txt
 
+    def extract_reactions(self, pdf_path, pdf_name):
+        """
+        Extract the reactions of one PDF with the LLM and store them in result_dict.
+
+        Returns:
+            The raw LLM answer, None if the document is too long and was skipped
+        """
+        # base64_img_list = self.pdf_to_base64_img_list(pdf_path)
+        cleaned_text = self.pdf_to_long_string(pdf_path)
+        total_length = len(cleaned_text)
+        print(f'Processing: {pdf_name}, TXT Length: {total_length}')
+        if total_length > 300000:
+            print(f'{pdf_name} Exceed maximum length, skip ...')
+            return None
+        llm = GPTAPI(temperature = 0.0)
+        # prompt = prompts.reaction_prompt
+        prompt_reaction_extract = prompts.prompt_reaction_extraction_cot # .format(substance=self.material)
+        raw_reaction = llm.answer_wo_vision(prompt_reaction_extract, cleaned_text)
+        raw_reaction = self.replace_zeros_in_reactants_and_products(raw_reaction)
+        # prompt2 = prompts.property_prompt.format(reactions=answer_reaction)
+        # answer_property = llm.answer_wo_vision(prompt2, cleaned_text)
+        # self.result_dict[pdf_name] = (ans_reaction, answer_property)
+        ans_reaction = raw_reaction.split("Final Output:")[-1].strip()
+        self.result_dict[pdf_name] = ans_reaction
+        # parse the reactions once now, trees built from this result reuse the records
+        get_reaction_record_store().reactions_for(ans_reaction, source=pdf_name)
+        return raw_reaction
+
+    def process_documents(self, catalog, target, save_batch_size=3):
+        """
+        Extract the pending documents of a target's working set in the document catalog,
+        instead of scanning the whole pdf folder.
+
+        Returns:
+            {pdf name: reactions} of every extracted document of the target
+        """
+        pending = catalog.pending(target)
+        print(f'{len(catalog.working_set(target))} documents for {target}, '
+              f'{len(pending)} are planned to be processed')
+        new_results = {}
+        for doc_hash, pdf_name, pdf_path, _ in tqdm(pending):
+            if pdf_name in self.result_dict:
+                # extracted by an earlier run, before it was in the catalog
+                catalog.mark(doc_hash, EXTRACTED, self.result_dict[pdf_name])
+                continue
+            if self.extract_reactions(pdf_path, pdf_name) is None:
+                catalog.mark(doc_hash, SKIPPED)
+                continue
+            catalog.mark(doc_hash, EXTRACTED, self.result_dict[pdf_name])
+            new_results[pdf_name] = self.result_dict[pdf_name]
+            if len(new_results) % save_batch_size == 0:
+                self.merge_results_json(new_results)
+        if new_results:
+            self.merge_results_json(new_results)
+        return catalog.results(target)
+
+    def merge_results_json(self, new_results):
+        """
+        Add results to the results json without dropping the ones other runs wrote meanwhile
+        """
+        os.makedirs(self.result_folder_name, exist_ok=True)
+        json_path = f"{self.result_folder_name}/{self.result_json_name}.json"
+        results = self.read_data_from_json(json_path) if os.path.exists(json_path) else {}
+        results.update(new_results)
+        tmp_path = f'{json_path}.{os.getpid()}.tmp'
+        self.save_data_as_json(tmp_path, results)
+        os.replace(tmp_path, json_path)
+
     def process_pdfs_txt(self, save_batch_size=3):
 
         pdf_file_list = self.get_pdf_files(self.pdf_folder_name)
@@ -190,25 +260,10 @@ class PDFProcessor:
         reactions_txt = ''
         for pdf_path in tqdm(pdf_file_to_process):
             pdf_name = pdf_path.replace('.pdf', '')
-            # base64_img_list = self.pdf_to_base64_img_list(os.path.join(self.pdf_folder_name, pdf_path))
-            cleaned_text = self.pdf_to_long_string(os.path.join(self.pdf_folder_name, pdf_path))
-            total_length = len(cleaned_text)
-            print(f'Processing: {pdf_name}, TXT Length: {total_length}')
-            if total_length > 300000:
-                print(f'{pdf_name} Exceed maximum length, skip ...')
+            raw_reaction = self.extract_reactions(os.path.join(self.pdf_folder_name, pdf_path), pdf_name)
+            if raw_reaction is None:
                 continue
-            llm = GPTAPI(temperature = 0.0)
-            # prompt = prompts.reaction_prompt
-            prompt_reaction_extract = prompts.prompt_reaction_extraction_cot # .format(substance=self.material)
-            ans_reaction = llm.answer_wo_vision(prompt_reaction_extract, cleaned_text)
-            ans_reaction = self.replace_zeros_in_reactants_and_products(ans_reaction)
-            # prompt2 = prompts.property_prompt.format(reactions=answer_reaction)
-            # answer_property = llm.answer_wo_vision(prompt2, cleaned_text)
-            answer_property = ''
-            # self.result_dict[pdf_name] = (ans_reaction, answer_property)
-            reactions_txt += ('\n\n' + ans_reaction)
-            ans_reaction = ans_reaction.split("Final Output:")[-1].strip()
-            self.result_dict[pdf_name] = ans_reaction
+            reactions_txt += ('\n\n' + raw_reaction)
 
             counter += 1
             if counter % save_batch_size == 0:
@@ -319,6 +319,19 @@ Remaining Reaction Pathways:
 Pathway: List remaining valid reaction indices in order (e.g., idx4, idx7, idx3)
 """
 
+prompt_shortlist_pathways = """
+Reaction Pathways:
+{all_pathways}
+
+The reaction pathways above are one part of the candidate pathways to manufacture commercially available {substance}.
+Select at most {k} pathways from them that are the best candidates, considering mild temperature and pressure conditions, reaction duration, yield, number of steps and accessibility of initial reactants.
+
+Format the output strictly as follows:
+
+Shortlisted Reaction Pathways:
+Pathway: List reaction indices in order (e.g., idx4, idx7, idx3)
+"""
+
 
 recommend_prompt_template_general = """
 Given the target product "{substance}",
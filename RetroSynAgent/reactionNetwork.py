@@ -0,0 +1,295 @@
+"""
+Compiled reaction network: substances interned to dense ints and reactions stored in CSR arrays.
+
+For reaction r (0 <= r < num_reactions):
+    reactant_indices[reactant_offsets[r]:reactant_offsets[r + 1]]   substance ids of its reactants
+    product_indices[product_offsets[r]:product_offsets[r + 1]]      substance ids of its products
+For substance s:
+    producer_indices[producer_offsets[s]:producer_offsets[s + 1]]   reaction ids producing s, in reaction order
+
+reaction_keys maps a reaction id back to its idx string ('1', '2', ...) and substance_names
+maps a substance id back to its name; both are only needed for display.
+"""
+from collections import deque
+from typing import Dict, List
+
+import numpy as np
+
+ID_DTYPE = np.int32
+OFFSET_DTYPE = np.int64
+
+
+def _csr(rows: List[List[int]]):
+    offsets = np.zeros(len(rows) + 1, dtype=OFFSET_DTYPE)
+    np.cumsum([len(row) for row in rows], out=offsets[1:])
+    indices = np.fromiter((item for row in rows for item in row), dtype=ID_DTYPE, count=int(offsets[-1]))
+    return offsets, indices
+
+
+class ReactionNetwork:
+    def __init__(self, reactions=None):
+        """
+        Args:
+            reactions: {idx: reaction} with 'reactants' and 'products' names, e.g. Tree.reactions
+        """
+        self.substance_names: List[str] = []
+        self.substance_ids: Dict[str, int] = {}
+        self.reaction_keys: List[str] = []
+        self.reaction_ids: Dict[str, int] = {}
+        self.reactant_offsets = np.zeros(1, dtype=OFFSET_DTYPE)
+        self.reactant_indices = np.zeros(0, dtype=ID_DTYPE)
+        self.product_offsets = np.zeros(1, dtype=OFFSET_DTYPE)
+        self.product_indices = np.zeros(0, dtype=ID_DTYPE)
+        self.producer_offsets = np.zeros(1, dtype=OFFSET_DTYPE)
+        self.producer_indices = np.zeros(0, dtype=ID_DTYPE)
+        self._components = None
+        if reactions:
+            self.add_reactions(reactions)
+
+    @property
+    def num_substances(self):
+        return len(self.substance_names)
+
+    @property
+    def num_reactions(self):
+        return len(self.reaction_keys)
+
+    def intern(self, name):
+        name = name.strip()
+        substance_id = self.substance_ids.get(name)
+        if substance_id is None:
+            substance_id = self.substance_ids[name] = len(self.substance_names)
+            self.substance_names.append(name)
+        return substance_id
+
+    def substance_id(self, name):
+        """
+        Id of a substance name, -1 if no reaction mentions it
+        """
+        return self.substance_ids.get(name.strip(), -1)
+
+    def reactants(self, reaction_id):
+        return self.reactant_indices[self.reactant_offsets[reaction_id]:self.reactant_offsets[reaction_id + 1]]
+
+    def products(self, reaction_id):
+        return self.product_indices[self.product_offsets[reaction_id]:self.product_offsets[reaction_id + 1]]
+
+    def producers(self, substance_id):
+        """
+        Reaction ids producing a substance
+        """
+        if substance_id < 0 or substance_id >= len(self.producer_offsets) - 1:
+            return self.producer_indices[:0]
+        return self.producer_indices[self.producer_offsets[substance_id]:self.producer_offsets[substance_id + 1]]
+
+    def add_reactions(self, reactions):
+        """
+        Append reactions to the network and rebuild the producer index.
+
+        Returns:
+            {substance_id: [reaction ids]} of the producers that were added
+        """
+        reactant_rows = []
+        product_rows = []
+        for idx, reaction in reactions.items():
+            idx = str(idx)
+            self.reaction_ids[idx] = len(self.reaction_keys)
+            self.reaction_keys.append(idx)
+            reactant_rows.append([self.intern(name) for name in reaction['reactants']])
+            product_rows.append([self.intern(name) for name in reaction['products']])
+        first_new = self.num_reactions - len(reactant_rows)
+
+        offsets, indices = _csr(reactant_rows)
+        self.reactant_offsets = np.concatenate([self.reactant_offsets, offsets[1:] + self.reactant_offsets[-1]])
+        self.reactant_indices = np.concatenate([self.reactant_indices, indices])
+        offsets, indices = _csr(product_rows)
+        self.product_offsets = np.concatenate([self.product_offsets, offsets[1:] + self.product_offsets[-1]])
+        self.product_indices = np.concatenate([self.product_indices, indices])
+
+        # product -> reactions, stable so producers keep reaction order
+        producing_reactions = np.repeat(np.arange(self.num_reactions, dtype=ID_DTYPE), np.diff(self.product_offsets))
+        order = np.argsort(self.product_indices, kind='stable')
+        self.producer_indices = producing_reactions[order]
+        counts = np.bincount(self.product_indices, minlength=self.num_substances)
+        self.producer_offsets = np.zeros(self.num_substances + 1, dtype=OFFSET_DTYPE)
+        np.cumsum(counts, out=self.producer_offsets[1:])
+
+        self._components = None
+        new_producers = {}
+        for reaction_id, row in enumerate(product_rows, start=first_new):
+            for substance_id in row:
+                new_producers.setdefault(substance_id, []).append(reaction_id)
+        return new_producers
+
+    def components(self):
+        """
+        Strongly connected components of the substance graph with an edge from every product of a
+        reaction to each of its reactants, the direction the tree is expanded in (Tarjan's algorithm,
+        iterative). Computed once and kept until reactions are added.
+
+        A tree branch can only return to one of its ancestors inside a cyclic component, so
+        substances outside reaction cycles never need an ancestor check.
+
+        Returns:
+            component: list, component id of every substance id
+            cyclic: list, per component id, True when it has more than one substance or a
+                reaction with the same substance among its reactants and products
+        """
+        if self._components is not None:
+            return self._components
+        num_substances = self.num_substances
+        successors = []
+        for substance_id in range(num_substances):
+            reactant_ids = set()
+            for reaction_id in self.producers(substance_id).tolist():
+                reactant_ids.update(self.reactants(reaction_id).tolist())
+            successors.append(list(reactant_ids))
+
+        index = [-1] * num_substances
+        lowlink = [0] * num_substances
+        on_stack = [False] * num_substances
+        component = [-1] * num_substances
+        cyclic = []
+        stack = []
+        counter = 0
+        for start in range(num_substances):
+            if index[start] >= 0:
+                continue
+            # each frame is (substance id, position of the next successor to visit)
+            frames = [(start, 0)]
+            index[start] = lowlink[start] = counter
+            counter += 1
+            stack.append(start)
+            on_stack[start] = True
+            while frames:
+                substance_id, position = frames[-1]
+                next_ids = successors[substance_id]
+                if position < len(next_ids):
+                    frames[-1] = (substance_id, position + 1)
+                    next_id = next_ids[position]
+                    if index[next_id] < 0:
+                        index[next_id] = lowlink[next_id] = counter
+                        counter += 1
+                        stack.append(next_id)
+                        on_stack[next_id] = True
+                        frames.append((next_id, 0))
+                    elif on_stack[next_id]:
+                        lowlink[substance_id] = min(lowlink[substance_id], index[next_id])
+                    continue
+                frames.pop()
+                if frames:
+                    parent_id = frames[-1][0]
+                    lowlink[parent_id] = min(lowlink[parent_id], lowlink[substance_id])
+                if lowlink[substance_id] == index[substance_id]:
+                    component_id = len(cyclic)
+                    size = 0
+                    while True:
+                        member = stack.pop()
+                        on_stack[member] = False
+                        component[member] = component_id
+                        size += 1
+                        if member == substance_id:
+                            break
+                    cyclic.append(size > 1 or substance_id in next_ids)
+        self._components = component, cyclic
+        return self._components
+
+    def edges(self):
+        """
+        (reactant id, product id, reaction id) arrays of every reactant -> product pair, in reaction order
+        """
+        reactant_counts = np.diff(self.reactant_offsets)
+        product_counts = np.diff(self.product_offsets)
+        pair_counts = reactant_counts * product_counts
+        reaction_ids = np.repeat(np.arange(self.num_reactions, dtype=ID_DTYPE), pair_counts)
+        # position of each pair inside its reaction, split into (reactant, product) positions
+        starts = np.repeat(np.cumsum(pair_counts) - pair_counts, pair_counts)
+        local = np.arange(len(reaction_ids), dtype=OFFSET_DTYPE) - starts
+        per_reactant = product_counts[reaction_ids]
+        sources = self.reactant_indices[self.reactant_offsets[reaction_ids] + local // per_reactant]
+        targets = self.product_indices[self.product_offsets[reaction_ids] + local % per_reactant]
+        return sources, targets, reaction_ids
+
+    def reachable(self, root_id, check_stock):
+        """
+        Backward search from the root over producing reactions, not beyond stock substances.
+
+        Args:
+            root_id: substance id of the target
+            check_stock: callable, list of substance ids -> list of bools, called once per
+                level of the search so the stock lookups of a level can be batched
+
+        Returns:
+            stock: ids of the reachable stock substances
+            unexpandable: ids of the reachable substances that are neither stock nor produced by a reaction
+            reactions: ids of the reachable reactions
+        """
+        stock = []
+        unexpandable = []
+        reactions = []
+        if root_id < 0:
+            return stock, unexpandable, reactions
+        seen_reactions = set()
+        seen = {root_id}
+        level = [root_id]
+        while level:
+            next_level = []
+            for substance_id, in_stock in zip(level, check_stock(level)):
+                if in_stock:
+                    stock.append(substance_id)
+                    continue
+                producers = self.producers(substance_id).tolist()
+                if not producers:
+                    unexpandable.append(substance_id)
+                for reaction_id in producers:
+                    if reaction_id in seen_reactions:
+                        continue
+                    seen_reactions.add(reaction_id)
+                    reactions.append(reaction_id)
+                    for reactant_id in self.reactants(reaction_id).tolist():
+                        if reactant_id not in seen:
+                            seen.add(reactant_id)
+                            next_level.append(reactant_id)
+            level = next_level
+        return stock, unexpandable, reactions
+
+    def solvability(self, root_id, check_stock):
+        """
+        Substances that can be made from stock, as the least fixed point of the Horn clauses
+        "all reactants of a reaction solvable -> its products solvable", seeded with the stock
+        substances. Runs in O(total size of the reactions reachable from the root) plus one
+        stock check per reachable substance.
+
+        Args:
+            root_id: substance id of the target
+            check_stock: see reachable
+
+        Returns:
+            reaction_solvable: bool array over reaction ids, True when every reactant is solvable
+            unexpandable: ids of the reachable substances that are neither stock nor produced by a reaction
+        """
+        reaction_solvable = np.zeros(self.num_reactions, dtype=np.bool_)
+        stock, unexpandable, reactions = self.reachable(root_id, check_stock)
+
+        # unit propagation: each reaction counts its reactants not known to be solvable yet,
+        # a reaction without reactants never yields a child node and stays unsolvable
+        missing = {}
+        consumers = {}
+        for reaction_id in reactions:
+            reactant_ids = set(self.reactants(reaction_id).tolist())
+            missing[reaction_id] = len(reactant_ids)
+            for reactant_id in reactant_ids:
+                consumers.setdefault(reactant_id, []).append(reaction_id)
+        solvable = set(stock)
+        queue = deque(stock)
+        while queue:
+            substance_id = queue.popleft()
+            for reaction_id in consumers.get(substance_id, ()):
+                missing[reaction_id] -= 1
+                if missing[reaction_id] == 0:
+                    reaction_solvable[reaction_id] = True
+                    for product_id in self.products(reaction_id).tolist():
+                        if product_id not in solvable:
+                            solvable.add(product_id)
+                            queue.append(product_id)
+        return reaction_solvable, unexpandable
@@ -7,6 +7,7 @@ product_dict = {'s1':[idx1,idx2,...],'s2':[...]} # s1 is obtained by raction-idx
 import json
 import networkx as nx
 from pyvis.network import Network
+from .reactionRecord import parse_reactions_text
 
 import warnings
 warnings.filterwarnings('ignore')
@@ -47,27 +48,13 @@ class ReactionParser:
         return product_dict
 
     def parse_reactions(self, reactions_txt):
-        idx = 1
-        reactants = []
-        products = []
         reactions_dict = {}
-        lines = reactions_txt.splitlines()
-        for line in lines:
-            line = line.strip()
-            if line.startswith("Reactants:"):
-                reactants = line.split("Reactants:")[1].strip().split(', ')
-                reactants = [reactant.lower() for reactant in reactants]
-            elif line.startswith("Products:"):
-                products = line.split("Products:")[1].strip().split(', ')
-                products = [product.lower() for product in products]
-            elif line.startswith("Conditions:"):
-                conditions = line.split("Conditions:")[1].strip()
-                reactions_dict[str(idx)] = {
-                    'reactants': tuple(reactants),
-                    'products': tuple(products),
-                    'conditions': conditions,
-                }
-                idx += 1
+        for idx, reaction in enumerate(parse_reactions_text(reactions_txt), start=1):
+            reactions_dict[str(idx)] = {
+                'reactants': reaction.reactants,
+                'products': reaction.products,
+                'conditions': reaction.conditions,
+            }
         return reactions_dict
 
     def parse_properties(self, properties_txt):
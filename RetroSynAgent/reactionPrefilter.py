@@ -0,0 +1,144 @@
+"""
+Deterministic checks that reject reactions before prompt_reactions_filtration, so the LLM only
+judges the reactions that need chemistry knowledge (catalysts, solvents, toxicity).
+
+Rules, in the order they are tried:
+- missing_substances: no reactants or no products
+- missing_conditions: empty conditions (criterion 1 of prompt_reactions_filtration)
+- no_change: the same substances on both sides
+- high_temperature: lowest stated temperature above max_temperature °C (criterion 2)
+- high_pressure: lowest stated pressure above max_pressure atm (criterion 3)
+- invalid_smiles: a substance written as SMILES that RDKit cannot parse
+- element_balance: structures of every substance are known and a product has an element
+  (besides H) that no reactant has and the conditions do not mention
+
+The RDKit rules are skipped when RDKit is not installed.
+"""
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+from .treeBuilder import SMILES_PATTERN
+
+try:
+    from rdkit import Chem, RDLogger
+    RDLogger.DisableLog('rdApp.*')
+except ImportError:
+    Chem = None
+
+RULES = ('missing_substances', 'missing_conditions', 'no_change', 'high_temperature', 'high_pressure',
+         'invalid_smiles', 'element_balance')
+
+EMPTY_CONDITIONS = {'', 'none', 'n/a', 'na', 'unknown', 'not specified', 'not provided', '-'}
+# low end of a value or range: "80 °C", "20-25 °C", "150 to 200 ℃"
+NUMBER_RANGE = r'(\d+(?:\.\d+)?)(?:\s*(?:-|–|~|to)\s*\d+(?:\.\d+)?)?\s*'
+TEMPERATURE_PATTERN = re.compile(NUMBER_RANGE + r'(?:°\s*C|℃|oC\b)')
+PRESSURE_PATTERN = re.compile(NUMBER_RANGE + r'(atm|bar|MPa|kPa|psi)\b', re.IGNORECASE)
+ATM_PER_UNIT = {'atm': 1.0, 'bar': 0.986923, 'mpa': 9.86923, 'kpa': 0.00986923, 'psi': 0.068046}
+# temperature units, whose letters are not element symbols
+TEMPERATURE_UNITS = re.compile(r'°\s*[CF]|℃|(?<=\d)\s*(?:oC|K)\b')
+# characters names do not have but SMILES do, as in NameToSMILES.convert
+SMILES_CHARS = re.compile(r"[=#@\\/[\]]")
+# how conditions name the source of an element, besides its symbol
+ELEMENT_STEMS = {'N': ('nitr', 'amin', 'amm', 'azid', 'hydrazin'), 'O': ('ox', 'hydrox', 'water', 'peroxid'),
+                 'S': ('sulf', 'sulph', 'thi'), 'P': ('phosph',), 'F': ('fluor',), 'Cl': ('chlor',),
+                 'Br': ('brom',), 'I': ('iod',), 'B': ('bor',), 'Si': ('sil',), 'C': ('carb', 'cyan', 'methyl'),
+                 'Na': ('sodium',), 'K': ('potassium',), 'Li': ('lithium',), 'Mg': ('magnesium',)}
+
+
+class ReactionPrefilter:
+    def __init__(self, smiles_lookup=None, max_temperature=350, max_pressure=2, max_workers=1):
+        """
+        Args:
+            smiles_lookup: callable name -> SMILES or None, e.g. the get of the SMILES cache; without
+                it only substances written as SMILES have structures
+            max_workers: threads checking the reactions
+        """
+        self.smiles_lookup = smiles_lookup
+        self.max_temperature = max_temperature
+        self.max_pressure = max_pressure
+        self.max_workers = max_workers
+        self.counts = dict.fromkeys(RULES + ('kept',), 0)
+
+    def check(self, reaction):
+        """
+        Returns:
+            name of the first rule the reaction breaks, None if it passes every rule
+        """
+        if not reaction.reactants or not reaction.products:
+            return 'missing_substances'
+        conditions = (reaction.conditions or '').strip()
+        if conditions.lower().rstrip('.') in EMPTY_CONDITIONS:
+            return 'missing_conditions'
+        if {name.strip().lower() for name in reaction.reactants} == {name.strip().lower() for name in reaction.products}:
+            return 'no_change'
+        temperatures = [float(low) for low in TEMPERATURE_PATTERN.findall(conditions)]
+        if temperatures and min(temperatures) > self.max_temperature:
+            return 'high_temperature'
+        pressures = [float(low) * ATM_PER_UNIT[unit.lower()] for low, unit in PRESSURE_PATTERN.findall(conditions)]
+        if pressures and min(pressures) > self.max_pressure:
+            return 'high_pressure'
+        if Chem is None:
+            return None
+        reactant_molecules = [self.molecule(name) for name in reaction.reactants]
+        product_molecules = [self.molecule(name) for name in reaction.products]
+        if any(molecule is False for molecule in reactant_molecules + product_molecules):
+            return 'invalid_smiles'
+        if all(reactant_molecules) and all(product_molecules):
+            missing = elements(product_molecules) - elements(reactant_molecules) - {'H'}
+            if any(not mentions(conditions, element) for element in missing):
+                return 'element_balance'
+        return None
+
+    def molecule(self, name):
+        """
+        RDKit molecule of the substance, None if its structure is unknown, False if it is written
+        as SMILES that do not parse
+        """
+        smiles = self.smiles_lookup(name) if self.smiles_lookup else None
+        if smiles and smiles != name:
+            return Chem.MolFromSmiles(smiles)
+        if not SMILES_PATTERN.match(name):
+            return None
+        molecule = Chem.MolFromSmiles(name)
+        if molecule is None and SMILES_CHARS.search(name):
+            return False
+        return molecule
+
+    def filter(self, reaction_records):
+        """
+        Args:
+            reaction_records: {idx: Reaction}
+
+        Returns:
+            ({idx: Reaction} passing every rule, {idx: rule} of the rejected reactions)
+        """
+        records = list(reaction_records.items())
+        if self.max_workers > 1 and len(records) > 1:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                results = list(executor.map(lambda item: self.check(item[1]), records))
+        else:
+            results = [self.check(reaction) for _, reaction in records]
+        kept = {}
+        rejected = {}
+        for (idx, reaction), rule in zip(records, results):
+            if rule is None:
+                kept[idx] = reaction
+            else:
+                rejected[idx] = rule
+            self.counts[rule or 'kept'] += 1
+        return kept, rejected
+
+    def report(self):
+        return ', '.join(f'{rule}: {count}' for rule, count in self.counts.items() if count)
+
+
+def elements(molecules):
+    return {atom.GetSymbol() for molecule in molecules for atom in molecule.GetAtoms()}
+
+
+def mentions(conditions, element):
+    conditions = TEMPERATURE_UNITS.sub(' ', conditions)
+    if re.search(rf'(?<![A-Za-z]){element}(?![a-z])', conditions):
+        return True
+    lowered = conditions.lower()
+    return any(stem in lowered for stem in ELEMENT_STEMS.get(element, ()))
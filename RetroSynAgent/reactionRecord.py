@@ -0,0 +1,147 @@
+import hashlib
+import json
+import os
+import threading
+
+REACTION_RECORDS_FILE = "reaction_records.jsonl"
+
+_record_stores = {}
+_record_stores_lock = threading.Lock()
+
+
+class Reaction:
+    """
+    One extracted reaction. Supports reaction['reactants'] style access so code written
+    against the previous {'reactants': ..., 'products': ..., 'conditions': ..., 'source': ...}
+    dicts keeps working.
+    """
+    __slots__ = ('idx', 'reactants', 'products', 'conditions', 'source')
+    FIELDS = ('reactants', 'products', 'conditions', 'source')
+
+    def __init__(self, reactants, products, conditions='', source=None, idx=None):
+        self.idx = idx
+        self.reactants = tuple(reactants)
+        self.products = tuple(products)
+        self.conditions = conditions
+        self.source = source
+
+    def __getitem__(self, key):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self.FIELDS
+
+    def __eq__(self, other):
+        if not isinstance(other, Reaction):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    def __repr__(self):
+        return (f"Reaction(idx={self.idx!r}, reactants={self.reactants!r}, products={self.products!r}, "
+                f"conditions={self.conditions!r}, source={self.source!r})")
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self.FIELDS else default
+
+    def keys(self):
+        return self.FIELDS
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.FIELDS}
+
+    def format(self):
+        """
+        Text block used in the prompts, "Reaction idx: ...\\nReactants: ...\\n..."
+        """
+        return (f"Reaction idx: {self.idx}\nReactants: {', '.join(self.reactants)}\nProducts: {', '.join(self.products)}\n"
+                f"Conditions: {self.conditions}\nSource: {self.source}\n\n")
+
+
+def parse_reactions_text(reactions_txt, source=None):
+    """
+    Parse the reactions of an LLM answer. A reaction is complete at its Conditions line;
+    "Reaction idx:" and "Source:" lines, as written by Reaction.format, are kept when present.
+
+    Returns:
+        List of Reaction, idx is None unless the text carried one
+    """
+    reactions = []
+    idx = None
+    reactants = []
+    products = []
+    for line in reactions_txt.splitlines():
+        line = line.strip()
+        if line.startswith('Reaction idx:'):
+            idx = line.split("Reaction idx:")[1].strip()
+        elif line.startswith("Reactants:"):
+            reactants = line.split("Reactants:")[1].strip().split(', ')
+            reactants = [reactant.lower() for reactant in reactants]
+        elif line.startswith("Products:"):
+            products = line.split("Products:")[1].strip().split(', ')
+            products = [product.lower() for product in products]
+        elif line.startswith("Conditions:"):
+            conditions = line.split("Conditions:")[1].strip()
+            reactions.append(Reaction(reactants, products, conditions, source, idx))
+            idx = None
+        elif line.startswith("Source:") and reactions:
+            reactions[-1].source = line.split("Source:")[1].strip()
+    return reactions
+
+
+class ReactionRecordStore:
+    """
+    Reactions parsed from each document's LLM answer, persisted as JSONL keyed by a hash of the answer,
+    so a document is parsed once however many trees are built from it.
+    """
+    def __init__(self, path=REACTION_RECORDS_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        self.records = {}
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.records[entry['hash']] = entry['reactions']
+
+    @staticmethod
+    def text_hash(reactions_txt):
+        return hashlib.blake2b(reactions_txt.encode('utf-8'), digest_size=16).hexdigest()
+
+    def reactions_for(self, reactions_txt, source=None):
+        """
+        Reactions of one document, parsed on first use.
+
+        Returns:
+            List of new Reaction objects (callers may modify them), idx left unset
+        """
+        key = self.text_hash(reactions_txt)
+        with self.lock:
+            rows = self.records.get(key)
+            if rows is None:
+                rows = [[list(reaction.reactants), list(reaction.products), reaction.conditions]
+                        for reaction in parse_reactions_text(reactions_txt)]
+                self.records[key] = rows
+                with open(self.path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps({'hash': key, 'reactions': rows}, ensure_ascii=False) + '\n')
+        return [Reaction(reactants, products, conditions, source) for reactants, products, conditions in rows]
+
+
+def get_reaction_record_store(path=REACTION_RECORDS_FILE) -> ReactionRecordStore:
+    """
+    Store shared by everything running in this process
+    """
+    with _record_stores_lock:
+        store = _record_stores.get(path)
+        if store is None:
+            store = _record_stores[path] = ReactionRecordStore(path)
+        return store
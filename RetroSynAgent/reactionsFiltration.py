@@ -3,22 +3,60 @@ import os
 from .treeBuilder import Tree, TreeLoader
 from . import prompts
 from .GPTAPI import GPTAPI
+from .llmMapReduce import map_prompts, merge_responses, shard_entries
+from .pathwayPrompt import PathwayPrompt, estimate_tokens, expand_aliases, parse_pathways
+from .reactionPrefilter import ReactionPrefilter
 
 class ReactionsFiltration:
-    def __init__(self, result_folder_name = 'res_pi'):
+    def __init__(self, result_folder_name = 'res_pi', compact=True, max_prompt_tokens=None, alias_min_length=25,
+                 map_reduce_tokens=None, shortlist_size=3, prefilter=True, prefilter_workers=4):
+        """
+        Args:
+            compact: write pathways as a reaction table and idx lists (PathwayPrompt) instead of
+                repeating the reactions under every pathway
+            max_prompt_tokens: estimated token budget of the compact pathway text, the best
+                pathways are kept, None keeps every pathway
+            alias_min_length: long substance names are replaced by aliases, None disables aliases
+            map_reduce_tokens: estimated token budget of one LLM call; larger reaction and pathway
+                texts are split into chunks sent concurrently, None sends everything in one call
+            shortlist_size: pathways kept per chunk by each round of shortlistPathways
+            prefilter: reject reactions by the local rules of ReactionPrefilter before the LLM
+                reaction filtration, which then only sees the remaining reactions
+            prefilter_workers: threads of the ReactionPrefilter
+        """
         self.result_folder_name = result_folder_name
+        self.compact = compact
+        self.max_prompt_tokens = max_prompt_tokens
+        self.alias_min_length = alias_min_length
+        self.map_reduce_tokens = map_reduce_tokens
+        self.shortlist_size = shortlist_size
+        self.prefilter = prefilter
+        self.prefilter_workers = prefilter_workers
+        # PathwayPrompt of the last pathway text, for filterPathways and expand_aliases
+        self.pathway_prompt = None
 
     def filterReactions(self, tree):
-        reactions_txt = tree.get_reactions_in_tree()
+        reaction_records = tree.get_reaction_records_in_tree()
+        reactions_txt = ''.join(reaction.format() for reaction in reaction_records.values())
         #
         # with open(f'{self.result_folder_name}/reactions_in_tree.txt', 'w') as f:
         #     f.write(reactions_txt)
         #
-        # 1) filter reactions based on conditions
+        # 1) filter reactions based on conditions, the local rules first
+        llm_reactions_txt = self.__prefilterReactions(tree, reaction_records) if self.prefilter else reactions_txt
         filename = f'{self.result_folder_name}/reactions_filtered.txt'
         if not os.path.exists(filename):
-            prompt_filter_reactions = prompts.prompt_reactions_filtration.format(reactions=reactions_txt)
-            response_filter_reactions = GPTAPI(temperature=0.3).answer_wo_vision(prompt_filter_reactions)
+            if not llm_reactions_txt.strip():
+                response_filter_reactions = "Remaining Reactions:\n"
+            elif self.map_reduce_tokens and estimate_tokens(llm_reactions_txt) > self.map_reduce_tokens:
+                chunks = shard_entries(llm_reactions_txt.strip().split("\n\n"), self.map_reduce_tokens)
+                print(f'Filtering reactions in {len(chunks)} chunks.')
+                responses = map_prompts([prompts.prompt_reactions_filtration.format(reactions="\n\n".join(chunk))
+                                         for chunk in chunks], temperature=0.3)
+                response_filter_reactions = merge_responses(responses, "Remaining Reactions:")
+            else:
+                prompt_filter_reactions = prompts.prompt_reactions_filtration.format(reactions=llm_reactions_txt)
+                response_filter_reactions = GPTAPI(temperature=0.3).answer_wo_vision(prompt_filter_reactions)
             with open(f'{self.result_folder_name}/reactions_filtered.txt', 'w') as f:
                 f.write(response_filter_reactions)
         else:
@@ -26,81 +64,168 @@ class ReactionsFiltration:
                 response_filter_reactions = f.read()
 
         remaining_reactions_txt = response_filter_reactions.split("Remaining Reactions:")[-1]
-        result = re.findall(r'Reaction idx: (\d+)', remaining_reactions_txt)
-        # remaining_reaction_indices
-        id_list = list(map(str, result))
-        # Split the string by "Reaction idx:" and keep only the parts included in reaction_ids
-        filtered_entries = []
-        for entry in reactions_txt.strip().split("\n\n"):
-            if any(f"Reaction idx: {rid}" in entry for rid in id_list):
-                filtered_entries.append(entry)
+        # remaining reaction indices, matched exactly against the idx of the records
+        remaining_ids = set(re.findall(r'Reaction idx:\s*(\d+)', remaining_reactions_txt))
+        filtered_entries = [reaction.format().rstrip("\n") for idx, reaction in reaction_records.items()
+                            if idx in remaining_ids]
         # Join the filtered results into a single string
         reactions_txt_filtered = "\n\n".join(filtered_entries)
         print(f'Filtered approximately {(1 - len(reactions_txt_filtered) / len(reactions_txt)) * 100:.2f}% of reactions.')
         return reactions_txt_filtered
 
-    def __concatPathwayandReactions(self, reactions_txt, all_path_list):
-        # Split the reaction string by line
-        reactions = reactions_txt.strip().split('\n\n')
-
-        # Store reaction strings in a dictionary indexed by Reaction idx
-        reaction_dict = {}
-        for reaction in reactions:
-            idx_line = reaction.split('\n')[0]
-            idx = idx_line.split(': ')[-1]
-            reaction_dict[idx] = reaction
+    def __prefilterReactions(self, tree, reaction_records):
+        """
+        Text of the reactions that pass the ReactionPrefilter rules; the rejected reactions and
+        their rules are written to reactions_prefiltered.txt
+        """
+        prefilter = ReactionPrefilter(smiles_lookup=tree.db.smiles_cache.get, max_workers=self.prefilter_workers)
+        kept, rejected = prefilter.filter(reaction_records)
+        print(f'Pre-filter rejected {len(rejected)} of {len(reaction_records)} reactions ({prefilter.report()}).')
+        with open(f'{self.result_folder_name}/reactions_prefiltered.txt', 'w') as f:
+            f.write(''.join(f'Reaction idx: {idx}, Rule: {rule}\n' for idx, rule in rejected.items()))
+        return ''.join(reaction.format() for reaction in kept.values())
 
+    def __concatPathwayandReactions(self, reaction_records, all_path_list):
+        """
+        reaction_records: {idx: Reaction} of the reactions in the tree
+        """
         # Find the corresponding entries for each pathway and output them
         output = []
         for path in all_path_list:
             output.append(f"Pathway: {', '.join(path)}\n")
             for idx in path:
-                if idx in reaction_dict:
-                    output.append(reaction_dict[idx] + "\n")
+                if idx in reaction_records:
+                    output.append(reaction_records[idx].format().rstrip("\n") + "\n")
             output.append('\n')
 
         # Output the result
         result = ''.join(output)
         return result
 
+    def __pathwaysText(self, reaction_records, all_path_list):
+        if not self.compact:
+            # kept for filterPathways, which selects the remaining pathways by their reaction idx
+            self.pathway_prompt = PathwayPrompt(reaction_records, all_path_list, alias_min_length=None)
+            return self.__concatPathwayandReactions(reaction_records=reaction_records, all_path_list=all_path_list)
+        self.pathway_prompt = PathwayPrompt(reaction_records, all_path_list, max_tokens=self.max_prompt_tokens,
+                                            alias_min_length=self.alias_min_length)
+        res = self.pathway_prompt.text()
+        if self.pathway_prompt.dropped:
+            print(f'{self.pathway_prompt.dropped} pathways dropped to fit {self.max_prompt_tokens} tokens.')
+        print(f'Pathway prompt: {len(self.pathway_prompt.pathways)} pathways, '
+              f'{len(self.pathway_prompt.reaction_idx())} reactions, ~{estimate_tokens(res)} tokens.')
+        return res
+
+    def expand_aliases(self, text):
+        """
+        Replace the substance aliases of the last pathway text in an LLM answer by the names
+        """
+        if self.pathway_prompt is None:
+            return text
+        return expand_aliases(text, self.pathway_prompt.aliases)
+
     def getFullReactionPathways(self, tree):
         all_path = tree.find_all_paths()
-        reactions_tree = tree.get_reactions_in_tree()
-        res = self.__concatPathwayandReactions(reactions_txt=reactions_tree, all_path_list=all_path)
+        if self.compact and self.max_prompt_tokens:
+            # truncation keeps the shortest pathways
+            all_path = sorted(all_path, key=len)
+        reaction_records = tree.get_reaction_records_in_tree()
+        res = self.__pathwaysText(reaction_records=reaction_records, all_path_list=all_path)
+        return res
+
+    def getRankedReactionPathways(self, tree, k=10, costs=None):
+        """
+        The k cheapest pathways of the tree (Tree.find_best_paths) in the format of
+        getFullReactionPathways, cheapest first, instead of every pathway.
+        """
+        ranked = tree.find_best_paths(k=k, costs=costs)
+        print(f'Ranked pathways: {", ".join(f"{cost:g}" for cost, _ in ranked)}')
+        reaction_records = tree.get_reaction_records([idx for _, path in ranked for idx in path])
+        res = self.__pathwaysText(reaction_records=reaction_records, all_path_list=[path for _, path in ranked])
         return res
 
 
-    def __filter_pathways(self, response_filter_pathways, pathways_txt):
-        remaining_pathway_txt = response_filter_pathways.split("Remaining Reaction Pathways:")[-1]
-        # result = re.findall(r'Pathway: (\d+)', remaining_pathway_txt)
-        id_list = [line.split("Pathway: ")[1].strip() for line in remaining_pathway_txt.split('\n') if
-                   "Pathway: " in line]
-        # remaining_pathway_indices
-        # id_list = list(map(str, result))
-        filtered_entries = []
-        for entry in pathways_txt.strip().split("\n\n"):
-            if any(f"Pathway: {id}" in entry for id in id_list):
-                filtered_entries.append(entry)
-        # print(f'{len(id_list)} pathways remaining - id_list')
-        # print(f'{len(filtered_entries)} pathways remaining - filtered_entries')
-        print(f'{len(filtered_entries)} pathways remaining')
-        filtered_pathways = "\n\n".join(filtered_entries)
-        return filtered_pathways
+    def __filter_pathways(self, response_filter_pathways):
+        # remaining pathways as reaction idx lists, kept from the PathwayPrompt of the pathway text
+        remaining = parse_pathways(response_filter_pathways, "Remaining Reaction Pathways:")
+        self.pathway_prompt = self.pathway_prompt.select(remaining)
+        print(f'{len(self.pathway_prompt.pathways)} pathways remaining')
+        if self.compact:
+            return self.pathway_prompt.text()
+        return self.__concatPathwayandReactions(reaction_records=self.pathway_prompt.reaction_records,
+                                               all_path_list=self.pathway_prompt.pathways).rstrip("\n")
 
-    def filterPathways(self, tree):
-        all_pathways_w_reactions = self.getFullReactionPathways(tree)
+    def filterPathways(self, tree, k=None):
+        """
+        k: only send the k cheapest pathways (getRankedReactionPathways), None sends every pathway
+        """
+        if k:
+            all_pathways_w_reactions = self.getRankedReactionPathways(tree, k=k)
+        else:
+            all_pathways_w_reactions = self.getFullReactionPathways(tree)
         # with open(f'{self.result_folder_name}/all_pathways.txt', 'w') as f:
         #     f.write(all_pathways_w_reactions)
 
         filename = f'{self.result_folder_name}/pathway_filtered.txt'
         if not os.path.exists(filename):
-            prompt_filter_pathway = prompts.prompt_filter_pathway.format(all_pathways=all_pathways_w_reactions)
-            response_filtered_pathway = GPTAPI(temperature=0.2).answer_wo_vision(prompt_filter_pathway)
+            if self.__sharded(all_pathways_w_reactions):
+                shards = self.pathway_prompt.shards(self.map_reduce_tokens)
+                print(f'Filtering pathways in {len(shards)} chunks.')
+                responses = map_prompts([prompts.prompt_filter_pathway.format(all_pathways=shard.text())
+                                         for shard in shards], temperature=0.2)
+                response_filtered_pathway = merge_responses(responses, "Remaining Reaction Pathways:")
+            else:
+                prompt_filter_pathway = prompts.prompt_filter_pathway.format(all_pathways=all_pathways_w_reactions)
+                response_filtered_pathway = GPTAPI(temperature=0.2).answer_wo_vision(prompt_filter_pathway)
             with open(f'{self.result_folder_name}/pathway_filtered.txt', 'w') as f:
                 f.write(response_filtered_pathway)
         else:
             with open(f'{self.result_folder_name}/pathway_filtered.txt', 'r') as f:
                 response_filtered_pathway = f.read()
-        filtered_pathways = self.__filter_pathways(response_filtered_pathway, pathways_txt=all_pathways_w_reactions)
+        filtered_pathways = self.__filter_pathways(response_filtered_pathway)
         return filtered_pathways
 
+    def __sharded(self, pathways_txt):
+        # pathways are split along the PathwayPrompt, so only the compact text is sharded
+        return (self.compact and self.map_reduce_tokens is not None
+                and estimate_tokens(pathways_txt) > self.map_reduce_tokens)
+
+    def shortlistPathways(self, substance, pathways_txt):
+        """
+        Tournament over the pathways of the last pathway text, for a recommendation prompt within
+        map_reduce_tokens: each round splits the pathways into chunks, asks concurrently for the
+        shortlist_size best pathways of every chunk and keeps the shortlisted ones, until they fit
+        in one call.
+
+        Returns:
+            pathway text of the shortlisted pathways, pathways_txt if it already fits
+        """
+        if not self.__sharded(pathways_txt):
+            return pathways_txt
+        pathway_prompt = self.pathway_prompt
+        text = pathways_txt
+        rounds = []
+        while estimate_tokens(text) > self.map_reduce_tokens:
+            shards = pathway_prompt.shards(self.map_reduce_tokens)
+            if len(shards) * self.shortlist_size >= len(pathway_prompt.pathways):
+                # chunks hold no more pathways than their shortlists, a round would not drop any
+                print(f'Pathways too large to shortlist within {self.map_reduce_tokens} tokens.')
+                break
+            responses = map_prompts([prompts.prompt_shortlist_pathways.format(all_pathways=shard.text(),
+                                                                              substance=substance,
+                                                                              k=self.shortlist_size)
+                                     for shard in shards])
+            response = merge_responses(responses, "Shortlisted Reaction Pathways:")
+            rounds.append(response)
+            shortlist = pathway_prompt.select(parse_pathways(response, "Shortlisted Reaction Pathways:"))
+            print(f'Shortlist round {len(rounds)}: {len(pathway_prompt.pathways)} pathways in {len(shards)} chunks, '
+                  f'{len(shortlist.pathways)} shortlisted.')
+            if not shortlist.pathways or len(shortlist.pathways) >= len(pathway_prompt.pathways):
+                # no answer could be used or nothing left to drop, recommend from the last round
+                break
+            pathway_prompt = shortlist
+            text = pathway_prompt.text()
+        with open(f'{self.result_folder_name}/pathway_shortlist.txt', 'w') as f:
+            f.write('\n\n'.join(rounds))
+        self.pathway_prompt = pathway_prompt
+        return text
@@ -0,0 +1,111 @@
+import json
+import os
+import threading
+
+from .fileLock import file_lock, write_atomic
+
+COMPACT_EVERY = 50
+
+
+class ExpansionResultsStore:
+    """
+    In-memory store of the reactions extracted from expansion literature, {pdf_name: reactions_txt}.
+
+    Every new result is appended to a JSONL log next to the json file and fsynced, so a crash
+    loses at most the record being written. The log is periodically compacted into the json
+    file (the same format as before, e.g. llm_res_add.json), which is replaced atomically.
+    Loading reads the json file and replays the log on top of it.
+
+    Several processes may share the files: appends and compaction hold a file lock, and
+    compaction merges the records other processes wrote before it removes the log.
+    """
+    def __init__(self, json_path, compact_every=COMPACT_EVERY):
+        self.json_path = json_path
+        self.log_path = os.path.splitext(json_path)[0] + '.jsonl'
+        self.compact_every = compact_every
+        self.lock = threading.Lock()
+        self.results = self._load()
+        self.pending = 0
+
+    def _load(self):
+        results = {}
+        if os.path.exists(self.json_path):
+            with open(self.json_path, 'r') as f:
+                try:
+                    results = json.load(f)
+                except json.JSONDecodeError:
+                    print(f'Failed to read {self.json_path}, starting from the log only.')
+        if os.path.exists(self.log_path):
+            with open(self.log_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        key, value = json.loads(line)
+                    except ValueError:
+                        # a record cut short by a crash
+                        continue
+                    results.setdefault(key, value)
+        return results
+
+    def __contains__(self, pdf_name):
+        return pdf_name in self.results
+
+    def __len__(self):
+        return len(self.results)
+
+    def __getitem__(self, pdf_name):
+        return self.results[pdf_name]
+
+    def items(self):
+        return self.results.items()
+
+    def as_dict(self):
+        return dict(self.results)
+
+    def add(self, pdf_name, reactions_txt) -> bool:
+        """
+        Record the result of one document; results that are already stored are kept.
+
+        Returns:
+            True if the result was new
+        """
+        with self.lock:
+            if pdf_name in self.results:
+                return False
+            self.results[pdf_name] = reactions_txt
+            # counted first, a record whose log write fails is still written by the next compaction
+            self.pending += 1
+            self._make_dirs()
+            # opened per record, another process may have compacted and removed the log meanwhile
+            with file_lock(self.json_path), open(self.log_path, 'a', encoding='utf-8') as log:
+                log.write(json.dumps([pdf_name, reactions_txt], ensure_ascii=False) + '\n')
+                log.flush()
+                os.fsync(log.fileno())
+            if self.pending >= self.compact_every:
+                self._compact()
+            return True
+
+    def compact(self):
+        with self.lock:
+            self._compact()
+
+    def _compact(self):
+        if self.pending == 0 and not os.path.exists(self.log_path):
+            return
+        self._make_dirs()
+        with file_lock(self.json_path):
+            # records of other processes, in the json file or still in the log
+            for key, value in self._load().items():
+                self.results.setdefault(key, value)
+            write_atomic(self.json_path, lambda f: json.dump(self.results, f, indent=4, ensure_ascii=False))
+            # the json file now holds every logged record, replaying them again would be harmless
+            if os.path.exists(self.log_path):
+                os.remove(self.log_path)
+        self.pending = 0
+
+    def _make_dirs(self):
+        directory = os.path.dirname(self.json_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def close(self):
+        self.compact()
@@ -0,0 +1,211 @@
+"""
+Best-route search over the reaction hypergraph, an alternative to enumerating every pathway.
+
+A route to a substance is either the substance itself when it is in stock, or a reaction
+producing it together with a route to each of its reactants. Its cost is
+
+    cost(stock leaf) = stock_cost
+    cost(reaction r with reactant routes R1..Rn) = step cost of r + cost(R1) + ... + cost(Rn)
+
+Routes follow the rules of a Tree branch: a reaction is not used when one of its reactants is
+the substance or one of its ancestors on the route, and reactants are combined as in
+Tree.search_reaction_pathways. Whether a reactant closes a cycle only depends on the nearest
+ancestors inside its strongly connected component (Node.closes_cycle), so the search runs over
+nodes (substance, those ancestors): outside reaction cycles a substance is a single node shared
+by every route, and the node graph is acyclic. The k best routes are enumerated lazily over it
+in the style of Huang and Chiang ("Better k-best parsing", 2005), cheapest first; routes with
+the same reactions as, or all the reactions of, a route found before are dropped like
+Tree.remove_supersets does.
+"""
+import heapq
+
+
+class RouteCosts:
+    """
+    Cost model of a route.
+
+    Args:
+        step_cost: cost of every reaction step
+        stock_cost: cost of every stock leaf of the route
+        source_costs: {source (document name): extra cost of a reaction extracted from it}
+        default_source_cost: extra cost of reactions from sources not in source_costs
+        reaction_costs: {reaction idx: cost replacing step_cost and the source cost}
+    """
+    def __init__(self, step_cost=1.0, stock_cost=0.0, source_costs=None, default_source_cost=0.0,
+                 reaction_costs=None):
+        self.step_cost = step_cost
+        self.stock_cost = stock_cost
+        self.source_costs = source_costs or {}
+        self.default_source_cost = default_source_cost
+        self.reaction_costs = reaction_costs or {}
+
+    def reaction_cost(self, idx, reaction):
+        if idx in self.reaction_costs:
+            return self.reaction_costs[idx]
+        return self.step_cost + self.source_costs.get(reaction.get('source'), self.default_source_cost)
+
+
+class RouteSearch:
+    def __init__(self, network, reactions, root_id, stock_ids, costs=None, solvable_reactions=None):
+        """
+        Args:
+            network: ReactionNetwork
+            reactions: {idx: reaction}, for the per-reaction costs
+            root_id: substance id of the target
+            stock_ids: ids of the stock substances, e.g. from ReactionNetwork.reachable
+            solvable_reactions: bool array over reaction ids of a tree built with prune_unsolvable,
+                the other reactions are not used
+        """
+        self.network = network
+        self.root_id = root_id
+        self.costs = costs or RouteCosts()
+        self.stock_ids = set(stock_ids)
+        self.solvable_reactions = solvable_reactions
+        self.reaction_cost = [self.costs.reaction_cost(idx, reactions[idx]) for idx in network.reaction_keys]
+        # search nodes: (substance id, frozenset of its ancestors that can close a cycle) <-> node id
+        self._node_ids = {}
+        self._node_keys = []
+        # lazy k-best state per node: derivations found so far, candidate heap, candidates pushed
+        self._derivations = {}
+        self._candidates = {}
+        self._pushed = {}
+
+    def _node(self, substance_id, ancestors):
+        key = (substance_id, ancestors)
+        node_id = self._node_ids.get(key)
+        if node_id is None:
+            node_id = self._node_ids[key] = len(self._node_keys)
+            self._node_keys.append(key)
+        return node_id
+
+    def _incoming(self, node_id):
+        """
+        Reactions a Tree node of the substance with these ancestors expands, with the search nodes
+        of the reactants they are combined with; like search_reaction_pathways, a reactant without
+        any route drops the reaction, unless a reactant with a route comes before it
+        """
+        substance_id, ancestors = self._node_keys[node_id]
+        component, cyclic = self.network.components()
+        if cyclic[component[substance_id]]:
+            chain = ancestors | {substance_id}
+        else:
+            chain = frozenset()
+        incoming = []
+        for reaction_id in self.network.producers(substance_id).tolist():
+            if self.solvable_reactions is not None and not self.solvable_reactions[reaction_id]:
+                continue
+            reactant_ids = self.network.reactants(reaction_id).tolist()
+            if not reactant_ids or any(reactant_id in chain for reactant_id in reactant_ids):
+                continue
+            children = []
+            found_route = False
+            for reactant_id in reactant_ids:
+                same_component = chain and component[reactant_id] == component[substance_id]
+                child_id = self._node(reactant_id, chain if same_component else frozenset())
+                if reactant_id in self.stock_ids:
+                    children.append(child_id)
+                elif self._kth(child_id, 0) is not None:
+                    found_route = True
+                    children.append(child_id)
+                elif not found_route:
+                    break
+            else:
+                incoming.append((reaction_id, tuple(children)))
+        return incoming
+
+    def _kth(self, node_id, k):
+        """
+        k-th best derivation (cost, reaction id, child node ids, ranks) of a node, None if there are fewer
+        """
+        if self._node_keys[node_id][0] in self.stock_ids:
+            return (self.costs.stock_cost, None, (), ()) if k == 0 else None
+        derivations = self._derivations.get(node_id)
+        if derivations is None:
+            derivations = self._derivations[node_id] = []
+            candidates = self._candidates[node_id] = []
+            self._pushed[node_id] = set()
+            for reaction_id, child_ids in self._incoming(node_id):
+                ranks = (0,) * len(child_ids)
+                cost = self._cost(reaction_id, child_ids, ranks)
+                if cost is not None:
+                    heapq.heappush(candidates, (cost, reaction_id, child_ids, ranks))
+        candidates = self._candidates[node_id]
+        pushed = self._pushed[node_id]
+        while len(derivations) <= k and candidates:
+            derivation = heapq.heappop(candidates)
+            derivations.append(derivation)
+            _, reaction_id, child_ids, ranks = derivation
+            for i in range(len(ranks)):
+                next_ranks = ranks[:i] + (ranks[i] + 1,) + ranks[i + 1:]
+                if (reaction_id, next_ranks) in pushed:
+                    continue
+                cost = self._cost(reaction_id, child_ids, next_ranks)
+                if cost is not None:
+                    pushed.add((reaction_id, next_ranks))
+                    heapq.heappush(candidates, (cost, reaction_id, child_ids, next_ranks))
+        return derivations[k] if k < len(derivations) else None
+
+    def _cost(self, reaction_id, child_ids, ranks):
+        cost = self.reaction_cost[reaction_id]
+        for child_id, rank in zip(child_ids, ranks):
+            derivation = self._kth(child_id, rank)
+            if derivation is None:
+                return None
+            cost += derivation[0]
+        return cost
+
+    def _route(self, node_id, k):
+        """
+        Reaction idx of the k-th derivation of a node, the root reaction first
+        """
+        _, reaction_id, child_ids, ranks = self._kth(node_id, k)
+        if reaction_id is None:
+            return []
+        route = [self.network.reaction_keys[reaction_id]]
+        for child_id, rank in zip(child_ids, ranks):
+            route.extend(self._route(child_id, rank))
+        return route
+
+    def _root(self):
+        if self.root_id < 0 or self.root_id in self.stock_ids:
+            return None
+        return self._node(self.root_id, frozenset())
+
+    def best_cost(self):
+        root = self._root()
+        derivation = self._kth(root, 0) if root is not None else None
+        return derivation[0] if derivation is not None else None
+
+    def k_best(self, k=5, max_derivations=None):
+        """
+        The k cheapest distinct routes to the root; a route with all the reactions of another
+        route is dropped, so with k large enough these are the pathways of Tree.find_all_paths.
+
+        Returns:
+            [(cost, [reaction idx, ...]), ...] cheapest first, reactions in the order of find_all_paths
+        """
+        root = self._root()
+        if root is None:
+            return []
+        routes = []
+        seen = set()
+        rank = 0
+        while max_derivations is None or rank < max_derivations:
+            derivation = self._kth(root, rank)
+            rank += 1
+            if derivation is None:
+                break
+            # a reaction used twice (shared intermediate) is listed once, like Tree.clean_path
+            route = list(dict.fromkeys(self._route(root, rank - 1)))
+            key = frozenset(route)
+            if key in seen:
+                continue
+            seen.add(key)
+            if any(frozenset(kept) <= key for _, kept in routes):
+                continue
+            # a costlier route may still have fewer reactions than the ones found before
+            routes = [(cost, kept) for cost, kept in routes if not key < frozenset(kept)]
+            routes.append((derivation[0], route))
+            if len(routes) == k:
+                break
+        return routes
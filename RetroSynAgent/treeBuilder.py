@@ -1,18 +1,36 @@
-import copy
 import json
 from graphviz import Digraph
 import time
 import pubchempy
-import pickle
 import os
 import re
 import http.client
 from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from .fileLock import file_lock, write_atomic
+from .name_to_smiles import NameToSMILES, _pubchem_rate_limiter, canonical_smiles, get_smiles_cache
+from .reactionRecord import Reaction, get_reaction_record_store, parse_reactions_text
+from .reactionNetwork import ReactionNetwork
+from .routeSearch import RouteSearch
+
+SMILES_PATTERN = re.compile(r'^[A-Za-z0-9@+\-#\(\)\\/\=\[\]\.%\:?]*$')
+
+
 class CommonSubstanceDB:
+    # stock set and query results are loaded once per process and shared by every tree,
+    # so batch runs over several targets do not re-read emol.json or re-query PubChem
+    _shared_database = None
+    _shared_query_results = None
+
     def __init__(self):
-        self.added_database = self.get_added_database()
-        self.smiles_cache = self.load_dict_from_json("smiles_cache.json")
-        self.common_sub_cache = self.load_dict_from_json("substance_query_result.json")
+        if CommonSubstanceDB._shared_database is None:
+            CommonSubstanceDB._shared_database = self.get_added_database()
+        if CommonSubstanceDB._shared_query_results is None:
+            CommonSubstanceDB._shared_query_results = self.load_dict_from_json("substance_query_result.json")
+        self.added_database = CommonSubstanceDB._shared_database
+        # shared with NameToSMILES so names resolved by either are looked up only once
+        self.smiles_cache = get_smiles_cache("smiles_cache.json")
+        self.common_sub_cache = CommonSubstanceDB._shared_query_results
 
     @staticmethod
     def read_data_from_json(filename):
@@ -62,9 +80,11 @@ class CommonSubstanceDB:
         retries = 0
         while retries < max_retries:
             try:
-                # Try to query PubChem
+                # Try to query PubChem, within its rate limit shared with NameToSMILES
+                _pubchem_rate_limiter.wait()
                 compound = pubchempy.get_compounds(compound_identifier, 'smiles', verify=False)
                 if not compound:
+                    _pubchem_rate_limiter.wait()
                     compound = pubchempy.get_compounds(compound_identifier, 'name',verify=False)
                 if compound:
                     print(f"{compound_identifier} query succeed in pubchem")
@@ -89,9 +109,25 @@ class CommonSubstanceDB:
             return self.smiles_cache[compound_name]
         smiles = self.get_smiles_from_name(compound_name)
         self.smiles_cache[compound_name] = smiles
-        self.save_dict_as_json(self.smiles_cache, "smiles_cache.json")
+        self.smiles_cache.save()
         return smiles
 
+    def prefetch_smiles(self, compound_names):
+        """
+        Resolve the SMILES of every name not cached yet with batched PubChem requests,
+        so the per-node lookups during tree expansion become cache hits.
+
+        Returns:
+            Tuple of (name -> SMILES, names unknown to PubChem) for the names queried
+        """
+        missing = [name for name in compound_names
+                   if name not in self.common_sub_cache and name not in self.smiles_cache
+                   and not SMILES_PATTERN.match(name)]
+        if not missing:
+            return {}, set()
+        # canonical SMILES and unknown names cached as themselves, like get_smiles_from_name
+        return NameToSMILES.convert_many(missing, isomeric=False, cache_unknown=True)
+
     def is_common_chemical_cached(self, compound_name):
         if compound_name in self.common_sub_cache:
             return self.common_sub_cache[compound_name]
@@ -100,18 +136,42 @@ class CommonSubstanceDB:
         self.save_dict_as_json(self.common_sub_cache)
         return result
 
+    def check_many(self, compound_names, max_workers=8):
+        """
+        Stock check of several substances and the query results saved once. The uncached
+        names are first resolved in bulk by prefetch_smiles: a name PubChem resolves is in
+        PubChem, a name it does not know is only checked against the local database. The
+        others are queried concurrently by is_common_chemical, all under the PubChem rate limit.
+        """
+        missing = list(dict.fromkeys(name for name in compound_names if name not in self.common_sub_cache))
+        if missing:
+            resolved, unknown = self.prefetch_smiles(missing)
+            queried = []
+            for name in missing:
+                if name in resolved:
+                    self.common_sub_cache[name] = True
+                elif name in unknown:
+                    self.common_sub_cache[name] = name in self.added_database
+                else:
+                    queried.append(name)
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                for name, result in zip(queried, executor.map(self.is_common_chemical, queried)):
+                    self.common_sub_cache[name] = result
+            self.save_dict_as_json(self.common_sub_cache)
+        return [self.common_sub_cache[name] for name in compound_names]
+
 
     @staticmethod
     def get_smiles_from_name(identifier):
-        smiles_pattern = re.compile(r'^[A-Za-z0-9@+\-#\(\)\\/\=\[\]\.%\:?]*$')
-        if smiles_pattern.match(identifier):
+        if SMILES_PATTERN.match(identifier):
             return identifier
 
         try:
             # Try to get SMILES from PubChem with a timeout
+            _pubchem_rate_limiter.wait()
             compounds = pubchempy.get_compounds(identifier, 'name')
             if compounds:
-                return compounds[0].canonical_smiles
+                return canonical_smiles(compounds[0].canonical_smiles)
             else:
                 print(f"No PubChem results found for '{identifier}'")
                 return identifier
@@ -129,66 +189,268 @@ class CommonSubstanceDB:
             return {}
 
     def save_dict_as_json(self, dict_file, filename="substance_query_result.json"):
-        with open(filename, 'w', encoding='utf-8') as f:
-            json.dump(dict_file, f, ensure_ascii=False, indent=4)
+        # other processes may have saved results meanwhile, they are merged into dict_file
+        with file_lock(filename):
+            for key, value in self.load_dict_from_json(filename).items():
+                dict_file.setdefault(key, value)
+            write_atomic(filename, lambda f: json.dump(dict(dict_file), f, ensure_ascii=False, indent=4))
+
+class TreeStats:
+    """
+    Node counts per depth and leaf count of a tree, updated as nodes are added, removed and found
+    in stock; the route count and the pathways of the tree once computed (None until then or
+    after a change)
+    """
+    __slots__ = ('level_nodes', 'leaves', 'routes', 'pathways')
+
+    def __init__(self):
+        self.level_nodes = []
+        self.leaves = 0
+        self.routes = None
+        self.pathways = None
+
+    @classmethod
+    def count(cls, root):
+        """
+        Stats of an existing tree, for trees whose nodes were not added through add_child
+        """
+        stats = cls()
+        stack = [(root, 0)]
+        while stack:
+            node, depth = stack.pop()
+            stats.add_node(depth)
+            stats.leaves += node.is_leaf
+            stack.extend((child, depth + 1) for child in node.children)
+        return stats
+
+    @property
+    def nodes(self):
+        return sum(self.level_nodes)
+
+    @property
+    def depth(self):
+        """
+        Depth of the deepest node, the root has depth 0
+        """
+        depth = len(self.level_nodes) - 1
+        while depth > 0 and not self.level_nodes[depth]:
+            depth -= 1
+        return depth
+
+    def add_node(self, depth):
+        while depth >= len(self.level_nodes):
+            self.level_nodes.append(0)
+        self.level_nodes[depth] += 1
+        self.changed()
+
+    def add_leaf(self):
+        self.leaves += 1
+        self.changed()
+
+    def remove_subtree(self, node, depth):
+        stack = [(node, depth)]
+        while stack:
+            node, depth = stack.pop()
+            self.level_nodes[depth] -= 1
+            self.leaves -= node.is_leaf
+            stack.extend((child, depth + 1) for child in node.children)
+        self.changed()
+
+    def changed(self):
+        self.routes = None
+        self.pathways = None
+
+    @staticmethod
+    def count_routes(root):
+        """
+        Number of pathways search_reaction_pathways yields, before duplicate reactions and
+        superset pathways are removed, counted in one pass over the tree: the routes of a node
+        are the sum over its reactions of the product of the routes of the reactants, a stock
+        leaf has one (empty) route.
+        """
+        # routes of each node; UNIT is the single empty route of a leaf
+        UNIT = None
+        routes = {}
+        stack = [(root, False)]
+        while stack:
+            node, visited = stack.pop()
+            if node.is_leaf:
+                routes[id(node)] = UNIT
+                continue
+            if not visited:
+                stack.append((node, True))
+                stack.extend((child, False) for child in node.children)
+                continue
+            # the same combination rules as search_reaction_pathways
+            reaction_routes = {}
+            for child in node.children:
+                child_routes = routes.pop(id(child))
+                reaction_idx = child.reaction_index
+                if reaction_idx not in reaction_routes or reaction_routes[reaction_idx] is UNIT:
+                    reaction_routes[reaction_idx] = child_routes
+                elif child_routes is UNIT:
+                    continue
+                elif child_routes:
+                    reaction_routes[reaction_idx] *= child_routes
+            routes[id(node)] = sum(1 if count is UNIT else count for count in reaction_routes.values())
+        count = routes[id(root)]
+        return 1 if count is UNIT else count
+
+
+class TreeContext:
+    """
+    State shared by every node of a tree, referenced once per node instead of copied into each
+    """
+    __slots__ = ('network', 'target_substance', 'cache_func', 'unexpandable_substances', 'solvable_reactions',
+                 'stats')
+
+    def __init__(self, network, target_substance, cache_func=None, unexpandable_substances=None,
+                 solvable_reactions=None):
+        self.network = network
+        self.target_substance = target_substance
+        self.cache_func = cache_func
+        self.unexpandable_substances = unexpandable_substances if unexpandable_substances is not None else set()
+        # bool array over reaction ids from the solvability pre-pass, None expands every reaction
+        self.solvable_reactions = solvable_reactions
+        self.stats = TreeStats()
+
+
+# shared by the nodes without children until their first child is added
+NO_CHILDREN = ()
+
 
 class Node:
-    def __init__(self, substance, reactions, product_dict,
-                 fathers_set=None, father=None, reaction_index=None,
-                 reaction_line=None, cache_func=None, unexpandable_substances=None,
-                 # smiles_converter=None
-                 ):
-        self.reaction_index = reaction_index
-        self.substance = substance
-        self.children = []
-        self.fathers_set = fathers_set if fathers_set is not None else set()
+    """
+    Tree node with only the per-node fields; names, the reaction path and the expansion settings
+    are derived from the tree context. Pickled trees from before these nodes are read by
+    treeStore.load_legacy_tree.
+    """
+    __slots__ = ('substance_id', 'reaction_id', 'father', 'children', 'is_leaf', 'context')
+
+    def __init__(self, substance_id, context, father=None, reaction_id=-1):
+        # interned id in the reaction network, -1 if no reaction mentions the substance (root only)
+        self.substance_id = substance_id
+        # id of the reaction producing the father from this node, -1 for the root
+        self.reaction_id = reaction_id
         self.father = father
-        self.reaction_line = reaction_line if reaction_line is not None else []
+        self.children = NO_CHILDREN
         self.is_leaf = False
-        self.cache_func = cache_func
-        self.reactions = reactions
-        self.product_dict = product_dict
-        self.unexpandable_substances = unexpandable_substances
-        # self.smiles_converter = smiles_converter
-
-    def add_child(self, substance: str, reaction_index: int):
-        curr_child_fathers_set = copy.deepcopy(self.fathers_set)
-        curr_child_fathers_set.add(self.substance)
-        curr_child_reaction_line = copy.deepcopy(self.reaction_line) + [reaction_index]
-        # child = Node(self.smiles_converter(substance),
-        child = Node(substance,
-                     self.reactions, self.product_dict,
-                     fathers_set=curr_child_fathers_set,
-                     father=self,
-                     reaction_index=reaction_index,
-                     reaction_line=curr_child_reaction_line,
-                     cache_func=self.cache_func,
-                     unexpandable_substances=self.unexpandable_substances,
-                     # smiles_converter=self.smiles_converter
-                     )
+        self.context = context
+
+    @property
+    def network(self):
+        return self.context.network
+
+    @property
+    def substance(self):
+        if self.father is None:
+            return self.context.target_substance
+        return self.context.network.substance_names[self.substance_id]
+
+    @property
+    def reaction_index(self):
+        return self.context.network.reaction_keys[self.reaction_id] if self.reaction_id >= 0 else None
+
+    @property
+    def reaction_line(self):
+        """
+        Reaction idx from the root down to this node
+        """
+        line = []
+        node = self
+        while node.father is not None:
+            line.append(node.reaction_index)
+            node = node.father
+        line.reverse()
+        return line
+
+    @property
+    def depth(self):
+        depth = 0
+        node = self
+        while node.father is not None:
+            depth += 1
+            node = node.father
+        return depth
+
+    def add_child(self, substance_id: int, reaction_id: int):
+        child = Node(substance_id, self.context, father=self, reaction_id=reaction_id)
+        self.context.stats.add_node(self.depth + 1)
+        if self.children is NO_CHILDREN:
+            self.children = []
         self.children.append(child)
         return child
 
+    def closes_cycle(self, substance_id):
+        """
+        Whether a substance is this node or one of its ancestors.
+        Both have to be in the same cyclic strongly connected component, and the ancestors inside
+        it are the nearest ones, so only those are walked; outside reaction cycles this is O(1).
+        """
+        component, cyclic = self.context.network.components()
+        component_id = component[substance_id]
+        if not cyclic[component_id]:
+            return False
+        node = self
+        while node is not None and node.substance_id >= 0 and component[node.substance_id] == component_id:
+            if node.substance_id == substance_id:
+                return True
+            node = node.father
+        return False
+
 
-    def remove_child_by_reaction(self, reaction_index: int):
+    def remove_child_by_reaction(self, reaction_id: int):
         """
         Remove children with the same reaction as ancestor nodes (forming a loop)
         This not only deletes the current child node but also deletes sibling nodes with the same reaction (same reaction index)
         """
-        self.children = [child for child in self.children if child.reaction_index != reaction_index]
+        depth = self.depth + 1
+        for child in self.children:
+            if child.reaction_id == reaction_id:
+                self.context.stats.remove_subtree(child, depth)
+        self.children = [child for child in self.children if child.reaction_id != reaction_id] or NO_CHILDREN
 
 
 
+    def expand_reaction(self, reaction_id):
+        """
+        Add the reactants of one reaction producing this substance as child nodes and expand them
+        """
+        # Get the reactants for the reaction that produces the substance, iterate and add as child nodes of the current node
+        reactant_ids = self.context.network.reactants(reaction_id).tolist()
+        # Generate all reactants for the current node substance
+        for reactant_id in reactant_ids:
+            # 1 === Check if the reactant is valid
+            # (1) If the reactant is the current node or one of its ancestors (forming a loop), the reaction is invalid
+            # (self.remove_child_by_reaction removes the child nodes already added for the same reaction index)
+            if self.closes_cycle(reactant_id):
+                self.remove_child_by_reaction(reaction_id)
+                break
+                # child.is_leaf = False
+                # continue
+            # 2 === self.add_child includes: creating the current child node and adding it to self.children.append(child)
+            child = self.add_child(reactant_id, reaction_id)
+            # (2) If the current child node cannot be expanded further (1 cannot be expanded to initial reactants 2 cannot be obtained through existing reactions)
+            # Recursively check if the current child can expand further
+            is_valid = child.expand()  # , init_reactants)
+            # Cannot expand
+            if not is_valid:
+                # self.remove_child_by_reaction(reaction_idx)
+                # break
+                child.is_leaf = False
+                continue
+
     def expand(self) -> bool:
         """
-        reactions {'idx': {'reactants':[], 'products':[], conditions: ''}, ...}
-        product_dict {'product': [idx1, idx2, ...], ...}
+        context.network: ReactionNetwork, reactants and producing reactions of each substance id
         """
+        context = self.context
         # Base conditions:
         # The reactant already belongs to existing reactants, no need to expand further
         # if self.substance in init_reactants:
-        if self.cache_func(self.substance):
+        if context.cache_func(self.substance):
             self.is_leaf = True
+            context.stats.add_leaf()
             # self.visited_substances[self.substance] = True
             # print(f"{self.substance} is accessible")
             print(f'{self.substance} query succeed.')
@@ -197,40 +459,21 @@ class Node:
         else:
             print(f'{self.substance} query failed.')
             # time.sleep(0.1)
-            reactions_idxs = self.product_dict.get(self.substance, [])
+            reaction_ids = context.network.producers(self.substance_id).tolist()
             # The substance cannot be obtained through existing reactions
-            if len(reactions_idxs) == 0:
-                self.unexpandable_substances.add(self.substance)
+            if len(reaction_ids) == 0:
+                context.unexpandable_substances.add(self.substance)
                 # self.visited_substances[self.substance] = False
                 # print(f"{self.substance} cannot be expanded further")
                 return False
             # The substance is not among existing reactants but can be obtained through existing reactions
             else:
                 # Iterate over all reactions that can produce the substance
-                for reaction_idx in reactions_idxs:
-                    # Get the reactants for the reaction that produces the substance, iterate and add as child nodes of the current node
-                    reactants_list = self.reactions[reaction_idx]['reactants']  # ['reactions'][0]
-                    # Generate all reactants for the current node substance
-                    for reactant in reactants_list:
-                        # 1 === self.add_child includes: creating the current child node and adding it to self.children.append(child)
-                        child = self.add_child(reactant, reaction_idx)
-                        # 2 === Check if the current child node is valid
-                        # (1) If the current child node has the same name as ancestor nodes (forming a loop), it is invalid
-                        # (self.remove_child_by_reaction not only removes the current child node but also nodes with the same reaction index)
-                        if child.substance in child.fathers_set:
-                            self.remove_child_by_reaction(reaction_idx)
-                            break
-                            # child.is_leaf = False
-                            # continue
-                        # (2) If the current child node cannot be expanded further (1 cannot be expanded to initial reactants 2 cannot be obtained through existing reactions)
-                        # Recursively check if the current child can expand further
-                        is_valid = child.expand()  # , init_reactants)
-                        # Cannot expand
-                        if not is_valid:
-                            # self.remove_child_by_reaction(reaction_idx)
-                            # break
-                            child.is_leaf = False
-                            continue
+                for reaction_id in reaction_ids:
+                    # a reaction with a reactant that cannot be made from stock never completes a pathway
+                    if context.solvable_reactions is not None and not context.solvable_reactions[reaction_id]:
+                        continue
+                    self.expand_reaction(reaction_id)
 
                 # After checking all reactions that can produce the substance, if "1" all children are invalid (no valid child nodes), cannot synthesize this substance
                 if len(self.children) == 0:
@@ -242,14 +485,28 @@ class Node:
                     return True
 
 class Tree:
-    def __init__(self, target_substance, result_dict=None, reactions_txt=None, reactions=None):
+    def __init__(self, target_substance, result_dict=None, reactions_txt=None, reactions=None,
+                 prune_unsolvable=False):
+        """
+        Args:
+            prune_unsolvable: run the solvability pre-pass before expanding and skip reactions with a
+                reactant that cannot be made from stock. The tree then only holds complete branches,
+                so it is meant for the final trees; trees used to pick expansion targets keep
+                their dead branches.
+        """
+        self.prune_unsolvable = prune_unsolvable
+        # documents already parsed and the idx given to the next parsed reaction, for add_reactions
+        self.parsed_sources = set()
         if reactions:
             self.reactions = reactions
         elif result_dict:
             self.reactions, self.reactions_txt = self.parse_results(result_dict)
         elif reactions_txt:
             self.reactions = self.parse_reactions_txt(reactions_txt)
-        self.product_dict = self.get_product_dict(self.reactions)
+        if not result_dict:
+            self.next_reaction_idx = max([int(idx) for idx in self.reactions if str(idx).isdigit()], default=0) + 1
+        # interned substances and CSR reaction tables used by the expansion
+        self.network = ReactionNetwork(self.reactions)
         self.target_substance = target_substance
         self.reaction_infos = set()
         self.all_path = []
@@ -257,16 +514,115 @@ class Tree:
         # self.chemical_cache = self.load_dict_from_json("substance_query_result.json")
         # self.smiles_cache = self.load_dict_from_json("smiles_cache.json")
         self.unexpandable_substances = set()
-        self.root = Node(target_substance, self.reactions, self.product_dict,
-                         cache_func=self.db.is_common_chemical_cached,
-                         unexpandable_substances=self.unexpandable_substances,
-                         # smiles_converter=self.db.get_smiles_cached
-                         )
+        self.context = TreeContext(self.network, target_substance, cache_func=self.db.is_common_chemical_cached,
+                                   unexpandable_substances=self.unexpandable_substances)
+        self.new_root()
+
+    def new_root(self, node_class=None):
+        """
+        Replace the nodes by a single, not yet expanded root and reset the stats
+        """
+        self.context.stats = TreeStats()
+        self.context.stats.add_node(0)
+        self.root = (node_class or Node)(self.network.substance_id(self.target_substance), self.context)
+        return self.root
+
+    @property
+    def stats(self):
+        """
+        {'nodes', 'leaves', 'depth', 'routes', 'pathways'} of the tree. Node, leaf and depth counts
+        are kept up to date while the tree is built; routes (TreeStats.count_routes) is counted in
+        one pass and cached until the tree changes. pathways is the number of pathways of
+        find_all_paths when they were already enumerated, None otherwise, since enumerating them
+        is exponential.
+        """
+        stats = self.context.stats
+        if stats.routes is None:
+            stats.routes = TreeStats.count_routes(self.root)
+        return {'nodes': stats.nodes, 'leaves': stats.leaves, 'depth': stats.depth, 'routes': stats.routes,
+                'pathways': None if stats.pathways is None else len(stats.pathways)}
 
     def construct_tree(self):
+        substances = set()
+        for reaction in self.reactions.values():
+            substances.update(reaction['reactants'])
+            substances.update(reaction['products'])
+        self.db.prefetch_smiles(substances)
+        if self.prune_unsolvable:
+            self.context.solvable_reactions = self.get_solvable_reactions()
         self.root.expand()
         return self.root
 
+    def get_solvable_reactions(self):
+        """
+        Solvability pre-pass over the reaction network, see ReactionNetwork.solvability.
+        Stock checks are batched per level of the backward search.
+        """
+        names = self.network.substance_names
+        reaction_solvable, unexpandable = self.network.solvability(
+            self.root.substance_id, lambda ids: self.db.check_many([names[i] for i in ids]))
+        self.unexpandable_substances.update(names[i] for i in unexpandable)
+        print(f'Solvability pre-pass: {int(reaction_solvable.sum())} of {self.network.num_reactions} '
+              f'reactions can be completed from stock.')
+        return reaction_solvable
+
+    def add_reactions(self, new_result_dict):
+        """
+        Add the reactions of newly processed documents to an already constructed tree.
+        The reaction network is extended in place and only the nodes whose substance gained
+        producing reactions are expanded further; the rest of the tree is kept.
+
+        Args:
+            new_result_dict: {pdf_name: reactions_txt}, documents parsed before are skipped
+
+        Returns:
+            Dict of the reactions that were added, keyed by reaction idx
+        """
+        new_docs = {pdf_name: reaction for pdf_name, reaction in new_result_dict.items()
+                    if pdf_name not in self.parsed_sources}
+        if not new_docs:
+            return {}
+        new_reactions, new_reactions_txt = self.parse_results(new_docs, start_idx=self.next_reaction_idx)
+        self.reactions.update(new_reactions)
+        self.reactions_txt = getattr(self, 'reactions_txt', '') + new_reactions_txt
+
+        new_producers = self.network.add_reactions(new_reactions)
+        if getattr(self, 'prune_unsolvable', False):
+            # new reactions can make skipped reactions anywhere in the tree solvable, rebuild it
+            self.unexpandable_substances.clear()
+            self.new_root()
+            self.construct_tree()
+            print(f'Added {len(new_reactions)} reactions from {len(new_docs)} documents, rebuilt the pruned tree.')
+            return new_reactions
+
+        substances = set()
+        for reaction in new_reactions.values():
+            substances.update(reaction['reactants'])
+            substances.update(reaction['products'])
+        self.db.prefetch_smiles(substances)
+
+        # collect the nodes to grow before expanding any of them, so new subtrees are not revisited
+        frontier = []
+        queue = deque([self.root])
+        while queue:
+            node = queue.popleft()
+            if node.substance_id < 0:
+                # the substance was not in the network when the node was created
+                node.substance_id = self.network.substance_id(node.substance)
+            if node.substance_id in new_producers and not node.is_leaf:
+                frontier.append(node)
+            queue.extend(node.children)
+        for node in frontier:
+            for reaction_id in new_producers[node.substance_id]:
+                node.expand_reaction(reaction_id)
+            if node.children:
+                # the substance can now be obtained through reactions; when every new reaction was
+                # rejected (e.g. closing a cycle) it stays on the frontier
+                self.unexpandable_substances.discard(node.substance)
+        print(f'Added {len(new_reactions)} reactions from {len(new_docs)} documents, '
+              f'expanded {len(frontier)} nodes.')
+        return new_reactions
+
     def get_product_dict(self, reactions_dict):
         product_dict = {}
         for idx, entry in reactions_dict.items():
@@ -282,73 +638,37 @@ class Tree:
         return product_dict
 
     def parse_reactions_txt(self, reactions_txt):
-        # idx = 1
         # note: v13 adds parsing of Conditions in reaction_txt & retains original Reaction idx instead of re-labeling
-        reactants = []
-        products = []
         reactions_dict = {}
-        lines = reactions_txt.splitlines()
-        for line in lines:
-            line = line.strip()
-            if line.startswith('Reaction idx:'):
-                idx = line.split("Reaction idx:")[1].strip()
-            if line.startswith("Reactants:"):
-                reactants = line.split("Reactants:")[1].strip().split(', ')
-                reactants = [reactant.lower() for reactant in reactants]
-            elif line.startswith("Products:"):
-                products = line.split("Products:")[1].strip().split(', ')
-                products = [product.lower() for product in products]
-            elif line.startswith("Conditions:"):
-                conditions = line.split("Conditions:")[1].strip()
-            elif line.startswith("Source:"):
-                source = line.split("Source:")[1].strip()
-                reactions_dict[str(idx)] = {
-                    'reactants': tuple(reactants),
-                    'products': tuple(products),
-                    'conditions': conditions,
-                    'source': source,
-                }
-                # idx += 1
+        for reaction in parse_reactions_text(reactions_txt):
+            if reaction.idx is not None:
+                reactions_dict[str(reaction.idx)] = reaction
         return reactions_dict
 
     def parse_reactions(self, reactions_txt, idx, pdf_name):
-        # idx = 1
-        reactants = []
-        products = []
         reactions_dict = {}
-        lines = reactions_txt.splitlines()
-        for line in lines:
-            line = line.strip()
-            if line.startswith("Reactants:"):
-                reactants = line.split("Reactants:")[1].strip().split(', ')
-                reactants = [reactant.lower() for reactant in reactants]
-            elif line.startswith("Products:"):
-                products = line.split("Products:")[1].strip().split(', ')
-                products = [product.lower() for product in products]
-            elif line.startswith("Conditions:"):
-                conditions = line.split("Conditions:")[1].strip()
-                reactions_dict[str(idx)] = {
-                    'reactants': tuple(reactants),
-                    'products': tuple(products),
-                    'conditions': conditions,
-                    'source': pdf_name,
-                }
-                idx += 1
+        # parsed once per document, later trees reuse the stored records
+        for reaction in get_reaction_record_store().reactions_for(reactions_txt, source=pdf_name):
+            reaction.idx = str(idx)
+            reactions_dict[str(idx)] = reaction
+            idx += 1
         return reactions_dict, idx
 
-    def parse_results(self, result_dict):
+    def parse_results(self, result_dict, start_idx=1):
         """
         result_dict : gpt_results_40.json
         """
         reactions_txt_all = ''
         reactions = {}
-        idx = 1
+        idx = start_idx
         # for pdf_name, (reaction, property) in result_dict.items():
         for pdf_name, reaction in result_dict.items():
             reactions_txt_all += (reaction + '\n\n')
 
             additional_reactions, idx = self.parse_reactions(reaction, idx, pdf_name)
             reactions.update(additional_reactions)
+            self.parsed_sources.add(pdf_name)
+        self.next_reaction_idx = idx
         return reactions, reactions_txt_all
 
 
@@ -379,6 +699,31 @@ class Tree:
     #     with open(filename, 'w', encoding='utf-8') as f:
     #         json.dump(dict_file, f, ensure_ascii=False, indent=4)
 
+    def get_frontier(self):
+        """
+        Statistics of the unexpandable substances, used to prioritise expansion
+
+        Returns:
+            {substance: {'depth': shallowest depth, 'occurrences': number of nodes,
+                         'unblocks': nodes whose reaction only misses this substance}}
+        """
+        frontier = {}
+        queue = deque([self.root])
+        while queue:
+            node = queue.popleft()
+            queue.extend(node.children)
+            if node.substance not in self.unexpandable_substances or node.is_leaf or node.children:
+                continue
+            depth = node.depth
+            stats = frontier.setdefault(node.substance, {'depth': depth, 'occurrences': 0, 'unblocks': 0})
+            stats['depth'] = min(stats['depth'], depth)
+            stats['occurrences'] += 1
+            if node.father is not None and all(sibling is node or sibling.is_leaf
+                                               for sibling in node.father.children
+                                               if sibling.reaction_id == node.reaction_id):
+                stats['unblocks'] += 1
+        return frontier
+
     def _count_nodes(self, node):
         count = 1
         for child in node.children:
@@ -386,19 +731,22 @@ class Tree:
         return count
 
     def get_node_count(self):
-        return self._count_nodes(self.root)
+        return self.context.stats.nodes
 
-    def get_reactions_in_tree_(self, reaction_idx_list):
-        reactions_tree = ''
+    def get_reaction_records(self, reaction_idx_list):
+        records = {}
         for idx in reaction_idx_list:
-            reactants = self.reactions[idx]['reactants']
-            products = self.reactions[idx]['products']
-            conditions = self.reactions[idx]['conditions']
-            source = self.reactions[idx]['source']
-            reaction_string = (f"Reaction idx: {idx}\nReactants: {', '.join(reactants)}\nProducts: {', '.join(products)}\n"
-                               f"Conditions: {conditions}\nSource: {source}\n\n")
-            reactions_tree += reaction_string
-        return reactions_tree
+            reaction = self.reactions[idx]
+            if not isinstance(reaction, Reaction):
+                # trees pickled before reaction records hold plain dicts
+                reaction = Reaction(reaction['reactants'], reaction['products'], reaction['conditions'],
+                                    reaction.get('source'))
+            reaction.idx = idx
+            records[idx] = reaction
+        return records
+
+    def get_reactions_in_tree_(self, reaction_idx_list):
+        return ''.join(reaction.format() for reaction in self.get_reaction_records(reaction_idx_list).values())
 
 
     def get_reactions_in_tree(self):
@@ -418,6 +766,19 @@ class Tree:
         reactions_tree = self.get_reactions_in_tree_(list(reaction_idx_set))
         return reactions_tree
 
+    def get_reaction_records_in_tree(self):
+        """
+        Reaction records of every reaction in the tree, {idx: Reaction}
+        """
+        reaction_idx_set = set()
+        queue = deque([self.root])
+        while queue:
+            node = queue.popleft()
+            if node.reaction_index is not None:
+                reaction_idx_set.add(node.reaction_index)
+            queue.extend(node.children)
+        return self.get_reaction_records(reaction_idx_set)
+
     def find_all_paths(self):
         """
         class Node:
@@ -434,10 +795,31 @@ class Tree:
         self.fathers_set = fathers_set if fathers_set is not None else set()
         self.reaction_line = reaction_line if reaction_line is not None else []
         """
-        path = self.search_reaction_pathways(self.root)
-        path = self.clean_path(path)
-        path = self.remove_supersets(path)
-        return path
+        stats = self.context.stats
+        if stats.pathways is None:
+            path = self.search_reaction_pathways(self.root)
+            path = self.clean_path(path)
+            stats.pathways = self.remove_supersets(path)
+        return list(stats.pathways)
+
+    def find_best_paths(self, k=5, costs=None):
+        """
+        The k cheapest pathways by RouteSearch, without enumerating every pathway of the tree;
+        with k at least the number of pathways, the pathways of find_all_paths.
+
+        Args:
+            k: number of pathways
+            costs: RouteCosts, by default every reaction step costs 1
+
+        Returns:
+            [(cost, [idx, ...]), ...] cheapest first
+        """
+        names = self.network.substance_names
+        stock, _, _ = self.network.reachable(
+            self.root.substance_id, lambda ids: self.db.check_many([names[i] for i in ids]))
+        search = RouteSearch(self.network, self.reactions, self.root.substance_id, stock, costs,
+                             solvable_reactions=self.context.solvable_reactions)
+        return search.k_best(k)
 
     def search_reaction_pathways(self, node):
         # Termination condition: if it is a leaf node, return an empty path
@@ -485,18 +867,29 @@ class Tree:
             :param data: List of lists, the original data
             :return: The result list after removing larger sets that contain other sets
         """
-        # Convert to list of sets to facilitate subset checking
-        data_sets = [set(sublist) for sublist in data]
+        # Encode each pathway as a bitset of its reactions, a superset test is then a single AND
+        bit_of = {}
+        masks = []
+        for sublist in data:
+            mask = 0
+            for idx in sublist:
+                mask |= 1 << bit_of.setdefault(idx, len(bit_of))
+            masks.append(mask)
+        sizes = [mask.bit_count() if hasattr(mask, 'bit_count') else bin(mask).count('1') for mask in masks]
+        # A set can only contain sets that are not larger than itself
+        by_size = sorted(range(len(masks)), key=sizes.__getitem__)
 
         # Result list to store the kept subsets
         result = []
 
         # Iterate over all the sets
-        for i, current_set in enumerate(data_sets):
+        for i, current_mask in enumerate(masks):
             # Check if the current set is a superset of any other set
             is_superset = False
-            for j, other_set in enumerate(data_sets):
-                if i != j and current_set.issuperset(other_set):
+            for j in by_size:
+                if sizes[j] > sizes[i]:
+                    break
+                if i != j and masks[j] & ~current_mask == 0:
                     is_superset = True
                     break
             # If the current set is not a superset of any other, keep it
@@ -637,13 +1030,37 @@ class Tree:
 
 
 class TreeLoader():
+    """
+    Saves trees in the versioned .npz format of treeStore. Tree names ending in .pkl are
+    mapped to the .npz file of the same name; legacy pickled trees are still read when no
+    .npz file exists.
+    """
+    def exists(self, filename):
+        from .treeStore import tree_path, legacy_path
+        return os.path.exists(tree_path(filename)) or os.path.exists(legacy_path(filename))
+
     def save_tree(self, tree, filename):
-        with open(filename, 'wb') as f:
-            pickle.dump(tree, f)
+        from .treeStore import save_tree
+        filename = save_tree(tree, filename)
         print(f"Tree saved to {filename}")
 
     def load_tree(self, filename):
-        with open(filename, 'rb') as f:
-            tree = pickle.load(f)
+        from .treeStore import tree_path, legacy_path, load_legacy_tree, load_tree
+        if os.path.exists(tree_path(filename)):
+            tree = load_tree(filename)
+            filename = tree_path(filename)
+        else:
+            # legacy pickled tree, converted to the current nodes; only load files you trust
+            filename = legacy_path(filename)
+            tree = load_legacy_tree(filename)
         print(f"Tree loaded from {filename}")
         return tree
+
+    def open_tree(self, filename):
+        """
+        Read-only view of a saved tree (root, get_node_count) without building Tree objects
+        """
+        from .treeStore import TreeFile, tree_path
+        if os.path.exists(tree_path(filename)):
+            return TreeFile(filename)
+        return self.load_tree(filename)
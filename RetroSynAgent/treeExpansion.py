@@ -1,33 +1,33 @@
 import os
 import copy
-import json
 import re
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from . import prompts
 from .treeBuilder import Tree, TreeLoader
 from .pdfDownloader import PDFDownloader
 from .pdfProcessor import PDFProcessor
 from .GPTAPI import GPTAPI
+from .resultsStore import ExpansionResultsStore
+from .expansionScheduler import ExpansionScheduler
+from .reactionRecord import get_reaction_record_store
 
+# Substances retrieved concurrently in one expansion iteration
+RETRIEVAL_WORKERS = int(os.getenv("EXPANSION_RETRIEVAL_WORKERS", "4"))
+# Documents parsed and sent to the LLM concurrently
+EXTRACTION_WORKERS = int(os.getenv("EXPANSION_EXTRACTION_WORKERS", "4"))
+# Retrieved documents waiting for extraction; retrieval blocks when the queue is full
+EXTRACTION_QUEUE_SIZE = 16
+# Concurrent downloads per document source; scholar search is rate limited, so papers run one at a time
+_source_slots = {
+    'patent': threading.BoundedSemaphore(int(os.getenv("EXPANSION_PATENT_SLOTS", "2"))),
+    'paper': threading.BoundedSemaphore(int(os.getenv("EXPANSION_PAPER_SLOTS", "1"))),
+}
+_STOP = object()
 
-class TreeExpansion:
-    def update_json_file(self, add_results_filepath, add_results):
-        # If the file exists, read the file content first
-        if os.path.exists(add_results_filepath):
-            with open(add_results_filepath, 'r') as f:
-                try:
-                    existing_data = json.load(f)
-                except json.JSONDecodeError:
-                    existing_data = {}  # Initialize as an empty dictionary if the file is empty or corrupted
-        else:
-            existing_data = {}
-        # Update existing data
-        existing_data.update(add_results)
-        existing_data = self.update_dict(existing_data, add_results)
-
-        # Write the updated data back to the file
-        with open(add_results_filepath, 'w') as f:
-            json.dump(existing_data, f, indent=4, ensure_ascii=False)
 
+class TreeExpansion:
     def update_dict(self, dict_1, dict_2):
         dict1 = dict_1.copy()
         dict2 = dict_2.copy()
@@ -36,210 +36,312 @@ class TreeExpansion:
                 dict1[key] = value
         return dict1
 
-    def expand_reactions_from_literature(self, result_folder_name, result_json_name, material, origin_result_dict, max_iter=10, retrieval_mode="patent-paper", smiles=None):
+    def retrieve_literature(self, substance, literature_add_folder, retrieval_mode="patent-paper"):
+        """
+        Download additional documents about an unexpandable substance.
+
+        Returns:
+            (pdf_folder_path, pdf_name_list) of the newly downloaded documents
+        """
+        pdf_name_list = []
+        attempt_iter = 0
+        pdf_folder_path = f'{literature_add_folder}/pdf_add_' + substance
+
+        # # num of pdf in pdf_folder_path is 0
+        # if (not os.path.exists(pdf_folder_path)) or (len(os.listdir(pdf_folder_path)) == 0):
+        #     while len(pdf_name_list) == 0:
+        #         attempt_iter += 1
+        #         downloader = PDFDownloader(substance, pdf_folder_name=pdf_folder_path,
+        #                                    num_results=attempt_iter, n_thread=3)
+        #         pdf_name_list = downloader.main()
+        #         if attempt_iter >= 3:
+        #             print(f'Fail to download additional PDFs for {substance} after 3 attempts.')
+        #             break
+        #     print(f'Successfully downloaded {len(pdf_name_list)} PDFs for {substance}')
+        # # num of pdf in pdf_folder_path is not 0
+        # else:
+        #     # Traverse all files in the folder
+        #     for file_name in os.listdir(pdf_folder_path):
+        #         # Check if the file extension is .pdf
+        #         if file_name.endswith(".pdf"):
+        #             pdf_name_list.append(file_name)
+
+        if not os.path.exists(pdf_folder_path):
+            os.makedirs(pdf_folder_path, exist_ok=True)
+
+        # If the number of PDFs in the folder is less than 3, try downloading
+        while len(os.listdir(pdf_folder_path)) < 3 and attempt_iter < 3:
+            attempt_iter += 1
+
+            # Determine expansion document source based on retrieval_mode
+            if retrieval_mode == "both-both":
+                # Use both patent and paper downloaders for expansion
+                from .patentPDFDownloader import PatentPDFDownloader
+                from .name_to_smiles import NameToSMILES
+
+                # Try to convert substance name to SMILES for patent search
+                valid_smiles = False
+                substance_smiles = substance
+
+                # Check if it already looks like a SMILES string
+                if re.search(r"[=#@\\/\[\]]|^[Cc][1-9]=|\.|\.\.\.|\.\\..", substance):
+                    valid_smiles = True
+                else:
+                    # Try to convert to SMILES
+                    print(f"Converting {substance} to SMILES for patent search...")
+                    success, conversion = NameToSMILES.convert(substance)
+                    if success:
+                        substance_smiles = conversion
+                        valid_smiles = True
+                        print(f"Successfully converted '{substance}' to SMILES: {substance_smiles}")
+                    else:
+                        print(f"Warning: Could not convert '{substance}' to SMILES: {conversion}")
+                        print(f"Cannot use patent search for this substance. Will only use academic paper search.")
+                        valid_smiles = False
+
+                # First try patent search if we have a valid SMILES
+                patent_pdf_list = []
+                if valid_smiles:
+                    try:
+                        # For both-both mode, use half the attempt_iter for each source
+                        patents_to_retrieve = max(1, attempt_iter // 2)
+                        downloader = PatentPDFDownloader(pdf_folder_name=pdf_folder_path, max_patents=patents_to_retrieve)
+                        with _source_slots['patent']:
+                            patent_pdf_list = downloader.process_smile(substance_smiles)
+                        print(f"Downloaded {len(patent_pdf_list)} patent PDFs for expansion of {substance}")
+                    except ValueError as e:
+                        print(f"Error with patent search: {str(e)}")
+                        print("Will still proceed with academic paper search.")
+
+                # Then do academic paper search
+                papers_to_retrieve = max(1, attempt_iter - len(patent_pdf_list))
+                downloader = PDFDownloader(substance, pdf_folder_name=pdf_folder_path,
+                                       num_results=papers_to_retrieve, n_thread=3)
+                with _source_slots['paper']:
+                    paper_pdf_list = downloader.main()
+                print(f"Downloaded {len(paper_pdf_list)} academic paper PDFs for expansion of {substance}")
+
+                # Combine the results
+                pdf_name_list = patent_pdf_list + paper_pdf_list
+                print(f"Total PDFs downloaded for expansion: {len(pdf_name_list)} ({len(patent_pdf_list)} patents, {len(paper_pdf_list)} papers)")
+
+            elif retrieval_mode.endswith("patent"):
+                # Use patent downloader for expansion
+                from .patentPDFDownloader import PatentPDFDownloader
+                from .name_to_smiles import NameToSMILES
+
+                # Try to convert substance name to SMILES
+                valid_smiles = False
+                substance_smiles = substance
+
+                # Check if it already looks like a SMILES string
+                if re.search(r"[=#@\\/\[\]]|^[Cc][1-9]=|\.|\.\.\.|\.\\..", substance):
+                    valid_smiles = True
+                else:
+                    # Try to convert to SMILES
+                    print(f"Converting {substance} to SMILES for patent search...")
+                    success, conversion = NameToSMILES.convert(substance)
+                    if success:
+                        substance_smiles = conversion
+                        valid_smiles = True
+                        print(f"Successfully converted '{substance}' to SMILES: {substance_smiles}")
+                    else:
+                        print(f"Warning: Could not convert '{substance}' to SMILES: {conversion}")
+                        print(f"Cannot use patent search for this substance. Falling back to academic paper search.")
+                        valid_smiles = False
+
+                # Only use PatentPDFDownloader if we have a valid SMILES
+                if valid_smiles:
+                    try:
+                        downloader = PatentPDFDownloader(pdf_folder_name=pdf_folder_path, max_patents=attempt_iter)
+                        with _source_slots['patent']:
+                            pdf_name_list = downloader.process_smile(substance_smiles)
+                        print(f"Downloaded {len(pdf_name_list)} patent PDFs for expansion of {substance}")
+                    except ValueError as e:
+                        print(f"Error with patent search: {str(e)}")
+                        print("Falling back to academic paper search.")
+                        # Fall back to academic paper search
+                        downloader = PDFDownloader(substance, pdf_folder_name=pdf_folder_path,
+                                               num_results=attempt_iter, n_thread=3)
+                        with _source_slots['paper']:
+                            pdf_name_list = downloader.main()
+                        print(f"Downloaded {len(pdf_name_list)} academic paper PDFs for expansion of {substance}")
+                else:
+                    # Fall back to academic paper search if no valid SMILES
+                    downloader = PDFDownloader(substance, pdf_folder_name=pdf_folder_path,
+                                           num_results=attempt_iter, n_thread=3)
+                    with _source_slots['paper']:
+                        pdf_name_list = downloader.main()
+                    print(f"Downloaded {len(pdf_name_list)} academic paper PDFs for expansion of {substance}")
+            else:
+                # Use academic paper downloader for expansion
+                downloader = PDFDownloader(substance, pdf_folder_name=pdf_folder_path,
+                                           num_results=attempt_iter, n_thread=3)
+                with _source_slots['paper']:
+                    pdf_name_list = downloader.main()
+                print(f"Downloaded {len(pdf_name_list)} academic paper PDFs for expansion of {substance}")
+
+        # Determine whether the download is successful based on the last file number
+        if len(os.listdir(pdf_folder_path)) < 3:
+            print(f'Fail to download at least 3 PDFs for {substance} after {attempt_iter} attempts.')
+        else:
+            print(f'Successfully downloaded {len(os.listdir(pdf_folder_path))} PDFs for {substance}')
+        return pdf_folder_path, pdf_name_list
+
+    def extract_reactions(self, substance, pdf_folder_path, pdf_name, budget=None):
+        """
+        Extract the reactions of one document with the LLM.
+
+        Returns:
+            reactions text of the document, None if the document does not fit in the budget
+        """
+        if budget is not None and not budget.take_document():
+            print(f'Skipping {pdf_name.replace(".pdf", "")}: expansion budget of this iteration is spent.')
+            return None
+        # Ensure we don't duplicate the path
+        if pdf_name.startswith(pdf_folder_path):
+            pdf_path = pdf_name
+        else:
+            pdf_path = os.path.join(pdf_folder_path, pdf_name)
+        # pdf_path = 'literature_add_folder/pdf_add_substancesName/literatureTitle.pdf'
+        pdf_processor = PDFProcessor()
+        long_string = pdf_processor.pdf_to_long_string(pdf_path)
+        total_length = len(long_string)
+        if budget is not None and not budget.take_tokens(long_string):
+            print(f'Skipping {pdf_name.replace(".pdf", "")}: too long for the expansion budget of this iteration.')
+            return None
+        print(f'Processing: {pdf_name.replace(".pdf", "")}, TXT Length: {total_length}')
+        prompt = prompts.prompt_add_reactions_from_literature_cot.format(material=substance)
+        llm = GPTAPI()
+        response = llm.answer_wo_vision(prompt, content=long_string)
+        #
+        ans_reaction = pdf_processor.replace_zeros_in_reactants_and_products(response)
+        ans_reaction = ans_reaction.split("Final Output:")[-1].strip()
+        # parse the reactions once now, trees built from this result reuse the records
+        get_reaction_record_store().reactions_for(ans_reaction, source=pdf_name.replace('.pdf', ''))
+        return ans_reaction
+
+    def expand_substances(self, substances, literature_add_folder, results_store, add_results_new,
+                          retrieval_mode="patent-paper", budget=None, deferred=None):
+        """
+        Retrieve and extract literature for all frontier substances concurrently.
+
+        Retrieval runs in parallel across substances, limited per document source; every
+        retrieved document goes through a bounded queue to the extraction workers, so
+        extraction starts while other substances are still downloading.
+        The new reactions are added to add_results_new and results_store.
+
+        Args:
+            deferred: list of (substance, pdf_folder_path, pdf_name) of documents skipped for the
+                budget; they are extracted before the new documents and the documents skipped
+                this time are put back in it
+        """
+        claimed = set()
+        results_lock = threading.Lock()
+        documents = queue.Queue(maxsize=EXTRACTION_QUEUE_SIZE)
+        carried = list(deferred or [])
+        if deferred is not None:
+            deferred.clear()
+
+        def retrieve(substance):
+            pdf_folder_path, pdf_name_list = self.retrieve_literature(substance, literature_add_folder, retrieval_mode)
+            # get pdfs in pdf_folder_path (new-downloaded)
+            for pdf_name in pdf_name_list:
+                documents.put((substance, pdf_folder_path, pdf_name))
+
+        def extract():
+            while True:
+                item = documents.get()
+                if item is _STOP:
+                    return
+                substance, pdf_folder_path, pdf_name = item
+                pdf_name_wo_suffix = pdf_name.replace('.pdf', '')
+                with results_lock:
+                    is_new = pdf_name_wo_suffix not in results_store and pdf_name_wo_suffix not in claimed
+                    claimed.add(pdf_name_wo_suffix)
+                if not is_new:
+                    print(f'{pdf_name_wo_suffix} has been processsed.')
+                    continue
+                skipped = False
+                try:
+                    ans_reaction = self.extract_reactions(substance, pdf_folder_path, pdf_name, budget)
+                    skipped = ans_reaction is None
+                except Exception as e:
+                    print(f'Failed to extract reactions from {pdf_name_wo_suffix}: {str(e)}')
+                    ans_reaction = None
+                if ans_reaction is None:
+                    # may be retrieved again in a later iteration, skipped documents are carried over
+                    with results_lock:
+                        claimed.discard(pdf_name_wo_suffix)
+                        if skipped and deferred is not None:
+                            deferred.append(item)
+                    continue
+                # logged to disk right away, the add results json file is rewritten only on compaction
+                try:
+                    results_store.add(pdf_name_wo_suffix, ans_reaction)
+                except Exception as e:
+                    # the worker keeps draining the queue; the store holds the result in memory
+                    # and writes it with the next compaction
+                    print(f'Failed to log the reactions of {pdf_name_wo_suffix}: {str(e)}')
+                with results_lock:
+                    add_results_new[pdf_name_wo_suffix] = ans_reaction
+
+        extractors = [threading.Thread(target=extract, daemon=True) for _ in range(EXTRACTION_WORKERS)]
+        for extractor in extractors:
+            extractor.start()
+        try:
+            for item in carried:
+                documents.put(item)
+            with ThreadPoolExecutor(max_workers=max(1, min(RETRIEVAL_WORKERS, len(substances)))) as executor:
+                futures = {executor.submit(retrieve, substance): substance for substance in substances}
+                for future in as_completed(futures):
+                    try:
+                        future.result()
+                    except Exception as e:
+                        print(f'Failed to retrieve literature for {futures[future]}: {str(e)}')
+        finally:
+            for _ in extractors:
+                documents.put(_STOP)
+            for extractor in extractors:
+                extractor.join()
+
+    def expand_reactions_from_literature(self, result_folder_name, result_json_name, material, origin_result_dict, max_iter=10, retrieval_mode="patent-paper", smiles=None, scheduler=None):
         add_results_filepath = result_folder_name + '/' + result_json_name + '_add.json'
         literature_add_folder = 'pdf_add'
         os.makedirs(literature_add_folder, exist_ok=True)
         result_dict = copy.deepcopy(origin_result_dict)
         # additional_reactions_txt = ''
         add_results_new = {}
-        result = False
-        unexpandable_substances = set()
         iteration = 1
-        # Exit the while loop if result is true and unexpandable_substances is an empty set.
-        # Enter the loop if result is false or unexpandable_substances is not an empty set.
+        # The tree is built once and grown with the reactions of each new batch of documents.
+        tree = Tree(material.lower(), result_dict = result_dict)
+        tree.construct_tree()
+        results_store = ExpansionResultsStore(add_results_filepath)
+        if scheduler is None:
+            scheduler = ExpansionScheduler()
 
-        while not result or unexpandable_substances:
+        while True:
             print(f'Iteration: {iteration}')
-            # 3. build graph & tree
-            # tree = Tree(material.lower(), reactions_txt=reactions_text)
-            if add_results_new:
-                # result_dict.update(add_results_new)
-                result_dict = self.update_dict(result_dict, add_results_new)
-            tree = Tree(material.lower(), result_dict = result_dict)
-            result = tree.construct_tree()
-
             if tree.unexpandable_substances != set():
                 unexp_subs_list = list(tree.unexpandable_substances)  # set -> list
                 print(f"Unexpandable substances: {', '.join(unexp_subs_list)}")
-                print(f'Now search for additional literature on these unexpandable intermediates.')
-                for substance in unexp_subs_list:
-                    pdf_name_list = []
-                    attempt_iter = 0
-                    pdf_folder_path = f'{literature_add_folder}/pdf_add_' + substance
-
-                    # # num of pdf in pdf_folder_path is 0
-                    # if (not os.path.exists(pdf_folder_path)) or (len(os.listdir(pdf_folder_path)) == 0):
-                    #     while len(pdf_name_list) == 0:
-                    #         attempt_iter += 1
-                    #         downloader = PDFDownloader(substance, pdf_folder_name=pdf_folder_path,
-                    #                                    num_results=attempt_iter, n_thread=3)
-                    #         pdf_name_list = downloader.main()
-                    #         if attempt_iter >= 3:
-                    #             print(f'Fail to download additional PDFs for {substance} after 3 attempts.')
-                    #             break
-                    #     print(f'Successfully downloaded {len(pdf_name_list)} PDFs for {substance}')
-                    # # num of pdf in pdf_folder_path is not 0
-                    # else:
-                    #     # Traverse all files in the folder
-                    #     for file_name in os.listdir(pdf_folder_path):
-                    #         # Check if the file extension is .pdf
-                    #         if file_name.endswith(".pdf"):
-                    #             pdf_name_list.append(file_name)
-
-                    if not os.path.exists(pdf_folder_path):
-                        os.makedirs(pdf_folder_path, exist_ok=True)
-
-                    # If the number of PDFs in the folder is less than 3, try downloading
-                    while len(os.listdir(pdf_folder_path)) < 3 and attempt_iter < 3:
-                        attempt_iter += 1
-
-                        # Determine expansion document source based on retrieval_mode
-                        if retrieval_mode == "both-both":
-                            # Use both patent and paper downloaders for expansion
-                            from .patentPDFDownloader import PatentPDFDownloader
-                            from .name_to_smiles import NameToSMILES
-
-                            # Try to convert substance name to SMILES for patent search
-                            valid_smiles = False
-                            substance_smiles = substance
-
-                            # Check if it already looks like a SMILES string
-                            if re.search(r"[=#@\\/\[\]]|^[Cc][1-9]=|\.|\.\.\.|\.\\..", substance):
-                                valid_smiles = True
-                            else:
-                                # Try to convert to SMILES
-                                print(f"Converting {substance} to SMILES for patent search...")
-                                success, result = NameToSMILES.convert(substance)
-                                if success:
-                                    substance_smiles = result
-                                    valid_smiles = True
-                                    print(f"Successfully converted '{substance}' to SMILES: {substance_smiles}")
-                                else:
-                                    print(f"Warning: Could not convert '{substance}' to SMILES: {result}")
-                                    print(f"Cannot use patent search for this substance. Will only use academic paper search.")
-                                    valid_smiles = False
-
-                            # First try patent search if we have a valid SMILES
-                            patent_pdf_list = []
-                            if valid_smiles:
-                                try:
-                                    # For both-both mode, use half the attempt_iter for each source
-                                    patents_to_retrieve = max(1, attempt_iter // 2)
-                                    downloader = PatentPDFDownloader(pdf_folder_name=pdf_folder_path, max_patents=patents_to_retrieve)
-                                    patent_pdf_list = downloader.process_smile(substance_smiles)
-                                    print(f"Downloaded {len(patent_pdf_list)} patent PDFs for expansion of {substance}")
-                                except ValueError as e:
-                                    print(f"Error with patent search: {str(e)}")
-                                    print("Will still proceed with academic paper search.")
-
-                            # Then do academic paper search
-                            papers_to_retrieve = max(1, attempt_iter - len(patent_pdf_list))
-                            downloader = PDFDownloader(substance, pdf_folder_name=pdf_folder_path,
-                                                   num_results=papers_to_retrieve, n_thread=3)
-                            paper_pdf_list = downloader.main()
-                            print(f"Downloaded {len(paper_pdf_list)} academic paper PDFs for expansion of {substance}")
-
-                            # Combine the results
-                            pdf_name_list = patent_pdf_list + paper_pdf_list
-                            print(f"Total PDFs downloaded for expansion: {len(pdf_name_list)} ({len(patent_pdf_list)} patents, {len(paper_pdf_list)} papers)")
-
-                        elif retrieval_mode.endswith("patent"):
-                            # Use patent downloader for expansion
-                            from .patentPDFDownloader import PatentPDFDownloader
-                            from .name_to_smiles import NameToSMILES
-
-                            # Try to convert substance name to SMILES
-                            valid_smiles = False
-                            substance_smiles = substance
-
-                            # Check if it already looks like a SMILES string
-                            if re.search(r"[=#@\\/\[\]]|^[Cc][1-9]=|\.|\.\.\.|\.\\..", substance):
-                                valid_smiles = True
-                            else:
-                                # Try to convert to SMILES
-                                print(f"Converting {substance} to SMILES for patent search...")
-                                success, result = NameToSMILES.convert(substance)
-                                if success:
-                                    substance_smiles = result
-                                    valid_smiles = True
-                                    print(f"Successfully converted '{substance}' to SMILES: {substance_smiles}")
-                                else:
-                                    print(f"Warning: Could not convert '{substance}' to SMILES: {result}")
-                                    print(f"Cannot use patent search for this substance. Falling back to academic paper search.")
-                                    valid_smiles = False
-
-                            # Only use PatentPDFDownloader if we have a valid SMILES
-                            if valid_smiles:
-                                try:
-                                    downloader = PatentPDFDownloader(pdf_folder_name=pdf_folder_path, max_patents=attempt_iter)
-                                    pdf_name_list = downloader.process_smile(substance_smiles)
-                                    print(f"Downloaded {len(pdf_name_list)} patent PDFs for expansion of {substance}")
-                                except ValueError as e:
-                                    print(f"Error with patent search: {str(e)}")
-                                    print("Falling back to academic paper search.")
-                                    # Fall back to academic paper search
-                                    downloader = PDFDownloader(substance, pdf_folder_name=pdf_folder_path,
-                                                           num_results=attempt_iter, n_thread=3)
-                                    pdf_name_list = downloader.main()
-                                    print(f"Downloaded {len(pdf_name_list)} academic paper PDFs for expansion of {substance}")
-                            else:
-                                # Fall back to academic paper search if no valid SMILES
-                                downloader = PDFDownloader(substance, pdf_folder_name=pdf_folder_path,
-                                                       num_results=attempt_iter, n_thread=3)
-                                pdf_name_list = downloader.main()
-                                print(f"Downloaded {len(pdf_name_list)} academic paper PDFs for expansion of {substance}")
-                        else:
-                            # Use academic paper downloader for expansion
-                            downloader = PDFDownloader(substance, pdf_folder_name=pdf_folder_path,
-                                                       num_results=attempt_iter, n_thread=3)
-                            pdf_name_list = downloader.main()
-                            print(f"Downloaded {len(pdf_name_list)} academic paper PDFs for expansion of {substance}")
+                # best-first: only the most promising substances are searched this iteration
+                selected = scheduler.select(tree.get_frontier())
+                if not selected and not scheduler.deferred:
+                    print('exit loop because every unexpandable substance has been attempted')
+                    break
+                print(f"Now search for additional literature on: {', '.join(selected)}")
+                if scheduler.deferred:
+                    print(f'{len(scheduler.deferred)} documents deferred from the last iteration.')
+                num_add_results = len(add_results_new)
+                self.expand_substances(selected, literature_add_folder, results_store,
+                                       add_results_new, retrieval_mode, budget=scheduler.new_budget(),
+                                       deferred=scheduler.deferred)
 
-                    # Determine whether the download is successful based on the last file number
-                    if len(os.listdir(pdf_folder_path)) < 3:
-                        print(f'Fail to download at least 3 PDFs for {substance} after {attempt_iter} attempts.')
-                    else:
-                        print(f'Successfully downloaded {len(os.listdir(pdf_folder_path))} PDFs for {substance}')
-
-                    # If there are (or newly downloaded) at least 3 PDFs, you can process them further
-                    # if len(os.listdir(pdf_folder_path)) >= 3:
-                    # for file_name in os.listdir(pdf_folder_path):
-                    #     if file_name.endswith(".pdf"):
-                    #         pdf_name_list.append(file_name)
-
-                    # ========================================================================================
-
-                    # get pdfs in pdf_folder_path (either new-downloaded or original)
-                    for pdf_name in pdf_name_list:
-                        pdf_name_wo_suffix = pdf_name.replace('.pdf', '')
-                        try:
-                            with open(add_results_filepath, 'r') as f:
-                                origin_add_results = json.load(f)
-                        except (FileNotFoundError, json.JSONDecodeError):
-                            origin_add_results = {}
-                        if pdf_name_wo_suffix not in origin_add_results:
-                            # Ensure we don't duplicate the path
-                            if pdf_name.startswith(pdf_folder_path):
-                                pdf_path = pdf_name
-                            else:
-                                pdf_path = os.path.join(pdf_folder_path, pdf_name)
-                            # pdf_path = 'literature_add_folder/pdf_add_substancesName/literatureTitle.pdf'
-                            pdf_processor = PDFProcessor()
-                            long_string = pdf_processor.pdf_to_long_string(pdf_path)
-                            total_length = len(long_string)
-                            print(f'Processing: {pdf_name_wo_suffix}, TXT Length: {total_length}')
-                            prompt = prompts.prompt_add_reactions_from_literature_cot.format(material=substance)
-                            llm = GPTAPI()
-                            response = llm.answer_wo_vision(prompt, content=long_string)
-                            #
-                            ans_reaction = pdf_processor.replace_zeros_in_reactants_and_products(response)
-                            ans_reaction = ans_reaction.split("Final Output:")[-1].strip()
-                            add_results_new[pdf_name_wo_suffix] = ans_reaction
-                            # update add results json file
-                            self.update_json_file(add_results_filepath, add_results_new)
-                        else:
-                            print(f'{pdf_name_wo_suffix} has been processsed.')
+                if len(add_results_new) > num_add_results:
+                    # re-expand only the nodes whose substance gained reactions
+                    tree.add_reactions(add_results_new)
+                scheduler.record_attempts(selected, tree.unexpandable_substances)
 
                 iteration += 1
                 if iteration == max_iter:
@@ -247,21 +349,21 @@ class TreeExpansion:
                     break
             # else: unexpandable_substances == set()
             else:
-                # If there are no unexpanded substances, set unexpandable_substances to an empty set
-                # This is the key to exiting the loop
-                unexpandable_substances = set()
-
                 print('exit loop because set is empty')
+                break
+        results_store.close()
         return add_results_new
 
 
-    def treeExpansion(self, result_folder_name, result_json_name, results_dict, material, expansion=False, max_iter=10, retrieval_mode="patent-paper", smiles=None):
+    def treeExpansion(self, result_folder_name, result_json_name, results_dict, material, expansion=False, max_iter=10, retrieval_mode="patent-paper", smiles=None, scheduler=None):
         add_results_filepath = result_folder_name + '/' + result_json_name + '_add.json'
-        if os.path.exists(add_results_filepath):
-            with open(add_results_filepath, 'r') as file:
-                add_results = json.load(file)
-                # results_dict.update(add_results)
-                results_dict = self.update_dict(results_dict, add_results)
+        results_store = ExpansionResultsStore(add_results_filepath)
+        if os.path.exists(add_results_filepath) or os.path.exists(results_store.log_path):
+            # also recovers results logged by a run that stopped before compacting
+            results_store.close()
+            add_results = results_store.as_dict()
+            # results_dict.update(add_results)
+            results_dict = self.update_dict(results_dict, add_results)
             print(f'Total: {len(results_dict)} articles.')
         else:
             add_results = {}
@@ -274,7 +376,8 @@ class TreeExpansion:
                                                                     origin_result_dict = results_dict,
                                                                     max_iter = max_iter,
                                                                     retrieval_mode = retrieval_mode,
-                                                                    smiles = smiles)
+                                                                    smiles = smiles,
+                                                                    scheduler = scheduler)
             if add_results_new:
                 # add_results.update(add_results_new)
                 add_results = self.update_dict(add_results, add_results_new)
@@ -0,0 +1,395 @@
+"""
+Versioned .npz format for retrosynthetic trees, written and read without pickle.
+
+Members (all plain NumPy arrays, loaded with allow_pickle=False):
+- version                    int32[1], FORMAT_VERSION
+- meta                       utf-8 JSON: target substance, parsed sources, next reaction idx, unexpandable substances,
+                             whether unsolvable reactions were pruned
+- substances, substances_offsets
+                             utf-8 blob + int64 offsets of the substance name table
+- reaction_keys, reaction_conditions, reaction_sources (+ _offsets)
+                             reaction idx strings and texts, one row per reaction
+- reactant_offsets, reactant_indices, product_offsets, product_indices
+                             CSR reactants / products of each reaction, as substance table rows
+- node_parent, node_substance, node_reaction, node_leaf
+                             nodes in preorder: parent row (-1 for the root), substance row,
+                             reaction row that produced the node (-1 for the root), stock leaf flag
+
+Members are memory-mapped from the uncompressed .npz file and only read when accessed, so
+TreeFile can answer node counts or build a display view without reading the reaction table
+or creating Tree/Node objects.
+
+Pickled trees from before this format (tree_pi/*.pkl) are converted by load_legacy_tree, or in
+place with `python -m RetroSynAgent.treeStore tree_pi/*.pkl`.
+"""
+import collections
+import copyreg
+import json
+import os
+import pickle
+import struct
+import zipfile
+
+import numpy as np
+
+FORMAT_VERSION = 1
+TREE_SUFFIX = '.npz'
+LEGACY_SUFFIX = '.pkl'
+
+
+def _encode_strings(strings):
+    encoded = [s.encode('utf-8') for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(s) for s in encoded], out=offsets[1:])
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+
+def _decode_strings(blob, offsets):
+    data = blob.tobytes()
+    offsets = offsets.tolist()
+    return [data[offsets[i]:offsets[i + 1]].decode('utf-8') for i in range(len(offsets) - 1)]
+
+
+class _MappedNpz:
+    """
+    Members of an uncompressed .npz (as written by save_tree) memory-mapped from the file, so
+    only the parts of a member that are used are read. np.load ignores mmap_mode for .npz files.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.members = {}
+        with zipfile.ZipFile(filename) as archive, open(filename, 'rb') as f:
+            for info in archive.infolist():
+                if info.compress_type != zipfile.ZIP_STORED:
+                    raise ValueError(f"{filename} has compressed members")
+                # local file header: 30 bytes, then the file name and the extra field
+                f.seek(info.header_offset + 26)
+                name_length, extra_length = struct.unpack('<HH', f.read(4))
+                f.seek(info.header_offset + 30 + name_length + extra_length)
+                version = np.lib.format.read_magic(f)
+                if version == (1, 0):
+                    shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+                elif version == (2, 0):
+                    shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+                else:
+                    raise ValueError(f"{filename} has .npy members of version {version}")
+                self.members[info.filename[:-len('.npy')]] = (shape, fortran_order, dtype, f.tell())
+
+    def __getitem__(self, member):
+        shape, fortran_order, dtype, offset = self.members[member]
+        if not all(shape):
+            return np.empty(shape, dtype=dtype)
+        return np.memmap(self.filename, dtype=dtype, mode='r', shape=shape, offset=offset,
+                         order='F' if fortran_order else 'C')
+
+
+def _open_npz(filename):
+    try:
+        return _MappedNpz(filename)
+    except ValueError:
+        # compressed files of other writers
+        return np.load(filename, allow_pickle=False)
+
+
+def tree_path(filename):
+    """
+    Path of the .npz tree file for a tree name, accepting the legacy .pkl names
+    """
+    stem, suffix = os.path.splitext(filename)
+    return stem + TREE_SUFFIX if suffix in (TREE_SUFFIX, LEGACY_SUFFIX) else filename + TREE_SUFFIX
+
+
+def legacy_path(filename):
+    return os.path.splitext(tree_path(filename))[0] + LEGACY_SUFFIX
+
+
+def save_tree(tree, filename):
+    filename = tree_path(filename)
+    network = tree.network
+    names = list(network.substance_names)
+    name_rows = dict(network.substance_ids)
+
+    def name_row(name):
+        row = name_rows.get(name)
+        if row is None:
+            row = name_rows[name] = len(names)
+            names.append(name)
+        return row
+
+    parents, substances, reactions, leaves = [], [], [], []
+    stack = [(tree.root, -1)]
+    while stack:
+        node, parent = stack.pop()
+        row = len(parents)
+        parents.append(parent)
+        substances.append(name_row(node.substance))
+        reactions.append(-1 if node.reaction_index is None else network.reaction_ids[node.reaction_index])
+        leaves.append(node.is_leaf)
+        # reversed so children come out of the stack in their original order
+        stack.extend((child, row) for child in reversed(node.children))
+
+    reaction_records = [tree.reactions[key] for key in network.reaction_keys]
+    meta = {
+        "target_substance": tree.target_substance,
+        "parsed_sources": sorted(getattr(tree, 'parsed_sources', ())),
+        "next_reaction_idx": getattr(tree, 'next_reaction_idx', None),
+        "unexpandable_substances": sorted(tree.unexpandable_substances),
+        "prune_unsolvable": getattr(tree, 'prune_unsolvable', False),
+    }
+    arrays = {"version": np.array([FORMAT_VERSION], dtype=np.int32),
+              "meta": np.frombuffer(json.dumps(meta, ensure_ascii=False).encode('utf-8'), dtype=np.uint8),
+              "reactant_offsets": network.reactant_offsets, "reactant_indices": network.reactant_indices,
+              "product_offsets": network.product_offsets, "product_indices": network.product_indices,
+              "node_parent": np.asarray(parents, dtype=np.int32),
+              "node_substance": np.asarray(substances, dtype=np.int32),
+              "node_reaction": np.asarray(reactions, dtype=np.int32),
+              "node_leaf": np.asarray(leaves, dtype=np.bool_)}
+    for member, strings in (("substances", names),
+                            ("reaction_keys", network.reaction_keys),
+                            ("reaction_conditions", [str(r.get('conditions', '')) for r in reaction_records]),
+                            # no source is stored as an empty string, read back as None
+                            ("reaction_sources", ['' if r.get('source') is None else str(r.get('source'))
+                                                  for r in reaction_records])):
+        arrays[member], arrays[member + "_offsets"] = _encode_strings(strings)
+
+    tmp_filename = filename + '.tmp.npz'
+    np.savez(tmp_filename, **arrays)
+    os.replace(tmp_filename, filename)
+    return filename
+
+
+class TreeNodeView:
+    """
+    Read-only node of a TreeFile, with the attributes display code uses from treeBuilder.Node
+    """
+    __slots__ = ('substance', 'reaction_index', 'is_leaf', 'children')
+
+    def __init__(self, substance, reaction_index, is_leaf):
+        self.substance = substance
+        self.reaction_index = reaction_index
+        self.is_leaf = is_leaf
+        self.children = []
+
+
+class TreeFile:
+    """
+    Lazily loaded tree file; members are read on first access.
+    """
+    def __init__(self, filename):
+        self.filename = tree_path(filename)
+        self.data = _open_npz(self.filename)
+        version = int(self.data["version"][0])
+        if version > FORMAT_VERSION:
+            raise ValueError(f"{self.filename} uses tree format version {version}, "
+                             f"this version reads up to {FORMAT_VERSION}")
+        self.meta = json.loads(self.data["meta"].tobytes().decode('utf-8'))
+        self._strings = {}
+        self._root = None
+
+    def strings(self, member):
+        if member not in self._strings:
+            self._strings[member] = _decode_strings(self.data[member], self.data[member + "_offsets"])
+        return self._strings[member]
+
+    def get_node_count(self):
+        return len(self.data["node_parent"])
+
+    @property
+    def root(self):
+        """
+        Node views of the whole tree, built from the node arrays only
+        """
+        if self._root is not None:
+            return self._root
+        names = self.strings("substances")
+        keys = self.strings("reaction_keys")
+        parents = self.data["node_parent"].tolist()
+        substances = self.data["node_substance"].tolist()
+        reactions = self.data["node_reaction"].tolist()
+        leaves = self.data["node_leaf"].tolist()
+        nodes = []
+        for row, parent in enumerate(parents):
+            node = TreeNodeView(names[substances[row]], keys[reactions[row]] if reactions[row] >= 0 else None,
+                                leaves[row])
+            nodes.append(node)
+            if parent >= 0:
+                nodes[parent].children.append(node)
+        self._root = nodes[0]
+        return self._root
+
+    def reactions(self):
+        from .reactionRecord import Reaction
+        names = self.strings("substances")
+        keys = self.strings("reaction_keys")
+        conditions = self.strings("reaction_conditions")
+        sources = self.strings("reaction_sources")
+        reactant_offsets, reactant_indices = self.data["reactant_offsets"], self.data["reactant_indices"].tolist()
+        product_offsets, product_indices = self.data["product_offsets"], self.data["product_indices"].tolist()
+        reactions = {}
+        for row, key in enumerate(keys):
+            reactants = [names[i] for i in reactant_indices[reactant_offsets[row]:reactant_offsets[row + 1]]]
+            products = [names[i] for i in product_indices[product_offsets[row]:product_offsets[row + 1]]]
+            reactions[key] = Reaction(reactants, products, conditions[row], sources[row] or None, key)
+        return reactions
+
+
+def _empty_tree(target_substance, reactions, prune_unsolvable=False, parsed_sources=(), next_reaction_idx=None,
+                unexpandable_substances=()):
+    """
+    Tree with its reaction network and context but without nodes, for the loaders to fill in
+    """
+    from .treeBuilder import CommonSubstanceDB, Tree, TreeContext
+    from .reactionNetwork import ReactionNetwork
+
+    tree = Tree.__new__(Tree)
+    tree.target_substance = target_substance
+    tree.prune_unsolvable = prune_unsolvable
+    tree.parsed_sources = set(parsed_sources)
+    tree.reactions = reactions
+    if next_reaction_idx is not None:
+        tree.next_reaction_idx = next_reaction_idx
+    else:
+        tree.next_reaction_idx = max([int(idx) for idx in tree.reactions if str(idx).isdigit()], default=0) + 1
+    tree.network = ReactionNetwork(tree.reactions)
+    tree.reaction_infos = set()
+    tree.all_path = []
+    tree.db = CommonSubstanceDB()
+    tree.unexpandable_substances = set(unexpandable_substances)
+    tree.context = TreeContext(tree.network, target_substance, cache_func=tree.db.is_common_chemical_cached,
+                               unexpandable_substances=tree.unexpandable_substances)
+    return tree
+
+
+def load_tree(filename):
+    """
+    Rebuild a full Tree, with the same nodes, from a tree file
+    """
+    from .treeBuilder import Node, TreeStats
+
+    tree_file = TreeFile(filename)
+    meta = tree_file.meta
+    tree = _empty_tree(meta["target_substance"], tree_file.reactions(),
+                       prune_unsolvable=meta.get("prune_unsolvable", False),
+                       parsed_sources=meta["parsed_sources"], next_reaction_idx=meta["next_reaction_idx"],
+                       unexpandable_substances=meta["unexpandable_substances"])
+    network = tree.network
+    names = tree_file.strings("substances")
+    parents = tree_file.data["node_parent"].tolist()
+    substances = tree_file.data["node_substance"].tolist()
+    reactions = tree_file.data["node_reaction"].tolist()
+    leaves = tree_file.data["node_leaf"].tolist()
+    nodes = []
+    for row, parent in enumerate(parents):
+        substance_id = network.substance_id(names[substances[row]])
+        if parent < 0:
+            node = Node(substance_id, tree.context)
+        else:
+            # the network is rebuilt from the reaction table, so reaction rows are reaction ids
+            node = nodes[parent].add_child(substance_id, reactions[row])
+        node.is_leaf = leaves[row]
+        nodes.append(node)
+    tree.root = nodes[0]
+    tree.context.stats = TreeStats.count(tree.root)
+    return tree
+
+
+class _PickledObject:
+    """
+    Stand-in for the Tree, Node and stock database objects of legacy pickled trees, keeps their attributes
+    """
+    def __setstate__(self, state):
+        if isinstance(state, tuple):
+            # (__dict__, __slots__ values)
+            state = {**(state[0] or {}), **(state[1] or {})}
+        self.__dict__.update(state)
+
+    def __getattr__(self, name):
+        # bound methods are pickled as getattr(obj, name), e.g. the cache_func of every node
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return None
+
+
+def _legacy_getattr(obj, name):
+    # bound methods of the pickled objects, any other attribute lookup is refused
+    if not isinstance(obj, _PickledObject) or name.startswith('_'):
+        raise pickle.UnpicklingError(f'legacy tree looks up {name!r} of {type(obj).__name__}')
+    return getattr(obj, name)
+
+
+class _LegacyUnpickler(pickle.Unpickler):
+    """
+    Unpickler of legacy trees that only resolves the globals such trees hold; any other global
+    (os.system, builtins.eval, ...) raises UnpicklingError
+    """
+    SAFE_GLOBALS = {
+        ('builtins', 'set'): set,
+        ('builtins', 'frozenset'): frozenset,
+        ('builtins', 'object'): object,
+        ('builtins', 'getattr'): _legacy_getattr,
+        ('copyreg', '_reconstructor'): copyreg._reconstructor,
+        ('copyreg', '__newobj__'): copyreg.__newobj__,
+        ('collections', 'OrderedDict'): collections.OrderedDict,
+        ('collections', 'defaultdict'): collections.defaultdict,
+        ('collections', 'deque'): collections.deque,
+    }
+
+    def find_class(self, module, name):
+        if module.split('.')[-1] == 'treeBuilder' and name in ('Tree', 'Node', 'CommonSubstanceDB'):
+            return _PickledObject
+        if module.split('.')[-1] == 'reactionRecord' and name == 'Reaction':
+            from .reactionRecord import Reaction
+            return Reaction
+        if (module, name) in self.SAFE_GLOBALS:
+            return self.SAFE_GLOBALS[(module, name)]
+        raise pickle.UnpicklingError(f'global {module}.{name} is not allowed in a legacy tree')
+
+
+def load_legacy_tree(filename):
+    """
+    Convert a pickled tree written before the tree files (tree_pi/*.pkl) into a Tree with the
+    current nodes. Only the globals legacy trees hold are resolved (_LegacyUnpickler).
+    """
+    from .treeBuilder import Node, TreeStats
+
+    with open(legacy_path(filename), 'rb') as f:
+        pickled = _LegacyUnpickler(f).load()
+    state = vars(pickled)
+    tree = _empty_tree(state['target_substance'], state['reactions'],
+                       prune_unsolvable=state.get('prune_unsolvable', False),
+                       parsed_sources=state.get('parsed_sources', ()),
+                       next_reaction_idx=state.get('next_reaction_idx'),
+                       unexpandable_substances=state.get('unexpandable_substances', ()))
+    network = tree.network
+    tree.root = Node(network.substance_id(tree.target_substance), tree.context)
+    tree.root.is_leaf = pickled.root.is_leaf
+    stack = [(pickled.root, tree.root)]
+    while stack:
+        pickled_node, node = stack.pop()
+        for pickled_child in pickled_node.children:
+            child = node.add_child(network.substance_id(pickled_child.substance),
+                                   network.reaction_ids[str(pickled_child.reaction_index)])
+            child.is_leaf = pickled_child.is_leaf
+            stack.append((pickled_child, child))
+    tree.context.stats = TreeStats.count(tree.root)
+    return tree
+
+
+def convert_legacy_trees(filenames):
+    """
+    Write the tree file of each legacy pickled tree next to it
+
+    Returns:
+        paths of the written tree files
+    """
+    written = []
+    for filename in filenames:
+        written.append(save_tree(load_legacy_tree(filename), filename))
+        print(f"{legacy_path(filename)} converted to {written[-1]}")
+    return written
+
+
+if __name__ == '__main__':
+    # python -m RetroSynAgent.treeStore tree_pi/*.pkl
+    import sys
+    convert_legacy_trees(sys.argv[1:])
@@ -1,15 +1,34 @@
+import asyncio
+import json
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional
+
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
 
-# Import the core function from your main module
-from main import main
-
 app = FastAPI(
     title="RetroSynthesisAgent API",
     description="API to run retrosynthetic analysis on chemical materials.",
     version="1.0.0"
 )
 
+# Pipeline runs are executed by a pool of worker processes so the event loop is never blocked.
+# The files every run writes (smiles_cache.json, substance_query_result.json, the expansion
+# results in res_pi) are locked while written (RetroSynAgent.fileLock). The per-material files in
+# pdf_pi/res_pi/tree_pi are not, raise the pool size only when the materials submitted
+# concurrently do not overlap.
+API_WORKERS = int(os.getenv("RETRO_API_WORKERS", 1))
+# Finished jobs are kept for this many seconds, and at most this many of them
+JOB_TTL = int(os.getenv("RETRO_API_JOB_TTL", 24 * 3600))
+MAX_FINISHED_JOBS = int(os.getenv("RETRO_API_MAX_FINISHED_JOBS", 1000))
+
 class RetroRequest(BaseModel):
     material: str
     num_results: int
@@ -22,6 +41,169 @@ class RetroResponse(BaseModel):
     status: str
     data: dict
 
+class JobResponse(BaseModel):
+    job_id: str
+    status: str
+    progress: Optional[str] = None
+    created_at: float
+    finished_at: Optional[float] = None
+    request: dict
+    result: Optional[dict] = None
+    error: Optional[str] = None
+
+
+def _run_job(job_id, params, progress):
+    """
+    Runs in a worker process; stages are reported through the shared progress dict
+    """
+    from main import main
+
+    def report(stage):
+        progress[job_id] = stage
+
+    report('started')
+    return main(progress=report, **params)
+
+
+class JobManager:
+    """
+    In-memory job table. Identical requests submitted while a job is queued or running
+    are coalesced onto that job instead of running the pipeline twice. Finished jobs are
+    dropped after job_ttl seconds or when more than max_finished are kept.
+    """
+    def __init__(self, max_workers, job_ttl=JOB_TTL, max_finished=MAX_FINISHED_JOBS):
+        self.max_workers = max_workers
+        self.job_ttl = job_ttl
+        self.max_finished = max_finished
+        self.jobs = {}
+        self.active = {}  # request key -> job id of the queued or running job
+        self.finished = deque()  # job ids in the order they finished
+        self.lock = threading.Lock()
+        self._executor = None
+        self._manager = None
+        self._progress = None
+
+    def _start(self):
+        context = multiprocessing.get_context("spawn")
+        if self._manager is None:
+            self._manager = context.Manager()
+            self._progress = self._manager.dict()
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=context)
+
+    def _reset_executor(self, executor):
+        """
+        Drop a broken pool (a worker died), the next submit starts a new one
+        """
+        if self._executor is executor:
+            self._executor = None
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _evict(self):
+        expiry = time.time() - self.job_ttl
+        while self.finished and (len(self.finished) > self.max_finished
+                                 or self.jobs[self.finished[0]]["finished_at"] < expiry):
+            del self.jobs[self.finished.popleft()]
+
+    @staticmethod
+    def request_key(params):
+        return json.dumps(params, sort_keys=True)
+
+    def submit(self, params):
+        key = self.request_key(params)
+        with self.lock:
+            job_id = self.active.get(key)
+            if job_id is not None:
+                return self.jobs[job_id]
+            self._evict()
+            self._start()
+            job_id = uuid.uuid4().hex
+            job = {"job_id": job_id, "status": "queued", "created_at": time.time(), "finished_at": None,
+                   "request": params, "result": None, "error": None}
+            try:
+                job["future"] = self._executor.submit(_run_job, job_id, params, self._progress)
+            except BrokenProcessPool:
+                self._reset_executor(self._executor)
+                self._start()
+                job["future"] = self._executor.submit(_run_job, job_id, params, self._progress)
+            executor = self._executor
+            self.jobs[job_id] = job
+            self.active[key] = job_id
+        job["future"].add_done_callback(lambda future: self._finish(job_id, key, future, executor))
+        return job
+
+    def _finish(self, job_id, key, future, executor):
+        with self.lock:
+            job = self.jobs[job_id]
+            try:
+                result = future.result()
+                # main() reports its own failures as {"error": ...}
+                if isinstance(result, dict) and "error" in result:
+                    job["status"], job["error"] = "failed", str(result["error"])
+                else:
+                    job["status"] = "succeeded"
+                job["result"] = result
+            except BrokenProcessPool as e:
+                job["status"], job["error"] = "failed", str(e)
+                self._reset_executor(executor)
+            except Exception as e:
+                job["status"], job["error"] = "failed", str(e)
+            job["finished_at"] = time.time()
+            if self.active.get(key) == job_id:
+                del self.active[key]
+            self._progress.pop(job_id, None)
+            self.finished.append(job_id)
+            self._evict()
+
+    def describe(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            description = {name: value for name, value in job.items() if name != "future"}
+            if job["status"] == "queued" and job_id in self._progress:
+                description["status"] = "running"
+            description["progress"] = self._progress.get(job_id) if job["finished_at"] is None else job["status"]
+            return description
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        if self._manager is not None:
+            self._manager.shutdown()
+            self._manager = None
+
+
+job_manager = JobManager(API_WORKERS)
+
+
+@app.on_event("shutdown")
+def shutdown_workers():
+    job_manager.shutdown()
+
+
+@app.post("/jobs", response_model=JobResponse, status_code=202)
+async def create_job(req: RetroRequest):
+    """
+    Queue a retrosynthetic analysis and return its job id immediately.
+    An identical request that is still queued or running returns the existing job.
+    """
+    job = job_manager.submit(req.dict())
+    return job_manager.describe(job["job_id"])
+
+
+@app.get("/jobs/{job_id}", response_model=JobResponse)
+async def get_job(job_id: str):
+    """
+    Status (queued, running, succeeded, failed), current stage and, once finished, the result of a job.
+    """
+    job = job_manager.describe(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    return job
+
+
 @app.post("/retro-synthesis/", response_model=RetroResponse)
 async def retro_synthesis(req: RetroRequest):
     """
@@ -33,16 +215,12 @@ async def retro_synthesis(req: RetroRequest):
     - **expansion**: Whether to expand the reaction tree with additional literature
     - **filtration**: Whether to filter reactions/pathways
     - **retrieval_mode**: Document retrieval mode (patent-patent, paper-paper, paper-patent, patent-paper)
+
+    Waits for the result; the work runs in the job pool, so other requests are still served meanwhile.
     """
     try:
-        result = main(
-            material=req.material,
-            num_results=req.num_results,
-            alignment=req.alignment,
-            expansion=req.expansion,
-            filtration=req.filtration,
-            retrieval_mode=req.retrieval_mode
-        )
+        job = job_manager.submit(req.dict())
+        result = await asyncio.wrap_future(job["future"])
         return {"status": "success", "data": result}
     except Exception as e:
         # Log error or handle specifically if needed
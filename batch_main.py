@@ -0,0 +1,170 @@
+"""
+Run several target materials in one process.
+
+Compared to one `python3 main.py` per material (run_Chem.sh), a batch run loads RDKit, PyMuPDF,
+the emol stock set and the OpenAI client once, and shares the SMILES cache, the stock query
+results, the extracted documents (a PDF retrieved for two targets is downloaded and sent to the
+LLM once) and, with --llm_cache_dir, identical LLM calls across targets and runs.
+
+Stages are overlapped across targets: names are resolved and documents downloaded concurrently,
+the documents of each target are extracted as soon as its downloads finish, while the other
+targets are still downloading. Tree building, expansion and recommendation then run per target.
+"""
+import argparse
+import json
+import os
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from main import build_pathways, extract_documents, resolve_material, retrieve_documents
+from RetroSynAgent.documentCatalog import CATALOG_FILE, DocumentCatalog
+from RetroSynAgent.expansionScheduler import ExpansionScheduler
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Process several target materials in one run.")
+    parser.add_argument('--materials', type=str, nargs='*', default=[],
+                        help="Chemical names or SMILES strings of the target molecules.")
+    parser.add_argument('--materials_file', type=str, default=None,
+                        help="File with one target material per line, blank lines and lines starting with # are skipped.")
+    parser.add_argument('--num_results', type=int, required=True,
+                        help="Maximum number of PDFs to download per material.")
+    parser.add_argument('--alignment', type=str, default="False", choices=["True", "False"],
+                        help="Whether to align entities except for root node.")
+    parser.add_argument('--expansion', type=str, default="False", choices=["True", "False"],
+                        help="Whether to expand the tree with additional literature.")
+    parser.add_argument('--filtration', type=str, default="False", choices=["True", "False"],
+                        help="Whether to filter reactions.")
+    parser.add_argument('--retrieval_mode', type=str, default="patent-patent",
+                        choices=["patent-patent", "paper-paper", "both-both"],
+                        help="Document retrieval mode, see main.py.")
+    parser.add_argument('--expansion_top_k', type=int, default=5,
+                        help="Number of unexpandable substances searched per expansion iteration, best first.")
+    parser.add_argument('--expansion_max_docs', type=int, default=None,
+                        help="Maximum number of documents sent to the LLM per expansion iteration.")
+    parser.add_argument('--expansion_max_tokens', type=int, default=None,
+                        help="Maximum number of estimated LLM input tokens per expansion iteration.")
+    parser.add_argument('--ranked_pathways', type=int, default=None,
+                        help="Only send the k cheapest pathways to the LLM instead of every pathway of the tree.")
+    parser.add_argument('--pathway_prompt_tokens', type=int, default=None,
+                        help="Maximum number of estimated tokens of the pathways sent to the LLM, the best pathways are kept.")
+    parser.add_argument('--map_reduce_tokens', type=int, default=None,
+                        help="Maximum number of estimated tokens per LLM call in filtration and recommendation.")
+    parser.add_argument('--retrieval_workers', type=int, default=4,
+                        help="Number of materials whose documents are retrieved concurrently.")
+    parser.add_argument('--llm_cache_dir', type=str, default='llm_cache',
+                        help="Directory of cached LLM responses, empty to disable.")
+    parser.add_argument('--output', type=str, default='res_pi/batch_results.json',
+                        help="JSON file the result of every material is written to.")
+    return parser.parse_args()
+
+
+def read_materials(materials, materials_file=None):
+    """
+    Materials from the command line and the materials file, duplicates removed, in order
+    """
+    materials = list(materials)
+    if materials_file:
+        with open(materials_file, 'r', encoding='utf-8') as f:
+            materials += [line.strip() for line in f if line.strip() and not line.strip().startswith('#')]
+    return list(dict.fromkeys(materials))
+
+
+def _resolve_and_retrieve(material, num_results, retrieval_mode, pdf_folder_name, catalog):
+    smiles, valid_smiles = resolve_material(material)
+    pdf_name_list = retrieve_documents(material, smiles, valid_smiles, num_results, retrieval_mode, pdf_folder_name,
+                                       catalog)
+    return smiles, pdf_name_list
+
+
+def run_batch(materials, num_results, alignment, expansion, filtration, retrieval_mode="patent-patent",
+              scheduler_args=None, retrieval_workers=4, ranked_pathways=None,
+              pathway_prompt_tokens=None, map_reduce_tokens=None):
+    """
+    Args:
+        materials: target materials, names or SMILES
+        scheduler_args: keyword arguments of the ExpansionScheduler created for each material
+        ranked_pathways, pathway_prompt_tokens, map_reduce_tokens: see main.build_pathways
+
+    Returns:
+        {material: result of main.build_pathways, or {"error": ...}}
+    """
+    pdf_folder_name = 'pdf_pi'
+    result_folder_name = 'res_pi'
+    result_json_name = 'llm_res'
+    os.makedirs(pdf_folder_name, exist_ok=True)
+    os.makedirs(result_folder_name, exist_ok=True)
+    catalog = DocumentCatalog(os.path.join(result_folder_name, CATALOG_FILE))
+
+    results = {}
+    smiles_of = {}
+    documents_of = {}
+    # downloads run in the pool; extraction runs here, one target at a time, since every target
+    # shares the results file. A document retrieved for several targets is extracted once.
+    with ThreadPoolExecutor(max_workers=retrieval_workers) as executor:
+        futures = {executor.submit(_resolve_and_retrieve, material, num_results, retrieval_mode, pdf_folder_name,
+                                   catalog): material for material in materials}
+        for future in as_completed(futures):
+            material = futures[future]
+            try:
+                smiles, pdf_name_list = future.result()
+                if not pdf_name_list:
+                    print(f"No PDFs were downloaded for {material}, skipping it.")
+                    results[material] = {"error": "No PDFs downloaded"}
+                    continue
+                print(f"Extracting reactions for {material} ({len(pdf_name_list)} PDFs)...")
+                documents_of[material] = extract_documents(pdf_folder_name, result_folder_name, result_json_name,
+                                                           material, catalog)
+                smiles_of[material] = smiles
+            except Exception as e:
+                traceback.print_exc()
+                results[material] = {"error": str(e)}
+
+    for material in materials:
+        if material not in smiles_of:
+            continue
+        print(f"Building pathways for {material}")
+        print("========================================")
+        try:
+            scheduler = ExpansionScheduler(**(scheduler_args or {}))
+            results[material] = build_pathways(material, smiles_of[material], alignment, expansion, filtration,
+                                               retrieval_mode, scheduler, result_folder_name, result_json_name,
+                                               results_dict=documents_of[material],
+                                               ranked_pathways=ranked_pathways,
+                                               pathway_prompt_tokens=pathway_prompt_tokens,
+                                               map_reduce_tokens=map_reduce_tokens)
+        except Exception as e:
+            traceback.print_exc()
+            results[material] = {"error": str(e)}
+        print(f"Completed: {material}")
+    return {material: results[material] for material in materials}
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    materials = read_materials(args.materials, args.materials_file)
+    if not materials:
+        raise SystemExit("No materials given, use --materials or --materials_file.")
+    if args.llm_cache_dir:
+        os.environ.setdefault('LLM_CACHE_DIR', args.llm_cache_dir)
+    print(f"Running {len(materials)} materials: {', '.join(materials)}")
+
+    results = run_batch(materials, args.num_results,
+                        alignment=args.alignment == "True",
+                        expansion=args.expansion == "True",
+                        filtration=args.filtration == "True",
+                        retrieval_mode=args.retrieval_mode,
+                        scheduler_args={"top_k": args.expansion_top_k,
+                                        "max_documents": args.expansion_max_docs,
+                                        "max_tokens": args.expansion_max_tokens},
+                        retrieval_workers=args.retrieval_workers,
+                        ranked_pathways=args.ranked_pathways,
+                        pathway_prompt_tokens=args.pathway_prompt_tokens,
+                        map_reduce_tokens=args.map_reduce_tokens)
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=4, ensure_ascii=False)
+    failed = [material for material, result in results.items() if "error" in result]
+    print(f"All materials processed, {len(materials) - len(failed)} succeeded, results saved to {args.output}")
+    if failed:
+        print(f"Failed: {', '.join(failed)}")
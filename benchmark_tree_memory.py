@@ -0,0 +1,118 @@
+"""
+Memory of tree nodes: the __slots__ nodes sharing one TreeContext against the previous layout,
+where every node had its own __dict__ with the shared references and copies of its ancestry
+(fathers_set, reaction_line).
+
+A layered synthetic reaction network is expanded into a tree with no stock lookups; the same
+tree is then copied into previous-layout nodes. Memory is measured with tracemalloc.
+
+    python benchmark_tree_memory.py --layers 7 --width 6
+"""
+import argparse
+import contextlib
+import os
+import random
+import time
+import tracemalloc
+
+from RetroSynAgent.reactionRecord import Reaction
+from RetroSynAgent.treeBuilder import Tree
+
+
+class PreviousNode:
+    """
+    Node with the attributes every node carried before TreeContext
+    """
+    def __init__(self, substance, network, fathers_set=None, father=None, reaction_index=None, reaction_line=None,
+                 cache_func=None, unexpandable_substances=None, substance_id=None, solvable_reactions=None):
+        self.reaction_index = reaction_index
+        self.substance = substance
+        self.substance_id = substance_id
+        self.children = []
+        self.fathers_set = fathers_set if fathers_set is not None else set()
+        self.father = father
+        self.reaction_line = reaction_line if reaction_line is not None else []
+        self.is_leaf = False
+        self.cache_func = cache_func
+        self.network = network
+        self.unexpandable_substances = unexpandable_substances
+        self.solvable_reactions = solvable_reactions
+
+
+def layered_reactions(layers, width, reactions_per_substance=2, seed=0):
+    """
+    Substances L{layer}_{i}; each is produced by reactions from two substances of the next layer,
+    the last layer is the stock
+    """
+    rng = random.Random(seed)
+    reactions = {}
+    for layer in range(layers):
+        for i in range(width if layer else 1):
+            for _ in range(reactions_per_substance):
+                idx = str(len(reactions) + 1)
+                reactants = [f'L{layer + 1}_{j}' for j in rng.sample(range(width), 2)]
+                reactions[idx] = Reaction(reactants, [f'L{layer}_{i}'], 'c', 'benchmark', idx)
+    stock = {f'L{layers}_{j}' for j in range(width)}
+    return reactions, stock
+
+
+def build_tree(reactions, stock):
+    tree = Tree('L0_0', reactions=reactions)
+    tree.db.prefetch_smiles = lambda names: None
+    tree.context.cache_func = stock.__contains__
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        tree.construct_tree()
+    return tree
+
+
+def copy_to_previous(tree):
+    context = tree.context
+    root = PreviousNode(tree.root.substance, tree.network, cache_func=context.cache_func,
+                        unexpandable_substances=context.unexpandable_substances, substance_id=tree.root.substance_id)
+    stack = [(tree.root, root)]
+    while stack:
+        node, previous = stack.pop()
+        previous.is_leaf = node.is_leaf
+        for child in node.children:
+            fathers_set = set(previous.fathers_set)
+            fathers_set.add(previous.substance_id)
+            previous_child = PreviousNode(child.substance, tree.network, fathers_set=fathers_set, father=previous,
+                                          reaction_index=child.reaction_index,
+                                          reaction_line=previous.reaction_line + [child.reaction_index],
+                                          cache_func=previous.cache_func,
+                                          unexpandable_substances=previous.unexpandable_substances,
+                                          substance_id=child.substance_id)
+            previous.children.append(previous_child)
+            stack.append((child, previous_child))
+    return root
+
+
+def measure(build):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = build()
+    seconds = time.perf_counter() - start
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, size, seconds
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare the memory of tree node layouts.")
+    parser.add_argument('--layers', type=int, default=7, help="Depth of the synthetic reaction network.")
+    parser.add_argument('--width', type=int, default=6, help="Substances per layer.")
+    args = parser.parse_args()
+
+    reactions, stock = layered_reactions(args.layers, args.width)
+    # warm-up, loads the stock database outside the measurement
+    build_tree(reactions, stock)
+    tree, current_size, current_seconds = measure(lambda: build_tree(reactions, stock))
+    node_count = tree.get_node_count()
+    _, previous_size, previous_seconds = measure(lambda: copy_to_previous(tree))
+
+    print(f'{len(reactions)} reactions, {node_count} nodes')
+    print(f'slots nodes + TreeContext: {current_size / 2 ** 20:8.1f} MiB, {current_size / node_count:6.1f} B/node '
+          f'(built in {current_seconds:.2f} s)')
+    print(f'previous nodes:            {previous_size / 2 ** 20:8.1f} MiB, {previous_size / node_count:6.1f} B/node '
+          f'(copied in {previous_seconds:.2f} s)')
+    print(f'{previous_size / current_size:.1f}x less memory')
@@ -16,7 +16,8 @@ if (not os.environ.get('PYTHONHTTPSVERIFY', '') and
     ssl._create_default_https_context = ssl._create_unverified_context
 # --- End of SSL bypass block ---
 
-from RetroSynAgent.treeBuilder import Tree, TreeLoader
+from RetroSynAgent.treeBuilder import Tree
+from RetroSynAgent.buildCache import BuildCache
 from RetroSynAgent.pdfProcessor import PDFProcessor
 from RetroSynAgent.knowledgeGraph import KnowledgeGraph
 from RetroSynAgent import prompts
@@ -52,16 +53,6 @@ def parse_arguments():
     return parser.parse_args()
 
 
-def countNodes(tree):
-    node_count = tree.get_node_count()
-    return node_count
-
-
-def searchPathways(tree):
-    all_path = tree.find_all_paths()
-    return all_path
-
-
 def main(material,
          num_results,
          alignment,
@@ -89,9 +80,10 @@ def main(material,
         os.makedirs(tree_folder_name, exist_ok=True)
         os.makedirs(result_folder_name, exist_ok=True)
         entityalignment = EntityAlignment()
-        treeloader = TreeLoader()
+        build_cache = BuildCache(tree_folder_name + '/cache')
         tree_expansion = TreeExpansion()
-        reactions_filtration = ReactionsFiltration()
+        # the pathways are saved in the output json, one readable block per pathway
+        reactions_filtration = ReactionsFiltration(compact=False)
 
         ### extractInfos
 
@@ -283,38 +275,26 @@ def main(material,
         results_dict = entityalignment.alignRootNode(result_folder_name, result_json_name, material)
 
         # 4 construct kg & tree
-        tree_name_wo_exp = tree_folder_name + '/' + material + '_wo_exp.pkl'
-        if not os.path.exists(tree_name_wo_exp):
-            tree_wo_exp = Tree(material.lower(), result_dict=results_dict)
-            print('Starting to construct RetroSynthetic Tree...')
-            tree_wo_exp.construct_tree()
-            treeloader.save_tree(tree_wo_exp, tree_name_wo_exp)
-        else:
-            tree_wo_exp = treeloader.load_tree(tree_name_wo_exp)
-            print('RetroSynthetic Tree wo expansion already loaded.')
-        node_count_wo_exp = countNodes(tree_wo_exp)
-        all_path_wo_exp = searchPathways(tree_wo_exp)
-        print(f'The tree contains {node_count_wo_exp} nodes and {len(all_path_wo_exp)} pathways before expansion.')
+        tree_name_wo_exp = tree_folder_name + '/' + material + '_wo_exp.npz'
+        print('Starting to construct RetroSynthetic Tree...')
+        tree_wo_exp = build_cache.tree(Tree(material.lower(), result_dict=results_dict), alias=tree_name_wo_exp)
+        stats_wo_exp = tree_wo_exp.stats
+        print(f'The tree contains {stats_wo_exp["nodes"]} nodes and {stats_wo_exp["routes"]} routes before expansion.')
 
         if alignment:
             print('Starting to align the nodes of RetroSynthetic Tree...')
 
             ### WO Expansion
-            tree_name_wo_exp_alg = tree_folder_name + '/' + material + '_wo_exp_alg.pkl'
-            if not os.path.exists(tree_name_wo_exp_alg):
-                reactions_wo_exp = tree_wo_exp.reactions
-                reactions_wo_exp_alg_1 = entityalignment.entityAlignment_1(reactions_dict=reactions_wo_exp)
-                reactions_wo_exp_alg_all = entityalignment.entityAlignment_2(reactions_dict=reactions_wo_exp_alg_1)
-                tree_wo_exp_alg = Tree(material.lower(), reactions=reactions_wo_exp_alg_all)
-                tree_wo_exp_alg.construct_tree()
-                treeloader.save_tree(tree_wo_exp_alg, tree_name_wo_exp_alg)
-            else:
-                tree_wo_exp_alg = treeloader.load_tree(tree_name_wo_exp_alg)
-                print('aligned RetroSynthetic Tree wo expansion already loaded.')
-            node_count_wo_exp_alg = countNodes(tree_wo_exp_alg)
-            all_path_wo_exp_alg = searchPathways(tree_wo_exp_alg)
+            tree_name_wo_exp_alg = tree_folder_name + '/' + material + '_wo_exp_alg.npz'
+            # alignment maps are persisted, so re-aligning is cheap and keys the tree on their current content
+            reactions_wo_exp = tree_wo_exp.reactions
+            reactions_wo_exp_alg_1 = entityalignment.entityAlignment_1(reactions_dict=reactions_wo_exp)
+            reactions_wo_exp_alg_all = entityalignment.entityAlignment_2(reactions_dict=reactions_wo_exp_alg_1)
+            tree_wo_exp_alg = build_cache.tree(Tree(material.lower(), reactions=reactions_wo_exp_alg_all),
+                                               alias=tree_name_wo_exp_alg)
+            stats_wo_exp_alg = tree_wo_exp_alg.stats
             print(
-                f'The aligned tree contains {node_count_wo_exp_alg} nodes and {len(all_path_wo_exp_alg)} pathways before expansion.')
+                f'The aligned tree contains {stats_wo_exp_alg["nodes"]} nodes and {stats_wo_exp_alg["routes"]} routes before expansion.')
             tree_wo_exp = tree_wo_exp_alg  # Update tree_wo_exp for further processing
 
         ## treeExpansion
@@ -329,42 +309,32 @@ def main(material,
                 results_dict = tree_expansion.update_dict(results_dict, results_dict_additional)
                 print(f"Added {len(results_dict_additional)} additional reaction entries from expansion.")
 
-            tree_name_exp = tree_folder_name + '/' + material + '_w_exp.pkl'
-            if not os.path.exists(tree_name_exp):
-                tree_exp = Tree(material.lower(), result_dict=results_dict)
-                print('Starting to construct Expanded RetroSynthetic Tree...')
-                tree_exp.construct_tree()
-                treeloader.save_tree(tree_exp, tree_name_exp)
-            else:
-                tree_exp = treeloader.load_tree(tree_name_exp)
-                print('RetroSynthetic Tree w expansion already loaded.')
+            tree_name_exp = tree_folder_name + '/' + material + '_w_exp.npz'
+            print('Starting to construct Expanded RetroSynthetic Tree...')
+            tree_exp = build_cache.tree(
+                Tree(material.lower(), result_dict=results_dict, prune_unsolvable=True),
+                alias=tree_name_exp)
         else:
             # Use the non-expanded tree if expansion is not requested
             tree_exp = tree_wo_exp
             print('Skipping tree expansion as requested.')
 
         # nodes & pathway count (tree w exp)
-        node_count_exp = countNodes(tree_exp)
-        all_path_exp = searchPathways(tree_exp)
-        print(f'The tree contains {node_count_exp} nodes and {len(all_path_exp)} pathways after expansion.')
+        stats_exp = tree_exp.stats
+        print(f'The tree contains {stats_exp["nodes"]} nodes and {stats_exp["routes"]} routes after expansion.')
 
         if alignment and expansion:
             ### Expansion alignment (only if both alignment and expansion are enabled)
-            tree_name_exp_alg = tree_folder_name + '/' + material + '_w_exp_alg.pkl'
-            if not os.path.exists(tree_name_exp_alg):
-                reactions_exp = tree_exp.reactions
-                reactions_exp_alg_1 = entityalignment.entityAlignment_1(reactions_dict=reactions_exp)
-                reactions_exp_alg_all = entityalignment.entityAlignment_2(reactions_dict=reactions_exp_alg_1)
-                tree_exp_alg = Tree(material.lower(), reactions=reactions_exp_alg_all)
-                tree_exp_alg.construct_tree()
-                treeloader.save_tree(tree_exp_alg, tree_name_exp_alg)
-            else:
-                tree_exp_alg = treeloader.load_tree(tree_name_exp_alg)
-                print('aligned RetroSynthetic Tree w expansion already loaded.')
-            node_count_exp_alg = countNodes(tree_exp_alg)
-            all_path_exp_alg = searchPathways(tree_exp_alg)
+            tree_name_exp_alg = tree_folder_name + '/' + material + '_w_exp_alg.npz'
+            reactions_exp = tree_exp.reactions
+            reactions_exp_alg_1 = entityalignment.entityAlignment_1(reactions_dict=reactions_exp)
+            reactions_exp_alg_all = entityalignment.entityAlignment_2(reactions_dict=reactions_exp_alg_1)
+            tree_exp_alg = build_cache.tree(
+                Tree(material.lower(), reactions=reactions_exp_alg_all, prune_unsolvable=True),
+                alias=tree_name_exp_alg)
+            stats_exp_alg = tree_exp_alg.stats
             print(
-                f'The aligned tree contains {node_count_exp_alg} nodes and {len(all_path_exp_alg)} pathways after expansion.')
+                f'The aligned tree contains {stats_exp_alg["nodes"]} nodes and {stats_exp_alg["routes"]} routes after expansion.')
             tree_exp = tree_exp_alg  # Update tree_exp for further processing
 
         all_pathways_w_reactions = reactions_filtration.getFullReactionPathways(tree_exp)
@@ -374,30 +344,25 @@ def main(material,
             # filter reactions based on conditions
             reactions_txt_filtered = reactions_filtration.filterReactions(tree_exp)
             # build & save tree
-            tree_name_filtered = tree_folder_name + '/' + material + '_filtered' + '.pkl'
-            if not os.path.exists(tree_name_filtered):
-                print('Starting to construct Filtered RetroSynthetic Tree...')
-                tree_filtered = Tree(material.lower(), reactions_txt=reactions_txt_filtered)
-                tree_filtered.construct_tree()
-                treeloader.save_tree(tree_filtered, tree_name_filtered)
-            else:
-                tree_filtered = treeloader.load_tree(tree_name_filtered)
-                print('Filtered RetroSynthetic Tree already loaded.')
-            node_count_filtered = countNodes(tree_filtered)
-            all_path_filtered = searchPathways(tree_filtered)
+            tree_name_filtered = tree_folder_name + '/' + material + '_filtered' + '.npz'
+            print('Starting to construct Filtered RetroSynthetic Tree...')
+            tree_filtered = build_cache.tree(
+                Tree(material.lower(), reactions_txt=reactions_txt_filtered, prune_unsolvable=True),
+                alias=tree_name_filtered)
+            stats_filtered = tree_filtered.stats
             print(
-                f'The tree contains {node_count_filtered} nodes and {len(all_path_filtered)} pathways after filtration.')
+                f'The tree contains {stats_filtered["nodes"]} nodes and {stats_filtered["routes"]} routes after filtration.')
 
             # filter invalid pathways
             filtered_pathways = reactions_filtration.filterPathways(tree_filtered)
             all_pathways_w_reactions = filtered_pathways
 
         # Check if we have at least 1 node and 1 pathway
-        node_count = countNodes(tree_exp)
-        all_path = searchPathways(tree_exp)
+        stats = tree_exp.stats
+        node_count, path_count = stats['nodes'], stats['routes']
 
-        if node_count < 1 or len(all_path) < 1:
-            print(f"Warning: Insufficient data. The tree contains {node_count} nodes and {len(all_path)} pathways.")
+        if node_count < 1 or path_count < 1:
+            print(f"Warning: Insufficient data. The tree contains {node_count} nodes and {path_count} pathways.")
             print(f"Saving raw results_dict data instead of pathways...")
             # Print the number of entries in results_dict
             print(f"Results dictionary contains {len(results_dict)} entries.")
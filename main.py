@@ -11,8 +11,10 @@ if (not os.environ.get('PYTHONHTTPSVERIFY', '') and
 # --- End of SSL bypass block ---
 
 import json
-from RetroSynAgent.treeBuilder import Tree, TreeLoader
+from RetroSynAgent.treeBuilder import Tree
+from RetroSynAgent.buildCache import BuildCache
 from RetroSynAgent.pdfProcessor import PDFProcessor
+from RetroSynAgent.documentCatalog import CATALOG_FILE, DocumentCatalog
 from RetroSynAgent.knowledgeGraph import KnowledgeGraph
 from RetroSynAgent import prompts
 from RetroSynAgent.GPTAPI import GPTAPI
@@ -26,6 +28,7 @@ import re
 import pubchempy
 from RetroSynAgent.entityAlignment import EntityAlignment
 from RetroSynAgent.treeExpansion import TreeExpansion
+from RetroSynAgent.expansionScheduler import ExpansionScheduler
 from RetroSynAgent.reactionsFiltration import ReactionsFiltration
 import argparse
 
@@ -100,19 +103,21 @@ def parse_arguments():
     parser.add_argument('--retrieval_mode', type=str, default="patent-patent",
                         choices=["patent-patent", "paper-paper", "both-both"],
                         help="Document retrieval mode: patent-patent (patents for both), paper-paper (papers for both), both-both (both patents and papers for both initial and expansion)")
+    parser.add_argument('--expansion_top_k', type=int, default=5,
+                        help="Number of unexpandable substances searched per expansion iteration, best first.")
+    parser.add_argument('--expansion_max_docs', type=int, default=None,
+                        help="Maximum number of documents sent to the LLM per expansion iteration.")
+    parser.add_argument('--expansion_max_tokens', type=int, default=None,
+                        help="Maximum number of estimated LLM input tokens per expansion iteration.")
+    parser.add_argument('--ranked_pathways', type=int, default=None,
+                        help="Only send the k cheapest pathways to the LLM instead of every pathway of the tree.")
+    parser.add_argument('--pathway_prompt_tokens', type=int, default=None,
+                        help="Maximum number of estimated tokens of the pathways sent to the LLM, the best pathways are kept.")
+    parser.add_argument('--map_reduce_tokens', type=int, default=None,
+                        help="Maximum number of estimated tokens per LLM call in filtration and recommendation; larger inputs are split into chunks sent concurrently.")
     return parser.parse_args()
 
 
-def countNodes(tree):
-    node_count = tree.get_node_count()
-    return node_count
-
-
-def searchPathways(tree):
-    all_path = tree.find_all_paths()
-    return all_path
-
-
 def recommendReactions(prompt, result_folder_name, response_name):
     res = GPTAPI().answer_wo_vision(prompt)
     with open(f'{result_folder_name}/{response_name}.txt', 'w') as f:
@@ -125,13 +130,370 @@ def recommendReactions(prompt, result_folder_name, response_name):
     return recommend_reactions_txt
 
 
+def resolve_material(material):
+    """
+    Convert a chemical name to SMILES if needed.
+
+    Returns:
+        (smiles, valid_smiles), smiles is the input itself when it could not be converted
+    """
+    # 1  Convert chemical name to SMILES if needed
+    print(f"Processing material: {material}")
+    smiles = material
+    valid_smiles = True
+
+    # Improved detection of chemical names vs SMILES strings
+    # Common chemical name patterns (like brackets in nomenclature)
+    chemical_name_patterns = [
+        r'\[[0-9\.]+\.[0-9\.]+\.[0-9\.]+\]',  # Matches patterns like [1.1.1] in Bicyclo[1.1.1]pentane
+        r'\([a-zA-Z0-9,\-]+\)',  # Matches patterns like (R)-, (S)-, (E)-, (Z)-, etc.
+        r'[a-zA-Z]{5,}',  # Long alphabetic strings are likely chemical names
+        r'[0-9]+-[a-zA-Z]',  # Numbered prefixes like 1,2-di, 2,3,4-tri
+        r'(di|tri|tetra|penta|hexa|hepta|octa|nona|deca)[a-z]'  # Common prefixes
+    ]
+
+    # SMILES-specific patterns that are unlikely in chemical names
+    smiles_specific_patterns = [
+        r'[=#@\\/]',  # SMILES operators
+        r'\[\w+\]',  # Atom specifications like [C@H], [NH2], etc.
+        r'c1[cnosp]',  # Aromatic carbon patterns
+        r'C[0-9]\(',  # Ring specifications
+        r'\(=O\)',  # Carbonyl groups in SMILES
+        r'\.[A-Z]',  # Disconnected structures
+    ]
+
+    # Check if it matches chemical name patterns
+    is_likely_chemical_name = any(re.search(pattern, material) for pattern in chemical_name_patterns)
+
+    # Check if it contains SMILES-specific patterns
+    has_smiles_patterns = any(re.search(pattern, material) for pattern in smiles_specific_patterns)
+
+    # Additional check for common chemical name words
+    common_chemical_words = ['acid', 'amine', 'ether', 'alcohol', 'aldehyde', 'ketone', 'ester',
+                             'benzene', 'methyl', 'ethyl', 'propyl', 'butyl', 'pentyl', 'hexyl',
+                             'cyclo', 'bicyclo', 'tricyclo', 'cubane', 'adamantane', 'fullerene']
+    contains_chemical_word = any(word.lower() in material.lower() for word in common_chemical_words)
+
+    # Special case for Bicyclo compounds which are often misidentified
+    is_bicyclo_compound = 'bicyclo' in material.lower() and '[' in material and ']' in material
+
+    # Decision logic: prioritize chemical name detection
+    if is_likely_chemical_name or contains_chemical_word or is_bicyclo_compound:
+        print(f"Input appears to be a chemical name. Converting to SMILES...")
+        success, result = NameToSMILES.convert(material)
+        if success:
+            smiles = result
+            print(f"Successfully converted '{material}' to SMILES: {smiles}")
+        else:
+            # For Bicyclo compounds, try a direct lookup for common structures
+            if is_bicyclo_compound:
+                bicyclo_smiles_map = {
+                    'bicyclo[1.1.1]pentane': 'C1C2CC1C2',
+                    'bicyclo[2.2.1]heptane': 'C1CC2CCC1C2',
+                    'bicyclo[2.2.2]octane': 'C1CC2CCC1CC2',
+                    'bicyclo[3.3.1]nonane': 'C1CC2CCCC(C1)C2',
+                    'bicyclo[4.4.0]decane': 'C1CCC2CCCCC2C1'
+                }
+
+                # Try case-insensitive match
+                success = False
+                for name, smile in bicyclo_smiles_map.items():
+                    if name.lower() == material.lower():
+                        smiles = smile
+                        print(f"Found SMILES for '{material}' in lookup table: {smiles}")
+                        success = True
+                        break
+
+                if not success:
+                    print(f"Warning: Could not convert '{material}' to SMILES: {result}")
+                    print(f"Proceeding with the original input as SMILES.")
+                    valid_smiles = False
+            else:
+                print(f"Warning: Could not convert '{material}' to SMILES: {result}")
+                print(f"Proceeding with the original input as SMILES.")
+                valid_smiles = False
+    else:
+        print(f"Input appears to be a SMILES string already. Proceeding without conversion.")
+        # Validate if it's actually a valid SMILES string
+        try:
+            # Simple validation check - if it contains brackets, make sure they're balanced
+            if '[' in material and material.count('[') != material.count(']'):
+                print(f"Warning: Unbalanced brackets in SMILES string. This might not be a valid SMILES.")
+                print(f"Attempting to convert as a chemical name instead...")
+                success, result = NameToSMILES.convert(material)
+                if success:
+                    smiles = result
+                    print(f"Successfully converted '{material}' to SMILES: {smiles}")
+                else:
+                    valid_smiles = False
+        except Exception as e:
+            print(f"Warning: Error validating SMILES string: {str(e)}")
+            valid_smiles = False
+    return smiles, valid_smiles
+
+
+def retrieve_documents(material, smiles, valid_smiles, num_results, retrieval_mode, pdf_folder_name='pdf_pi',
+                       catalog=None):
+    """
+    Download the patents and/or papers of the initial retrieval into pdf_folder_name,
+    and register them as the material's working set in the document catalog if one is given.
+
+    Returns:
+        Paths of the downloaded PDFs
+    """
+    # Decide on initial retrieval method based on valid SMILES and retrieval mode
+    pdf_name_list = []
+    os.makedirs(pdf_folder_name, exist_ok=True)
+
+    if retrieval_mode == "both-both":
+        # Retrieve from both patents and papers
+        # Calculate how many documents to retrieve from each source
+        # Default to 8 from each source if user specified more than 16 total
+        patents_to_retrieve = min(8, num_results // 2)
+        papers_to_retrieve = min(8, num_results - patents_to_retrieve)
+
+        print(f"Retrieving {patents_to_retrieve} patents and {papers_to_retrieve} papers for initial retrieval...")
+
+        # First retrieve from patents if we have a valid SMILES
+        patent_pdf_list = []
+        if valid_smiles:
+            try:
+                print("Initializing PatentPDFDownloader for initial retrieval...")
+                downloader = PatentPDFDownloader(pdf_folder_name=pdf_folder_name, max_patents=patents_to_retrieve)
+                print("Calling process_smile method...")
+                # Default Redis connection parameters
+                redis_host = os.getenv("REDIS_HOST", "localhost")
+                redis_port = int(os.getenv("REDIS_PORT", 6379))
+                redis_db = int(os.getenv("REDIS_DB", 0))
+                patent_pdf_list = downloader.process_smile(smiles, redis_host, redis_port, redis_db)
+                print(f'Successfully downloaded {len(patent_pdf_list)} PDFs from patents for SMILES: {smiles}')
+            except ValueError as e:
+                print(f"Error with patent search: {str(e)}")
+                print("Will still proceed with academic paper search.")
+        else:
+            print("No valid SMILES available for patent search. Will only retrieve academic papers.")
+
+        # Then retrieve from academic papers
+        print("Initializing PDFDownloader for academic paper retrieval...")
+        downloader = PDFDownloader(material, pdf_folder_name=pdf_folder_name, num_results=papers_to_retrieve, n_thread=3)
+        paper_pdf_list = downloader.main()
+        print(f'Successfully downloaded {len(paper_pdf_list)} PDFs from academic papers for {material}')
+
+        # Combine the results
+        if catalog is not None:
+            catalog.register(patent_pdf_list, material, source='patent')
+            catalog.register(paper_pdf_list, material, source='paper')
+        pdf_name_list = patent_pdf_list + paper_pdf_list
+        print(f'Total PDFs downloaded: {len(pdf_name_list)} ({len(patent_pdf_list)} patents, {len(paper_pdf_list)} papers)')
+
+    elif retrieval_mode.startswith("patent") and valid_smiles:
+        # Patent-based initial retrieval (requires valid SMILES)
+        try:
+            print("Initializing PatentPDFDownloader for initial retrieval...")
+            downloader = PatentPDFDownloader(pdf_folder_name=pdf_folder_name, max_patents=num_results)
+            print("Calling process_smile method...")
+            # Default Redis connection parameters
+            redis_host = os.getenv("REDIS_HOST", "localhost")
+            redis_port = int(os.getenv("REDIS_PORT", 6379))
+            redis_db = int(os.getenv("REDIS_DB", 0))
+            pdf_name_list = downloader.process_smile(smiles, redis_host, redis_port, redis_db)
+            print(f'Successfully downloaded {len(pdf_name_list)} PDFs from patents for SMILES: {smiles}')
+            if catalog is not None:
+                catalog.register(pdf_name_list, material, source='patent')
+        except ValueError as e:
+            print(f"Error with patent search: {str(e)}")
+            print("Falling back to academic paper search.")
+            # Fall back to academic paper search
+            print("Initializing PDFDownloader for initial retrieval (fallback)...")
+            downloader = PDFDownloader(material, pdf_folder_name=pdf_folder_name, num_results=num_results, n_thread=3)
+            pdf_name_list = downloader.main()
+            print(f'Successfully downloaded {len(pdf_name_list)} PDFs from academic papers for {material}')
+            if catalog is not None:
+                catalog.register(pdf_name_list, material, source='paper')
+    else:  # paper-based initial retrieval
+        print("Initializing PDFDownloader for initial retrieval...")
+        downloader = PDFDownloader(material, pdf_folder_name=pdf_folder_name, num_results=num_results, n_thread=3)
+        pdf_name_list = downloader.main()
+        print(f'Successfully downloaded {len(pdf_name_list)} PDFs from academic papers for {material}')
+        if catalog is not None:
+            catalog.register(pdf_name_list, material, source='paper')
+    return pdf_name_list
+
+
+def extract_documents(pdf_folder_name='pdf_pi', result_folder_name='res_pi', result_json_name='llm_res',
+                      material=None, catalog=None):
+    """
+    Extract the reactions of the material's documents in the catalog that are not processed yet,
+    or of every PDF in pdf_folder_name without a catalog.
+
+    Returns:
+        {pdf name: reactions} of the material's documents with a catalog, else None
+        (the trees then read every result in the results json)
+    """
+    pdf_processor = PDFProcessor(pdf_folder_name=pdf_folder_name, result_folder_name=result_folder_name,
+                                 result_json_name=result_json_name)
+    pdf_processor.load_existing_results()
+    if catalog is not None and material is not None:
+        return pdf_processor.process_documents(catalog, material, save_batch_size=2)
+    pdf_processor.process_pdfs_txt(save_batch_size=2)
+    return None
+
+
+def build_pathways(material, smiles, alignment, expansion, filtration, retrieval_mode,
+                   expansion_scheduler=None, result_folder_name='res_pi', result_json_name='llm_res',
+                   tree_folder_name='tree_pi', progress=None, results_dict=None, ranked_pathways=None,
+                   pathway_prompt_tokens=None, map_reduce_tokens=None):
+    """
+    Build, align, expand and filter the trees of a material from the extracted reactions,
+    then ask the LLM for the recommended pathway.
+
+    Args:
+        progress: optional callback, called with the name of each stage as it starts
+        results_dict: {pdf name: reactions} of the material's working set, by default every
+            result in the results json
+        ranked_pathways: only send the k cheapest pathways (RouteSearch) to the LLM instead of
+            every pathway of the tree, None sends every pathway
+        pathway_prompt_tokens: estimated token budget of the pathways in the filtration and
+            recommendation prompts, None sends every pathway
+        map_reduce_tokens: estimated token budget of one filtration or recommendation call,
+            larger inputs are split into chunks (ReactionsFiltration), None sends one call each
+    """
+    progress = progress or (lambda stage: None)
+    os.makedirs(tree_folder_name, exist_ok=True)
+    entityalignment = EntityAlignment()
+    build_cache = BuildCache(tree_folder_name + '/cache')
+    tree_expansion = TreeExpansion()
+    reactions_filtration = ReactionsFiltration(max_prompt_tokens=pathway_prompt_tokens,
+                                               map_reduce_tokens=map_reduce_tokens)
+
+    ### treeBuildWOExapnsion
+    progress('building tree')
+    results_dict = entityalignment.alignRootNode(result_folder_name, result_json_name, material,
+                                                 results_dict=results_dict)
+
+    # 4 construct kg & tree
+    tree_name_wo_exp = tree_folder_name + '/' + material + '_wo_exp.npz'
+    print('Starting to construct RetroSynthetic Tree...')
+    tree_wo_exp = build_cache.tree(Tree(material.lower(), result_dict=results_dict), alias=tree_name_wo_exp)
+    stats_wo_exp = tree_wo_exp.stats
+    print(f'The tree contains {stats_wo_exp["nodes"]} nodes and {stats_wo_exp["routes"]} routes before expansion.')
+
+    if alignment:
+        print('Starting to align the nodes of RetroSynthetic Tree...')
+
+        ### WO Expansion
+        tree_name_wo_exp_alg = tree_folder_name + '/' + material + '_wo_exp_alg.npz'
+        # alignment maps are persisted, so re-aligning is cheap and keys the tree on their current content
+        reactions_wo_exp = tree_wo_exp.reactions
+        reactions_wo_exp_alg_1 = entityalignment.entityAlignment_1(reactions_dict=reactions_wo_exp)
+        reactions_wo_exp_alg_all = entityalignment.entityAlignment_2(reactions_dict=reactions_wo_exp_alg_1)
+        tree_wo_exp_alg = build_cache.tree(Tree(material.lower(), reactions=reactions_wo_exp_alg_all),
+                                           alias=tree_name_wo_exp_alg)
+        stats_wo_exp_alg = tree_wo_exp_alg.stats
+        print(
+            f'The aligned tree contains {stats_wo_exp_alg["nodes"]} nodes and {stats_wo_exp_alg["routes"]} routes before expansion.')
+        tree_wo_exp = tree_wo_exp_alg  # Update tree_wo_exp for further processing
+
+    ## treeExpansion
+    # 5 kg & tree expansion
+    results_dict_additional = None
+    if expansion:
+        progress('expanding tree')
+        results_dict_additional = tree_expansion.treeExpansion(result_folder_name, result_json_name,
+                                                               results_dict, material, expansion=True, max_iter=5,
+                                                               retrieval_mode=retrieval_mode, smiles=smiles,
+                                                               scheduler=expansion_scheduler)
+        if results_dict_additional:
+            results_dict = tree_expansion.update_dict(results_dict, results_dict_additional)
+    print(results_dict)
+    tree_name_exp = tree_folder_name + '/' + material + '_w_exp.npz'
+    print('Starting to construct Expanded RetroSynthetic Tree...')
+    tree_exp = build_cache.tree(
+        Tree(material.lower(), result_dict=results_dict, prune_unsolvable=True),
+        alias=tree_name_exp)
+
+    # nodes & pathway count (tree w exp)
+    stats_exp = tree_exp.stats
+    print(f'The tree contains {stats_exp["nodes"]} nodes and {stats_exp["routes"]} routes after expansion.')
+
+    if alignment:
+        ### Expansion
+        tree_name_exp_alg = tree_folder_name + '/' + material + '_w_exp_alg.npz'
+        reactions_exp = tree_exp.reactions
+        reactions_exp_alg_1 = entityalignment.entityAlignment_1(reactions_dict=reactions_exp)
+        reactions_exp_alg_all = entityalignment.entityAlignment_2(reactions_dict=reactions_exp_alg_1)
+        tree_exp_alg = build_cache.tree(
+            Tree(material.lower(), reactions=reactions_exp_alg_all, prune_unsolvable=True),
+            alias=tree_name_exp_alg)
+        stats_exp_alg = tree_exp_alg.stats
+        print(
+            f'The aligned tree contains {stats_exp_alg["nodes"]} nodes and {stats_exp_alg["routes"]} routes after expansion.')
+        tree_exp = tree_exp_alg  # Update tree_exp for further processing
+
+    if ranked_pathways:
+        all_pathways_w_reactions = reactions_filtration.getRankedReactionPathways(tree_exp, k=ranked_pathways)
+    else:
+        all_pathways_w_reactions = reactions_filtration.getFullReactionPathways(tree_exp)
+
+    ## Filtration
+    if filtration:
+        progress('filtering reactions')
+        # filter reactions based on conditions
+        reactions_txt_filtered = reactions_filtration.filterReactions(tree_exp)
+        # build & save tree
+        tree_name_filtered = tree_folder_name + '/' + material + '_filtered' + '.npz'
+        print('Starting to construct Filtered RetroSynthetic Tree...')
+        tree_filtered = build_cache.tree(
+            Tree(material.lower(), reactions_txt=reactions_txt_filtered, prune_unsolvable=True),
+            alias=tree_name_filtered)
+        stats_filtered = tree_filtered.stats
+        print(
+            f'The tree contains {stats_filtered["nodes"]} nodes and {stats_filtered["routes"]} routes after filtration.')
+
+        # filter invalid pathways
+        filtered_pathways = reactions_filtration.filterPathways(tree_filtered, k=ranked_pathways)
+        all_pathways_w_reactions = filtered_pathways
+
+    ### Recommendation
+    progress('recommending pathway')
+    # recommend based on specific criterion
+
+    # [1]
+    # print(filtered_pathways)
+    print(all_pathways_w_reactions)
+
+    # Check if we have at least 1 node and 1 pathway before proceeding
+    stats = tree_exp.stats
+    node_count, path_count = stats['nodes'], stats['routes']
+
+    if node_count < 1 or path_count < 1:
+        print(f"Warning: Insufficient data for recommendation. The tree contains {node_count} nodes and {path_count} pathways.")
+        return {"error": f"Insufficient reaction data. The tree contains {node_count} nodes and {path_count} pathways."}
+
+    # too many pathways for one call: shortlist them chunk by chunk first
+    all_pathways_w_reactions = reactions_filtration.shortlistPathways(material, all_pathways_w_reactions)
+    prompt_recommend1 = prompts.recommend_prompt_commercial.format(all_pathways=all_pathways_w_reactions,
+                                                                   substance=material)
+    recommend1_reactions_txt = recommendReactions(prompt_recommend1, result_folder_name,
+                                                  response_name='recommend_pathway1')
+    # the pathways name long substances by aliases, the answer should not but may use them
+    parsed_data = parse_reaction_data(reactions_filtration.expand_aliases(recommend1_reactions_txt))
+    return parsed_data
+
+
 def main(material,
          num_results,
          alignment,
          expansion,
          filtration,
-         retrieval_mode="patent-paper"):
+         retrieval_mode="patent-paper",
+         expansion_scheduler=None,
+         progress=None,
+         ranked_pathways=None,
+         pathway_prompt_tokens=None,
+         map_reduce_tokens=None):
     try:
+        progress = progress or (lambda stage: None)
         print("Starting main function...")
         print(f"Material: {material}")
         print(f"Number of results: {num_results}")
@@ -144,175 +506,15 @@ def main(material,
         result_folder_name = 'res_pi'
         result_json_name = 'llm_res'
         tree_folder_name = 'tree_pi'
-        os.makedirs(tree_folder_name, exist_ok=True)
         os.makedirs(result_folder_name, exist_ok=True)
-        entityalignment = EntityAlignment()
-        treeloader = TreeLoader()
-        tree_expansion = TreeExpansion()
-        reactions_filtration = ReactionsFiltration()
+        catalog = DocumentCatalog(os.path.join(result_folder_name, CATALOG_FILE))
 
         ### extractInfos
-
-        # 1  Convert chemical name to SMILES if needed
-        print(f"Processing material: {material}")
-        smiles = material
-        valid_smiles = True
-
-        # Improved detection of chemical names vs SMILES strings
-        # Common chemical name patterns (like brackets in nomenclature)
-        chemical_name_patterns = [
-            r'\[[0-9\.]+\.[0-9\.]+\.[0-9\.]+\]',  # Matches patterns like [1.1.1] in Bicyclo[1.1.1]pentane
-            r'\([a-zA-Z0-9,\-]+\)',  # Matches patterns like (R)-, (S)-, (E)-, (Z)-, etc.
-            r'[a-zA-Z]{5,}',  # Long alphabetic strings are likely chemical names
-            r'[0-9]+-[a-zA-Z]',  # Numbered prefixes like 1,2-di, 2,3,4-tri
-            r'(di|tri|tetra|penta|hexa|hepta|octa|nona|deca)[a-z]'  # Common prefixes
-        ]
-
-        # SMILES-specific patterns that are unlikely in chemical names
-        smiles_specific_patterns = [
-            r'[=#@\\/]',  # SMILES operators
-            r'\[\w+\]',  # Atom specifications like [C@H], [NH2], etc.
-            r'c1[cnosp]',  # Aromatic carbon patterns
-            r'C[0-9]\(',  # Ring specifications
-            r'\(=O\)',  # Carbonyl groups in SMILES
-            r'\.[A-Z]',  # Disconnected structures
-        ]
-
-        # Check if it matches chemical name patterns
-        is_likely_chemical_name = any(re.search(pattern, material) for pattern in chemical_name_patterns)
-
-        # Check if it contains SMILES-specific patterns
-        has_smiles_patterns = any(re.search(pattern, material) for pattern in smiles_specific_patterns)
-
-        # Additional check for common chemical name words
-        common_chemical_words = ['acid', 'amine', 'ether', 'alcohol', 'aldehyde', 'ketone', 'ester',
-                                 'benzene', 'methyl', 'ethyl', 'propyl', 'butyl', 'pentyl', 'hexyl',
-                                 'cyclo', 'bicyclo', 'tricyclo', 'cubane', 'adamantane', 'fullerene']
-        contains_chemical_word = any(word.lower() in material.lower() for word in common_chemical_words)
-
-        # Special case for Bicyclo compounds which are often misidentified
-        is_bicyclo_compound = 'bicyclo' in material.lower() and '[' in material and ']' in material
-
-        # Decision logic: prioritize chemical name detection
-        if is_likely_chemical_name or contains_chemical_word or is_bicyclo_compound:
-            print(f"Input appears to be a chemical name. Converting to SMILES...")
-            success, result = NameToSMILES.convert(material)
-            if success:
-                smiles = result
-                print(f"Successfully converted '{material}' to SMILES: {smiles}")
-            else:
-                # For Bicyclo compounds, try a direct lookup for common structures
-                if is_bicyclo_compound:
-                    bicyclo_smiles_map = {
-                        'bicyclo[1.1.1]pentane': 'C1C2CC1C2',
-                        'bicyclo[2.2.1]heptane': 'C1CC2CCC1C2',
-                        'bicyclo[2.2.2]octane': 'C1CC2CCC1CC2',
-                        'bicyclo[3.3.1]nonane': 'C1CC2CCCC(C1)C2',
-                        'bicyclo[4.4.0]decane': 'C1CCC2CCCCC2C1'
-                    }
-
-                    # Try case-insensitive match
-                    success = False
-                    for name, smile in bicyclo_smiles_map.items():
-                        if name.lower() == material.lower():
-                            smiles = smile
-                            print(f"Found SMILES for '{material}' in lookup table: {smiles}")
-                            success = True
-                            break
-
-                    if not success:
-                        print(f"Warning: Could not convert '{material}' to SMILES: {result}")
-                        print(f"Proceeding with the original input as SMILES.")
-                        valid_smiles = False
-                else:
-                    print(f"Warning: Could not convert '{material}' to SMILES: {result}")
-                    print(f"Proceeding with the original input as SMILES.")
-                    valid_smiles = False
-        else:
-            print(f"Input appears to be a SMILES string already. Proceeding without conversion.")
-            # Validate if it's actually a valid SMILES string
-            try:
-                # Simple validation check - if it contains brackets, make sure they're balanced
-                if '[' in material and material.count('[') != material.count(']'):
-                    print(f"Warning: Unbalanced brackets in SMILES string. This might not be a valid SMILES.")
-                    print(f"Attempting to convert as a chemical name instead...")
-                    success, result = NameToSMILES.convert(material)
-                    if success:
-                        smiles = result
-                        print(f"Successfully converted '{material}' to SMILES: {smiles}")
-                    else:
-                        valid_smiles = False
-            except Exception as e:
-                print(f"Warning: Error validating SMILES string: {str(e)}")
-                valid_smiles = False
-
-        # Decide on initial retrieval method based on valid SMILES and retrieval mode
-        pdf_name_list = []
-        os.makedirs(pdf_folder_name, exist_ok=True)
-
-        if retrieval_mode == "both-both":
-            # Retrieve from both patents and papers
-            # Calculate how many documents to retrieve from each source
-            # Default to 8 from each source if user specified more than 16 total
-            patents_to_retrieve = min(8, num_results // 2)
-            papers_to_retrieve = min(8, num_results - patents_to_retrieve)
-
-            print(f"Retrieving {patents_to_retrieve} patents and {papers_to_retrieve} papers for initial retrieval...")
-
-            # First retrieve from patents if we have a valid SMILES
-            patent_pdf_list = []
-            if valid_smiles:
-                try:
-                    print("Initializing PatentPDFDownloader for initial retrieval...")
-                    downloader = PatentPDFDownloader(pdf_folder_name=pdf_folder_name, max_patents=patents_to_retrieve)
-                    print("Calling process_smile method...")
-                    # Default Redis connection parameters
-                    redis_host = os.getenv("REDIS_HOST", "localhost")
-                    redis_port = int(os.getenv("REDIS_PORT", 6379))
-                    redis_db = int(os.getenv("REDIS_DB", 0))
-                    patent_pdf_list = downloader.process_smile(smiles, redis_host, redis_port, redis_db)
-                    print(f'Successfully downloaded {len(patent_pdf_list)} PDFs from patents for SMILES: {smiles}')
-                except ValueError as e:
-                    print(f"Error with patent search: {str(e)}")
-                    print("Will still proceed with academic paper search.")
-            else:
-                print("No valid SMILES available for patent search. Will only retrieve academic papers.")
-
-            # Then retrieve from academic papers
-            print("Initializing PDFDownloader for academic paper retrieval...")
-            downloader = PDFDownloader(material, pdf_folder_name=pdf_folder_name, num_results=papers_to_retrieve, n_thread=3)
-            paper_pdf_list = downloader.main()
-            print(f'Successfully downloaded {len(paper_pdf_list)} PDFs from academic papers for {material}')
-
-            # Combine the results
-            pdf_name_list = patent_pdf_list + paper_pdf_list
-            print(f'Total PDFs downloaded: {len(pdf_name_list)} ({len(patent_pdf_list)} patents, {len(paper_pdf_list)} papers)')
-
-        elif retrieval_mode.startswith("patent") and valid_smiles:
-            # Patent-based initial retrieval (requires valid SMILES)
-            try:
-                print("Initializing PatentPDFDownloader for initial retrieval...")
-                downloader = PatentPDFDownloader(pdf_folder_name=pdf_folder_name, max_patents=num_results)
-                print("Calling process_smile method...")
-                # Default Redis connection parameters
-                redis_host = os.getenv("REDIS_HOST", "localhost")
-                redis_port = int(os.getenv("REDIS_PORT", 6379))
-                redis_db = int(os.getenv("REDIS_DB", 0))
-                pdf_name_list = downloader.process_smile(smiles, redis_host, redis_port, redis_db)
-                print(f'Successfully downloaded {len(pdf_name_list)} PDFs from patents for SMILES: {smiles}')
-            except ValueError as e:
-                print(f"Error with patent search: {str(e)}")
-                print("Falling back to academic paper search.")
-                # Fall back to academic paper search
-                print("Initializing PDFDownloader for initial retrieval (fallback)...")
-                downloader = PDFDownloader(material, pdf_folder_name=pdf_folder_name, num_results=num_results, n_thread=3)
-                pdf_name_list = downloader.main()
-                print(f'Successfully downloaded {len(pdf_name_list)} PDFs from academic papers for {material}')
-        else:  # paper-based initial retrieval
-            print("Initializing PDFDownloader for initial retrieval...")
-            downloader = PDFDownloader(material, pdf_folder_name=pdf_folder_name, num_results=num_results, n_thread=3)
-            pdf_name_list = downloader.main()
-            print(f'Successfully downloaded {len(pdf_name_list)} PDFs from academic papers for {material}')
+        progress('resolving material')
+        smiles, valid_smiles = resolve_material(material)
+        progress('retrieving documents')
+        pdf_name_list = retrieve_documents(material, smiles, valid_smiles, num_results, retrieval_mode,
+                                           pdf_folder_name, catalog)
 
         if not pdf_name_list:
             print("No PDFs were downloaded. This could be because:")
@@ -324,139 +526,13 @@ def main(material,
             return {"error": "No PDFs downloaded"}
 
         # 2 Extract infos from PDF about reactions
-        pdf_processor = PDFProcessor(pdf_folder_name=pdf_folder_name, result_folder_name=result_folder_name,
-                                     result_json_name=result_json_name)
-        pdf_processor.load_existing_results()
-        pdf_processor.process_pdfs_txt(save_batch_size=2)
-
-        ### treeBuildWOExapnsion
-        results_dict = entityalignment.alignRootNode(result_folder_name, result_json_name, material)
-
-        # 4 construct kg & tree
-        tree_name_wo_exp = tree_folder_name + '/' + material + '_wo_exp.pkl'
-        if not os.path.exists(tree_name_wo_exp):
-            tree_wo_exp = Tree(material.lower(), result_dict=results_dict)
-            print('Starting to construct RetroSynthetic Tree...')
-            tree_wo_exp.construct_tree()
-            treeloader.save_tree(tree_wo_exp, tree_name_wo_exp)
-        else:
-            tree_wo_exp = treeloader.load_tree(tree_name_wo_exp)
-            print('RetroSynthetic Tree wo expansion already loaded.')
-        node_count_wo_exp = countNodes(tree_wo_exp)
-        all_path_wo_exp = searchPathways(tree_wo_exp)
-        print(f'The tree contains {node_count_wo_exp} nodes and {len(all_path_wo_exp)} pathways before expansion.')
-
-        if alignment:
-            print('Starting to align the nodes of RetroSynthetic Tree...')
-
-            ### WO Expansion
-            tree_name_wo_exp_alg = tree_folder_name + '/' + material + '_wo_exp_alg.pkl'
-            if not os.path.exists(tree_name_wo_exp_alg):
-                reactions_wo_exp = tree_wo_exp.reactions
-                reactions_wo_exp_alg_1 = entityalignment.entityAlignment_1(reactions_dict=reactions_wo_exp)
-                reactions_wo_exp_alg_all = entityalignment.entityAlignment_2(reactions_dict=reactions_wo_exp_alg_1)
-                tree_wo_exp_alg = Tree(material.lower(), reactions=reactions_wo_exp_alg_all)
-                tree_wo_exp_alg.construct_tree()
-                treeloader.save_tree(tree_wo_exp_alg, tree_name_wo_exp_alg)
-            else:
-                tree_wo_exp_alg = treeloader.load_tree(tree_name_wo_exp_alg)
-                print('aligned RetroSynthetic Tree wo expansion already loaded.')
-            node_count_wo_exp_alg = countNodes(tree_wo_exp_alg)
-            all_path_wo_exp_alg = searchPathways(tree_wo_exp_alg)
-            print(
-                f'The aligned tree contains {node_count_wo_exp_alg} nodes and {len(all_path_wo_exp_alg)} pathways before expansion.')
-            tree_wo_exp = tree_wo_exp_alg  # Update tree_wo_exp for further processing
-
-        ## treeExpansion
-        # 5 kg & tree expansion
-        results_dict_additional = None
-        if expansion:
-            results_dict_additional = tree_expansion.treeExpansion(result_folder_name, result_json_name,
-                                                                   results_dict, material, expansion=True, max_iter=5,
-                                                                   retrieval_mode=retrieval_mode, smiles=smiles)
-            if results_dict_additional:
-                results_dict = tree_expansion.update_dict(results_dict, results_dict_additional)
-        print(results_dict)
-        tree_name_exp = tree_folder_name + '/' + material + '_w_exp.pkl'
-        if not os.path.exists(tree_name_exp):
-            tree_exp = Tree(material.lower(), result_dict=results_dict)
-            print('Starting to construct Expanded RetroSynthetic Tree...')
-            tree_exp.construct_tree()
-            treeloader.save_tree(tree_exp, tree_name_exp)
-        else:
-            tree_exp = treeloader.load_tree(tree_name_exp)
-            print('RetroSynthetic Tree w expansion already loaded.')
-
-        # nodes & pathway count (tree w exp)
-        node_count_exp = countNodes(tree_exp)
-        all_path_exp = searchPathways(tree_exp)
-        print(f'The tree contains {node_count_exp} nodes and {len(all_path_exp)} pathways after expansion.')
-
-        if alignment:
-            ### Expansion
-            tree_name_exp_alg = tree_folder_name + '/' + material + '_w_exp_alg.pkl'
-            if not os.path.exists(tree_name_exp_alg):
-                reactions_exp = tree_exp.reactions
-                reactions_exp_alg_1 = entityalignment.entityAlignment_1(reactions_dict=reactions_exp)
-                reactions_exp_alg_all = entityalignment.entityAlignment_2(reactions_dict=reactions_exp_alg_1)
-                tree_exp_alg = Tree(material.lower(), reactions=reactions_exp_alg_all)
-                tree_exp_alg.construct_tree()
-                treeloader.save_tree(tree_exp_alg, tree_name_exp_alg)
-            else:
-                tree_exp_alg = treeloader.load_tree(tree_name_exp_alg)
-                print('aligned RetroSynthetic Tree w expansion already loaded.')
-            node_count_exp_alg = countNodes(tree_exp_alg)
-            all_path_exp_alg = searchPathways(tree_exp_alg)
-            print(
-                f'The aligned tree contains {node_count_exp_alg} nodes and {len(all_path_exp_alg)} pathways after expansion.')
-            tree_exp = tree_exp_alg  # Update tree_exp for further processing
+        progress('extracting reactions')
+        results_dict = extract_documents(pdf_folder_name, result_folder_name, result_json_name, material, catalog)
 
-        all_pathways_w_reactions = reactions_filtration.getFullReactionPathways(tree_exp)
-
-        ## Filtration
-        if filtration:
-            # filter reactions based on conditions
-            reactions_txt_filtered = reactions_filtration.filterReactions(tree_exp)
-            # build & save tree
-            tree_name_filtered = tree_folder_name + '/' + material + '_filtered' + '.pkl'
-            if not os.path.exists(tree_name_filtered):
-                print('Starting to construct Filtered RetroSynthetic Tree...')
-                tree_filtered = Tree(material.lower(), reactions_txt=reactions_txt_filtered)
-                tree_filtered.construct_tree()
-                treeloader.save_tree(tree_filtered, tree_name_filtered)
-            else:
-                tree_filtered = treeloader.load_tree(tree_name_filtered)
-                print('Filtered RetroSynthetic Tree already loaded.')
-            node_count_filtered = countNodes(tree_filtered)
-            all_path_filtered = searchPathways(tree_filtered)
-            print(
-                f'The tree contains {node_count_filtered} nodes and {len(all_path_filtered)} pathways after filtration.')
-
-            # filter invalid pathways
-            filtered_pathways = reactions_filtration.filterPathways(tree_filtered)
-            all_pathways_w_reactions = filtered_pathways
-
-        ### Recommendation
-        # recommend based on specific criterion
-
-        # [1]
-        # print(filtered_pathways)
-        print(all_pathways_w_reactions)
-
-        # Check if we have at least 1 node and 1 pathway before proceeding
-        node_count = countNodes(tree_exp)
-        all_path = searchPathways(tree_exp)
-
-        if node_count < 1 or len(all_path) < 1:
-            print(f"Warning: Insufficient data for recommendation. The tree contains {node_count} nodes and {len(all_path)} pathways.")
-            return {"error": f"Insufficient reaction data. The tree contains {node_count} nodes and {len(all_path)} pathways."}
-
-        prompt_recommend1 = prompts.recommend_prompt_commercial.format(all_pathways=all_pathways_w_reactions,
-                                                                       substance=material)
-        recommend1_reactions_txt = recommendReactions(prompt_recommend1, result_folder_name,
-                                                      response_name='recommend_pathway1')
-        parsed_data = parse_reaction_data(recommend1_reactions_txt)
-        return parsed_data
+        return build_pathways(material, smiles, alignment, expansion, filtration, retrieval_mode,
+                              expansion_scheduler, result_folder_name, result_json_name, tree_folder_name,
+                              progress, results_dict, ranked_pathways, pathway_prompt_tokens,
+                              map_reduce_tokens)
     except Exception as e:
         import traceback
         print(f"Error in main function: {str(e)}")
@@ -473,6 +549,9 @@ if __name__ == '__main__':
         expansion = args.expansion == "True"
         filtration = args.filtration == "True"
         retrieval_mode = args.retrieval_mode
+        expansion_scheduler = ExpansionScheduler(top_k=args.expansion_top_k,
+                                                 max_documents=args.expansion_max_docs,
+                                                 max_tokens=args.expansion_max_tokens)
 
         print(
             f"Running with parameters: material={material}, num_results={num_results}, alignment={alignment}, expansion={expansion}, filtration={filtration}, retrieval_mode={retrieval_mode}")
@@ -483,7 +562,11 @@ if __name__ == '__main__':
             alignment,
             expansion,
             filtration,
-            retrieval_mode
+            retrieval_mode,
+            expansion_scheduler,
+            ranked_pathways=args.ranked_pathways,
+            pathway_prompt_tokens=args.pathway_prompt_tokens,
+            map_reduce_tokens=args.map_reduce_tokens
         )
         print("Program completed successfully!")
     except Exception as e:
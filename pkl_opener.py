@@ -1,9 +1,10 @@
-import pickle
 import json
+import os
+
+from RetroSynAgent.treeStore import TreeFile, tree_path, load_legacy_tree
+
+tree_filename = 'tree_pi/Azulene_w_exp_alg.npz'
 
-# Load the pickle file
-with open('tree_pi/Azulene_w_exp_alg.pkl', 'rb') as file:
-    my_obj = pickle.load(file)
 
 # Function to convert any object to JSON-serializable dict
 def safe_serialize(obj):
@@ -18,16 +19,25 @@ def safe_serialize(obj):
     else:
         return str(obj)  # fallback to string representation
 
-# Build a dict from dir() and values
-data = {}
-for attr in dir(my_obj):
-    if attr.startswith('__') and attr.endswith('__'):
-        continue  # Skip dunder methods
-    try:
-        value = getattr(my_obj, attr)
-        data[attr] = safe_serialize(value)
-    except Exception as e:
-        data[attr] = f"Could not access attribute: {str(e)}"
+
+def node_to_dict(node):
+    return {"substance": node.substance, "reaction_index": node.reaction_index, "is_leaf": node.is_leaf,
+            "children": [node_to_dict(child) for child in node.children]}
+
+
+if os.path.exists(tree_path(tree_filename)):
+    # Tree files hold plain arrays and are read without unpickling
+    tree_file = TreeFile(tree_filename)
+    data = dict(tree_file.meta)
+    data["reactions"] = {idx: reaction.to_dict() for idx, reaction in tree_file.reactions().items()}
+    data["root"] = node_to_dict(tree_file.root)
+else:
+    # Legacy pickled tree, converted to the current nodes; only open files you trust
+    tree = load_legacy_tree(tree_filename)
+    data = {"target_substance": tree.target_substance,
+            "unexpandable_substances": sorted(tree.unexpandable_substances),
+            "reactions": {idx: safe_serialize(dict(reaction)) for idx, reaction in tree.reactions.items()},
+            "root": node_to_dict(tree.root)}
 
 # Write to JSON file
 with open('tree_object_dump.json', 'w') as f:
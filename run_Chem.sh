@@ -33,17 +33,6 @@ EXPANSION=True
 FILTRATION=False
 RETRIEVAL_MODE="both-both"
 
-# Process each chemical
-for chemical in "${chemicals[@]}"; do
-  echo "Processing: $chemical"
-  echo "========================================"
-
-  # Run the main.py script with the current chemical
-  python3 main.py --material "$chemical" --num_results $NUM_RESULTS --alignment $ALIGNMENT --expansion $EXPANSION --filtration $FILTRATION --retrieval_mode $RETRIEVAL_MODE
-
-  echo "Completed: $chemical"
-  echo "========================================"
-  echo ""
-done
-
-echo "All chemicals processed successfully!"
\ No newline at end of file
+# Process all chemicals in one batch run; stock lookups, downloads, extracted
+# documents and LLM responses are shared between them
+python3 batch_main.py --materials "${chemicals[@]}" --num_results $NUM_RESULTS --alignment $ALIGNMENT --expansion $EXPANSION --filtration $FILTRATION --retrieval_mode $RETRIEVAL_MODE
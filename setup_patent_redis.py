@@ -1,14 +1,34 @@
 #!/usr/bin/env python3
 """
 Script to import molecule_to_patent.jsonl data into Redis for use with PatentPDFDownloader.
+
+Two storage layouts are supported (see RetroSynAgent/patentIndex.py):
+- string:  one "smile:<SMILES>" key per molecule holding a JSON list of patent IDs
+- compact: hashed SMILES bucketed into Redis hashes, interned patent IDs packed as varints
+
+An existing string-layout database can be converted in place with --migrate, and
+--benchmark compares the memory usage of both layouts on a sample of the JSONL file.
+
+With --index-file the data is written to an embedded memory-mapped index file
+instead, which PatentPDFDownloader reads without a Redis server.
+
+--fingerprints additionally builds the Morgan fingerprint index used for the
+similarity fallback when an exact SMILES has no patents.
 """
+import argparse
 import json
 import os
+import random
 import sys
 import redis
 from tqdm import tqdm
 import time
 from rdkit import Chem
+from RetroSynAgent.patentIndex import (
+    CompactRedisWriter, LAYOUT_COMPACT, LAYOUT_KEY, LAYOUT_STRING, STRING_KEY_PREFIX,
+    bucket_bits_for, build_patent_index_file, get_patent_ids,
+)
+from RetroSynAgent.fingerprintIndex import FingerprintIndexBuilder
 
 def clean_smile(smile):
     """
@@ -24,27 +44,18 @@ def clean_smile(smile):
         print(f"Error processing SMILE string: {str(e)}")
         return None
 
-def import_data_to_redis(jsonl_file, redis_host="localhost", redis_port=6379, redis_db=0, batch_size=1000):
-    """
-    Import data from molecule_to_patent.jsonl into Redis
-    
-    Args:
-        jsonl_file: Path to the jsonl file
-        redis_host: Redis host
-        redis_port: Redis port
-        redis_db: Redis database
-        batch_size: Number of records to process in each batch
-    """
-    # Connect to Redis
+def connect_redis(redis_host, redis_port, redis_db):
     try:
         r = redis.Redis(host=redis_host, port=redis_port, db=redis_db)
         r.ping()  # Test connection
         print(f"Connected to Redis at {redis_host}:{redis_port}, DB {redis_db}")
+        return r
     except Exception as e:
         print(f"Error connecting to Redis: {str(e)}")
         print("Make sure Redis is running and accessible.")
         sys.exit(1)
-    
+
+def count_patcid_records(jsonl_file, max_records=None):
     # Check if file exists
     if not os.path.exists(jsonl_file):
         print(f"Error: File {jsonl_file} not found.")
@@ -54,55 +65,126 @@ def import_data_to_redis(jsonl_file, redis_host="localhost", redis_port=6379, re
     # Count lines in file for progress bar
     with open(jsonl_file, 'r') as f:
         line_count = sum(1 for _ in f)
+    if max_records is not None:
+        line_count = min(line_count, max_records)
+    return line_count
+
+def iter_patcid_records(jsonl_file, line_count, stats):
+    """
+    Yield (cleaned smile, patents) tuples from the jsonl file
     
-    print(f"Processing {line_count} records from {jsonl_file}")
-    
-    # Process file in batches
-    batch = []
-    processed = 0
-    skipped = 0
-    
+    Args:
+        jsonl_file: Path to the jsonl file
+        line_count: Number of lines to read
+        stats: Dict whose "skipped" counter is updated for unusable records
+    """
     with open(jsonl_file, 'r') as f:
-        for line in tqdm(f, total=line_count, desc="Processing records"):
+        for line_num, line in enumerate(tqdm(f, total=line_count, desc="Processing records")):
+            if line_num >= line_count:
+                break
             try:
                 data = json.loads(line)
                 smile = data.get("smile")
                 patents = data.get("patents", [])
                 
                 if not smile or not patents:
-                    skipped += 1
+                    stats["skipped"] += 1
                     continue
                 
                 # Clean SMILE string
                 cleaned_smile = clean_smile(smile)
                 if not cleaned_smile:
-                    skipped += 1
+                    stats["skipped"] += 1
                     continue
                 
-                # Add to batch
-                batch.append((cleaned_smile, patents))
-                
-                # Process batch if it reaches batch_size
-                if len(batch) >= batch_size:
-                    _process_batch(r, batch)
-                    processed += len(batch)
-                    batch = []
+                yield cleaned_smile, patents
                     
             except json.JSONDecodeError:
-                skipped += 1
+                stats["skipped"] += 1
                 continue
             except Exception as e:
                 print(f"Error processing record: {str(e)}")
-                skipped += 1
+                stats["skipped"] += 1
                 continue
+
+def import_data_to_redis(jsonl_file, redis_host="localhost", redis_port=6379, redis_db=0, batch_size=1000,
+                         layout=LAYOUT_STRING, max_records=None, fingerprint_dir=None):
+    """
+    Import data from molecule_to_patent.jsonl into Redis
+    
+    Args:
+        jsonl_file: Path to the jsonl file
+        redis_host: Redis host
+        redis_port: Redis port
+        redis_db: Redis database
+        batch_size: Number of records to process in each batch
+        layout: Storage layout, "string" or "compact"
+        max_records: Only import the first max_records lines (used for benchmarks)
+        fingerprint_dir: Also build a fingerprint similarity index in this directory
+    """
+    r = connect_redis(redis_host, redis_port, redis_db)
+    line_count = count_patcid_records(jsonl_file, max_records)
+    
+    print(f"Processing {line_count} records from {jsonl_file} into the {layout} layout")
+
+    if layout == LAYOUT_COMPACT:
+        writer = CompactRedisWriter(r, bucket_bits=bucket_bits_for(line_count))
+        write_batch = writer.write_batch
+    else:
+        write_batch = lambda records: _process_batch(r, records)
+    
+    # Process file in batches
+    batch = []
+    processed = 0
+    stats = {"skipped": 0}
+    records = iter_patcid_records(jsonl_file, line_count, stats)
+    fingerprint_builder = FingerprintIndexBuilder(fingerprint_dir) if fingerprint_dir else None
+    if fingerprint_builder:
+        records = fingerprint_builder.observe(records)
+    
+    for record in records:
+        # Add to batch
+        batch.append(record)
+        
+        # Process batch if it reaches batch_size
+        if len(batch) >= batch_size:
+            write_batch(batch)
+            processed += len(batch)
+            batch = []
     
     # Process remaining records
     if batch:
-        _process_batch(r, batch)
+        write_batch(batch)
         processed += len(batch)
     
-    print(f"Import completed. Processed {processed} records, skipped {skipped} records.")
+    print(f"Import completed. Processed {processed} records, skipped {stats['skipped']} records.")
     print(f"Data is now available in Redis for use with PatentPDFDownloader.")
+    _finish_fingerprints(fingerprint_builder)
+
+def _finish_fingerprints(fingerprint_builder):
+    if fingerprint_builder is None:
+        return
+    print("Sorting fingerprint index...")
+    num_fingerprints = fingerprint_builder.finish()
+    print(f"Fingerprint index with {num_fingerprints} molecules written to {fingerprint_builder.index_dir}.")
+    print(f"Set PATENT_FP_INDEX_PATH={fingerprint_builder.index_dir} to enable the similarity fallback.")
+
+def build_index_file(jsonl_file, output_path, max_records=None, fingerprint_dir=None):
+    """
+    Build the embedded patent index file used instead of Redis on single-node deployments
+    (set PATENT_INDEX_PATH to the output file).
+    """
+    line_count = count_patcid_records(jsonl_file, max_records)
+    print(f"Processing {line_count} records from {jsonl_file} into {output_path}")
+    stats = {"skipped": 0}
+    records = iter_patcid_records(jsonl_file, line_count, stats)
+    fingerprint_builder = FingerprintIndexBuilder(fingerprint_dir) if fingerprint_dir else None
+    if fingerprint_builder:
+        records = fingerprint_builder.observe(records)
+    num_molecules = build_patent_index_file(records, output_path)
+    print(f"Index completed. Wrote {num_molecules} molecules to {output_path}, skipped {stats['skipped']} records.")
+    print(f"Set PATENT_INDEX_PATH={output_path} to use it with PatentPDFDownloader.")
+    _finish_fingerprints(fingerprint_builder)
 
 def _process_batch(redis_client, batch):
     """
@@ -120,24 +202,119 @@ def _process_batch(redis_client, batch):
     
     pipe.execute()
 
-if __name__ == "__main__":
-    # Default file path
-    jsonl_file = "patcid_molecule_to_patents.jsonl"
-    
+def migrate_to_compact(redis_host="localhost", redis_port=6379, redis_db=0, batch_size=1000, delete_old=False):
+    """
+    Convert an existing string-layout database to the compact layout in place.
+    Lookups keep working during the migration because readers fall back to the string keys.
+
+    Args:
+        delete_old: Delete each "smile:" key once its compact entry has been written
+    """
+    r = connect_redis(redis_host, redis_port, redis_db)
+    num_keys = r.dbsize()
+    writer = CompactRedisWriter(r, bucket_bits=bucket_bits_for(num_keys))
+    migrated = 0
+    keys = []
+    for key in tqdm(r.scan_iter(match=f"{STRING_KEY_PREFIX}*", count=batch_size), total=num_keys, desc="Migrating"):
+        keys.append(key)
+        if len(keys) >= batch_size:
+            migrated += _migrate_keys(r, writer, keys, delete_old)
+            keys = []
+    if keys:
+        migrated += _migrate_keys(r, writer, keys, delete_old)
+    r.set(LAYOUT_KEY, LAYOUT_COMPACT)
+    print(f"Migration completed. Migrated {migrated} molecules to the compact layout.")
+
+def _migrate_keys(redis_client, writer, keys, delete_old):
+    values = redis_client.mget(keys)
+    batch = []
+    for key, value in zip(keys, values):
+        if value is None:
+            continue
+        smile = key.decode('utf-8')[len(STRING_KEY_PREFIX):]
+        batch.append((smile, json.loads(value)))
+    writer.write_batch(batch)
+    if delete_old:
+        redis_client.delete(*keys)
+    return len(batch)
+
+def benchmark_layouts(jsonl_file, redis_host="localhost", redis_port=6379, scratch_db=15,
+                      sample_size=100000, num_lookups=1000):
+    """
+    Import the first sample_size records into a scratch database once per layout and
+    report memory per molecule and lookup latency. The scratch database is flushed.
+    """
+    r = connect_redis(redis_host, redis_port, scratch_db)
+    if r.dbsize() > 0:
+        print(f"Error: scratch DB {scratch_db} is not empty, refusing to flush it.")
+        sys.exit(1)
+
+    smiles_sample = []
+    with open(jsonl_file, 'r') as f:
+        for line_num, line in enumerate(f):
+            if line_num >= sample_size:
+                break
+            smile = json.loads(line).get("smile")
+            cleaned = clean_smile(smile) if smile else None
+            if cleaned:
+                smiles_sample.append(cleaned)
+    lookup_sample = random.sample(smiles_sample, min(num_lookups, len(smiles_sample)))
+
+    report = {}
+    for layout in (LAYOUT_STRING, LAYOUT_COMPACT):
+        r.flushdb()
+        baseline = r.info('memory')['used_memory']
+        import_data_to_redis(jsonl_file, redis_host, redis_port, scratch_db, layout=layout, max_records=sample_size)
+        used = r.info('memory')['used_memory'] - baseline
+        start = time.perf_counter()
+        for smile in lookup_sample:
+            get_patent_ids(r, smile)
+        lookup_ms = (time.perf_counter() - start) * 1000 / max(1, len(lookup_sample))
+        report[layout] = (used, lookup_ms)
+    r.flushdb()
+
+    print(f"Benchmark on {len(smiles_sample)} molecules:")
+    for layout, (used, lookup_ms) in report.items():
+        print(f"  {layout:8s}: {used / 1024 / 1024:.1f} MB, {used / max(1, len(smiles_sample)):.1f} B/molecule, "
+              f"{lookup_ms:.3f} ms/lookup")
+    if report[LAYOUT_COMPACT][0] > 0:
+        print(f"  compact layout uses {report[LAYOUT_STRING][0] / report[LAYOUT_COMPACT][0]:.1f}x less memory")
+    return report
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Import PatCID molecule_to_patents.jsonl into Redis.")
+    parser.add_argument('jsonl_file', nargs='?', default="patcid_molecule_to_patents.jsonl")
     # Get Redis connection details from environment or command line
-    redis_host = os.getenv("REDIS_HOST", "localhost")
-    redis_port = int(os.getenv("REDIS_PORT", 6379))
-    redis_db = int(os.getenv("REDIS_DB", 0))
-    
-    # Override with command line arguments if provided
-    if len(sys.argv) > 1:
-        jsonl_file = sys.argv[1]
-    if len(sys.argv) > 2:
-        redis_host = sys.argv[2]
-    if len(sys.argv) > 3:
-        redis_port = int(sys.argv[3])
-    if len(sys.argv) > 4:
-        redis_db = int(sys.argv[4])
-    
-    # Import data
-    import_data_to_redis(jsonl_file, redis_host, redis_port, redis_db)
+    parser.add_argument('redis_host', nargs='?', default=os.getenv("REDIS_HOST", "localhost"))
+    parser.add_argument('redis_port', nargs='?', type=int, default=int(os.getenv("REDIS_PORT", 6379)))
+    parser.add_argument('redis_db', nargs='?', type=int, default=int(os.getenv("REDIS_DB", 0)))
+    parser.add_argument('--layout', choices=[LAYOUT_STRING, LAYOUT_COMPACT], default=LAYOUT_STRING,
+                        help="Storage layout to import into.")
+    parser.add_argument('--migrate', action='store_true',
+                        help="Convert an existing string-layout database to the compact layout.")
+    parser.add_argument('--delete-old', action='store_true',
+                        help="With --migrate, delete string keys once migrated.")
+    parser.add_argument('--index-file', type=str, default=None, metavar='PATH',
+                        help="Build an embedded index file at PATH instead of importing into Redis.")
+    parser.add_argument('--fingerprints', type=str, default=None, metavar='DIR',
+                        help="Also build a Morgan fingerprint similarity index in DIR.")
+    parser.add_argument('--benchmark', type=int, metavar='N', default=None,
+                        help="Compare memory usage of both layouts on the first N records.")
+    parser.add_argument('--scratch-db', type=int, default=15,
+                        help="Empty Redis DB used (and flushed) by --benchmark.")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_arguments()
+
+    if args.index_file:
+        build_index_file(args.jsonl_file, args.index_file, fingerprint_dir=args.fingerprints)
+    elif args.benchmark:
+        benchmark_layouts(args.jsonl_file, args.redis_host, args.redis_port, args.scratch_db,
+                          sample_size=args.benchmark)
+    elif args.migrate:
+        migrate_to_compact(args.redis_host, args.redis_port, args.redis_db, delete_old=args.delete_old)
+    else:
+        # Import data
+        import_data_to_redis(args.jsonl_file, args.redis_host, args.redis_port, args.redis_db, layout=args.layout,
+                             fingerprint_dir=args.fingerprints)
@@ -0,0 +1,141 @@
+"""
+Check NameToSMILES.convert_many against a local stub of the PubChem PUG-REST endpoints it uses:
+POST compound/name/cids/JSON (one name per request) and POST compound/cid/property/.../JSON
+(batches of CIDs).
+
+    python -m unittest test_name_to_smiles
+"""
+import json
+import os
+import tempfile
+import threading
+import unittest
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+from RetroSynAgent import name_to_smiles
+from RetroSynAgent.name_to_smiles import NameToSMILES
+
+# known names and their CIDs; several names share a CID, as synonyms do
+KNOWN_NAMES = {f'compound {i}': 1000 + i for i in range(150)}
+KNOWN_NAMES['ethanol'] = KNOWN_NAMES['ethyl alcohol'] = 702
+
+
+def isomeric_smiles(cid):
+    return f'[{cid}CH4]'
+
+
+class PubChemStub(BaseHTTPRequestHandler):
+    # (path, form data) of every request, shared with the test
+    requests = []
+
+    def do_POST(self):
+        form = urllib.parse.parse_qs(self.rfile.read(int(self.headers['Content-Length'])).decode())
+        PubChemStub.requests.append((self.path, form))
+        if self.path == '/compound/name/cids/JSON':
+            cid = KNOWN_NAMES.get(form['name'][0])
+            if cid is None:
+                self.send_json(404, {'Fault': {'Code': 'PUGREST.NotFound'}})
+            else:
+                self.send_json(200, {'IdentifierList': {'CID': [cid]}})
+        elif self.path == '/compound/cid/property/IsomericSMILES,CanonicalSMILES/JSON':
+            properties = [{'CID': int(cid), 'IsomericSMILES': isomeric_smiles(int(cid)), 'CanonicalSMILES': 'CO'}
+                          for cid in form['cid'][0].split(',')]
+            self.send_json(200, {'PropertyTable': {'Properties': properties}})
+        else:
+            self.send_json(400, {})
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ConvertManyTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), PubChemStub)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        PubChemStub.requests.clear()
+        # the caches are json files in the working directory, one instance per file
+        self.cwd = os.getcwd()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        os.chdir(self.tmpdir.name)
+        patches = [
+            mock.patch.object(name_to_smiles, 'PUBCHEM_BASE_URL', f'http://127.0.0.1:{self.server.server_port}'),
+            mock.patch.object(name_to_smiles, '_pubchem_rate_limiter', name_to_smiles._RateLimiter(1000)),
+            mock.patch.dict(name_to_smiles._smiles_caches, clear=True),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmpdir.cleanup()
+
+    def requests_to(self, path):
+        return [form for request_path, form in PubChemStub.requests if request_path == path]
+
+    def test_results_mapped_back_to_names(self):
+        names = ['ethanol', 'compound 3', 'ethyl alcohol', 'unknownium', 'compound 3']
+        resolved, unknown = NameToSMILES.convert_many(names)
+        self.assertEqual(resolved, {'ethanol': isomeric_smiles(702), 'ethyl alcohol': isomeric_smiles(702),
+                                    'compound 3': isomeric_smiles(1003)})
+        self.assertEqual(unknown, {'unknownium'})
+        # one name lookup per distinct name, the shared CID requested once
+        self.assertEqual(len(self.requests_to('/compound/name/cids/JSON')), 4)
+        (batch,) = self.requests_to('/compound/cid/property/IsomericSMILES,CanonicalSMILES/JSON')
+        self.assertEqual(sorted(batch['cid'][0].split(',')), ['1003', '702'])
+
+    def test_canonical_and_isomeric_caches(self):
+        NameToSMILES.convert_many(['ethanol'], isomeric=False)
+        NameToSMILES.convert_many(['ethanol'])
+        self.assertEqual(dict(name_to_smiles.get_smiles_cache()), {'ethanol': 'CO'})
+        self.assertEqual(dict(name_to_smiles.get_smiles_cache(name_to_smiles.ISOMERIC_SMILES_CACHE_FILE)),
+                         {'ethanol': isomeric_smiles(702)})
+        # cached now, in both forms
+        PubChemStub.requests.clear()
+        self.assertEqual(NameToSMILES.convert_many(['ethanol'], isomeric=False), ({'ethanol': 'CO'}, set()))
+        self.assertEqual(NameToSMILES.convert_many(['ethanol']), ({'ethanol': isomeric_smiles(702)}, set()))
+        self.assertEqual(PubChemStub.requests, [])
+
+    def test_cache_unknown(self):
+        NameToSMILES.convert_many(['unknownium'], isomeric=False)
+        self.assertNotIn('unknownium', name_to_smiles.get_smiles_cache())
+        NameToSMILES.convert_many(['unknownium'], isomeric=False, cache_unknown=True)
+        self.assertEqual(name_to_smiles.get_smiles_cache()['unknownium'], 'unknownium')
+        # cached as unknown, not queried again
+        PubChemStub.requests.clear()
+        resolved, unknown = NameToSMILES.convert_many(['unknownium'], isomeric=False, cache_unknown=True)
+        self.assertEqual((resolved, unknown), ({}, set()))
+        self.assertEqual(PubChemStub.requests, [])
+        with open(name_to_smiles.SMILES_CACHE_FILE, encoding='utf-8') as f:
+            self.assertEqual(json.load(f), {'unknownium': 'unknownium'})
+
+    def test_cid_batches(self):
+        names = [f'compound {i}' for i in range(150)]
+        resolved, unknown = NameToSMILES.convert_many(names)
+        self.assertEqual(resolved, {name: isomeric_smiles(cid) for name, cid in KNOWN_NAMES.items() if name in names})
+        self.assertEqual(unknown, set())
+        batches = self.requests_to('/compound/cid/property/IsomericSMILES,CanonicalSMILES/JSON')
+        self.assertEqual(sorted(len(batch['cid'][0].split(',')) for batch in batches),
+                         [150 - name_to_smiles.PUBCHEM_CID_BATCH_SIZE, name_to_smiles.PUBCHEM_CID_BATCH_SIZE])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+"""
+Check that Tree.find_best_paths with a large k returns the pathways of Tree.find_all_paths, on
+small reaction networks with cycles and a fixed stock set.
+
+    python -m unittest test_route_search
+"""
+import contextlib
+import io
+import random
+import unittest
+from unittest import mock
+
+from RetroSynAgent.reactionRecord import Reaction
+from RetroSynAgent.treeBuilder import CommonSubstanceDB, Tree
+
+
+def reactions_of(spec):
+    """
+    {idx: Reaction} of [(product, [reactant, ...]), ...], idx from 1
+    """
+    return {str(i): Reaction(reactants, [product], 'c', 'test', str(i))
+            for i, (product, reactants) in enumerate(spec, start=1)}
+
+
+def build(target, reactions, stock, prune_unsolvable=False):
+    """
+    Tree over the reactions with a fixed stock set, without any stock database or network lookups
+    """
+    tree = Tree(target, reactions=reactions, prune_unsolvable=prune_unsolvable)
+    tree.db.prefetch_smiles = lambda names: ({}, set())
+    tree.db.check_many = lambda names, max_workers=8: [name in stock for name in names]
+    tree.context.cache_func = stock.__contains__
+    with contextlib.redirect_stdout(io.StringIO()):
+        tree.construct_tree()
+    return tree
+
+
+def random_network(rng):
+    substances = [f's{i}' for i in range(rng.randint(4, 8))]
+    spec = [(rng.choice(substances), rng.sample(substances, rng.randint(1, 3))) for _ in range(rng.randint(2, 14))]
+    stock = set(rng.sample(substances[1:], rng.randint(1, 3)))
+    return substances[0], reactions_of(spec), stock
+
+
+class FindBestPathsTest(unittest.TestCase):
+    def setUp(self):
+        # no emol.json or query results, the stock is given per tree
+        patches = [mock.patch.object(CommonSubstanceDB, '_shared_database', set()),
+                   mock.patch.object(CommonSubstanceDB, '_shared_query_results', {})]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def assertSamePathways(self, tree):
+        all_paths = sorted(sorted(path) for path in tree.find_all_paths())
+        best_paths = sorted(sorted(path) for _, path in tree.find_best_paths(k=10 ** 6))
+        self.assertEqual(best_paths, all_paths)
+
+    def test_route_through_later_intermediate(self):
+        tree = build('t', reactions_of([('t', ['a']), ('a', ['s']), ('a', ['c']), ('c', ['e']), ('e', ['s2'])]),
+                     {'s', 's2'})
+        self.assertEqual(tree.find_best_paths(k=10), [(2.0, ['1', '2']), (4.0, ['1', '3', '4', '5'])])
+        self.assertSamePathways(tree)
+
+    def test_cycle(self):
+        # a <- b <- a is cut on each branch, a is also made from stock
+        tree = build('t', reactions_of([('t', ['a']), ('a', ['b']), ('b', ['a']), ('b', ['s']), ('a', ['s'])]),
+                     {'s'})
+        self.assertEqual(sorted(path for _, path in tree.find_best_paths(k=10)), [['1', '2', '4'], ['1', '5']])
+        self.assertSamePathways(tree)
+
+    def test_k_cheapest(self):
+        tree = build('t', reactions_of([('t', ['a']), ('a', ['s']), ('a', ['c']), ('c', ['e']), ('e', ['s2'])]),
+                     {'s', 's2'})
+        self.assertEqual(tree.find_best_paths(k=1), [(2.0, ['1', '2'])])
+
+    def test_random_cyclic_networks(self):
+        rng = random.Random(0)
+        for trial in range(200):
+            target, reactions, stock = random_network(rng)
+            for prune_unsolvable in (False, True):
+                with self.subTest(trial=trial, prune_unsolvable=prune_unsolvable):
+                    self.assertSamePathways(build(target, reactions, stock, prune_unsolvable))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,148 @@
+"""
+Check that cycle handling by strongly connected components (Node.closes_cycle) yields the same
+trees and pathways as the per-node ancestor sets it replaced.
+
+Every archived tree in tree_pi is rebuilt from its reactions twice, with the current nodes and
+with the previous ancestor-set nodes, taking its leaves as the stock. Both must match each other
+and the archived pathways. --random N also checks N random reaction networks full of cycles.
+
+    python verify_cycle_pruning.py                      # every tree in tree_pi
+    python verify_cycle_pruning.py tree_pi/x_w_exp.npz  # given trees
+    python verify_cycle_pruning.py --random 500
+"""
+import argparse
+import contextlib
+import glob
+import io
+import os
+import random
+
+from RetroSynAgent.reactionRecord import Reaction
+from RetroSynAgent.treeBuilder import Node, Tree
+from RetroSynAgent.treeStore import load_tree
+
+
+class LegacyNode(Node):
+    """
+    Node with the previous cycle check: every node carries the set of its ancestors' substance ids
+    """
+    def __init__(self, *args, fathers_set=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fathers_set = fathers_set if fathers_set is not None else set()
+
+    def add_child(self, substance_id, reaction_id):
+        fathers_set = set(self.fathers_set)
+        fathers_set.add(self.substance_id)
+        child = LegacyNode(substance_id, self.context, fathers_set=fathers_set, father=self, reaction_id=reaction_id)
+        self.context.stats.add_node(self.depth + 1)
+        if not self.children:
+            self.children = []
+        self.children.append(child)
+        return child
+
+    def expand_reaction(self, reaction_id):
+        for reactant_id in self.network.reactants(reaction_id).tolist():
+            child = self.add_child(reactant_id, reaction_id)
+            if child.substance_id in child.fathers_set:
+                self.remove_child_by_reaction(reaction_id)
+                break
+            if not child.expand():
+                child.is_leaf = False
+
+
+def rebuild(target, reactions, stock, node_class, prune_unsolvable=False):
+    """
+    Tree over the reactions with a fixed stock set, without any stock database or network lookups
+    """
+    tree = Tree(target, reactions=reactions, prune_unsolvable=prune_unsolvable)
+    tree.db.prefetch_smiles = lambda names: None
+    tree.db.check_many = lambda names, max_workers=8: [name in stock for name in names]
+    tree.context.cache_func = stock.__contains__
+    tree.new_root(node_class)
+    with contextlib.redirect_stdout(io.StringIO()):
+        tree.construct_tree()
+    return tree
+
+
+def shape(node):
+    return (node.substance, node.reaction_index, node.is_leaf, [shape(child) for child in node.children])
+
+
+def compare(target, reactions, stock, prune_unsolvable=False, archived_paths=None):
+    """
+    Returns:
+        list of mismatch descriptions, empty when the trees and pathways agree
+    """
+    current = rebuild(target, reactions, stock, Node, prune_unsolvable)
+    legacy = rebuild(target, reactions, stock, LegacyNode, prune_unsolvable)
+    errors = []
+    if shape(current.root) != shape(legacy.root):
+        errors.append('trees differ')
+    current_paths = sorted(map(sorted, current.find_all_paths()))
+    if current_paths != sorted(map(sorted, legacy.find_all_paths())):
+        errors.append('pathways differ from the ancestor-set tree')
+    if archived_paths is not None and current_paths != sorted(map(sorted, archived_paths)):
+        errors.append('pathways differ from the archived tree')
+    if current.unexpandable_substances != legacy.unexpandable_substances:
+        errors.append('unexpandable substances differ')
+    return errors
+
+
+def stock_of(tree):
+    stock = set()
+    nodes = [tree.root]
+    while nodes:
+        node = nodes.pop()
+        if node.is_leaf:
+            stock.add(node.substance)
+        nodes.extend(node.children)
+    return stock
+
+
+def verify_archived(filenames):
+    failed = 0
+    for filename in filenames:
+        tree = load_tree(filename)
+        errors = compare(tree.target_substance, tree.reactions, stock_of(tree),
+                         prune_unsolvable=tree.prune_unsolvable, archived_paths=tree.find_all_paths())
+        print(f'{filename}: {"; ".join(errors) if errors else "ok"}')
+        failed += bool(errors)
+    return failed
+
+
+def random_reactions(rng, num_substances=12, num_reactions=20):
+    substances = [f's{i}' for i in range(num_substances)]
+    reactions = {}
+    for idx in range(1, num_reactions + 1):
+        reactants = rng.sample(substances, rng.randint(1, 3))
+        products = rng.sample(substances, rng.randint(1, 2))
+        reactions[str(idx)] = Reaction(reactants, products, f'c{idx}', f'doc{idx % 4}', str(idx))
+    return substances, reactions
+
+
+def verify_random(count, seed=0):
+    rng = random.Random(seed)
+    failed = 0
+    for trial in range(count):
+        substances, reactions = random_reactions(rng)
+        stock = set(rng.sample(substances[1:], 4))
+        errors = compare(substances[0], reactions, stock, prune_unsolvable=trial % 2 == 1)
+        if errors:
+            print(f'random network {trial}: {"; ".join(errors)}')
+            failed += 1
+    print(f'{count - failed} of {count} random networks agree.')
+    return failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare SCC cycle handling with per-node ancestor sets.")
+    parser.add_argument('trees', nargs='*', help="Tree files, by default every .npz tree in tree_pi.")
+    parser.add_argument('--random', type=int, default=0, help="Number of random reaction networks to check.")
+    args = parser.parse_args()
+    filenames = args.trees or sorted(glob.glob(os.path.join('tree_pi', '*.npz')))
+    failed = verify_archived(filenames)
+    if args.random:
+        failed += verify_random(args.random)
+    if failed:
+        raise SystemExit(f'{failed} mismatches')
+    print('Cycle handling matches the ancestor sets.')
@@ -5,7 +5,6 @@ from fastapi.templating import Jinja2Templates
 from typing import List, Optional
 from pydantic import BaseModel
 from RetroSynAgent.treeBuilder import TreeLoader, Tree
-import os
 app = FastAPI()
 app.mount("/static", StaticFiles(directory="static"), name="static")
 templates = Jinja2Templates(directory="templates")
@@ -126,19 +125,19 @@ tree_loader = TreeLoader()
 # tree_folder = 'tree_pi/0108-alg2-final'
 tree_folder = 'tree_pi'
 # main_tree
-tree_main_filename = f'{tree_folder}/{material}_w_exp_alg.pkl'
+tree_main_filename = f'{tree_folder}/{material}_w_exp_alg.npz'
 # sub_tree_1_purple
-# tree_filtered_filename = f"{tree_folder}/{material}_filtered.pkl"
+# tree_filtered_filename = f"{tree_folder}/{material}_filtered.npz"
 # sub_tree_2_black
-tree_wo_exp_filename = f'{tree_folder}/{material}_wo_exp_alg.pkl'
+tree_wo_exp_filename = f'{tree_folder}/{material}_wo_exp_alg.npz'
 # pathway1
-path_1 = f"{tree_folder}/{material}_pathway1.pkl"
+path_1 = f"{tree_folder}/{material}_pathway1.npz"
 # pathway2
-path_2 = f"{tree_folder}/{material}_pathway2.pkl"
+path_2 = f"{tree_folder}/{material}_pathway2.npz"
 
 
-if os.path.exists(tree_main_filename):
-    tree_main = tree_loader.load_tree(tree_main_filename)
+if tree_loader.exists(tree_main_filename):
+    tree_main = tree_loader.open_tree(tree_main_filename)
     tree_main_api = create_tree_from_saved_tree_2(tree_main)
     print(f'successfully loaded tree after expansion, '
           f'{tree_main.get_node_count()} nodes in original tree, '
@@ -146,21 +145,21 @@ if os.path.exists(tree_main_filename):
 # if os.path.exists(tree_filtered_filename):
 #     tree_filtered = tree_loader.load_tree(tree_filtered_filename)
 #     tree_filtered_api = create_tree_from_saved_tree_2(tree_filtered)
-if os.path.exists(tree_wo_exp_filename):
-    tree_wo_exp = tree_loader.load_tree(tree_wo_exp_filename)
+if tree_loader.exists(tree_wo_exp_filename):
+    tree_wo_exp = tree_loader.open_tree(tree_wo_exp_filename)
     tree_wo_exp_api = create_tree_from_saved_tree_2(tree_wo_exp)
     print(f'successfully loaded tree before expansion, '
           f'{tree_wo_exp.get_node_count()} nodes in original tree, '
           f'{count_nodes(tree_wo_exp_api)} nodes in api tree.')
-if os.path.exists(path_1):
-    path1_tree = tree_loader.load_tree(path_1)
+if tree_loader.exists(path_1):
+    path1_tree = tree_loader.open_tree(path_1)
     path1_tree_api = create_tree_from_saved_tree_2(path1_tree)
-if os.path.exists(path_2):
-    path2_tree = tree_loader.load_tree(path_2)
+if tree_loader.exists(path_2):
+    path2_tree = tree_loader.open_tree(path_2)
     path2_tree_api = create_tree_from_saved_tree_2(path2_tree)
 
 
-# tree_test_filename = f'{tree_folder}/{material}_w_exp_alg_0.pkl'
+# tree_test_filename = f'{tree_folder}/{material}_w_exp_alg_0.npz'
 #
 # if os.path.exists(tree_test_filename):
 #     tree_test = tree_loader.load_tree(tree_test_filename)